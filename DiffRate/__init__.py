@@ -5,10 +5,11 @@
 # LICENSE file in the root directory of this source tree.
 # --------------------------------------------------------
 
-from . import merge, patch, utils
+from . import merge, patch, reuse, temporal, utils
 from .vis import make_visualization
+from .static import export
 
-__all__ = ["utils", "merge", "patch", "make_visualization"]
+__all__ = ["utils", "merge", "patch", "reuse", "temporal", "make_visualization", "export"]
 
 
 
@@ -2,6 +2,9 @@
 Differentiable Discrte Proxy 
 '''
 
+import math
+import re
+
 import torch.nn as nn
 import torch
 from DiffRate.utils import ste_ceil
@@ -59,18 +62,178 @@ class DiffRate(nn.Module):
             token_mask[int(self.kept_token_number):] = 0
         token_mask = token_mask - token_probability.detach() + token_probability   # ste trick, similar to gumbel softmax
         return token_mask
-        
-            
-    
-            
 
 
 
-        
-        
-        
-        
-        
-            
-        
-        
\ No newline at end of file
+class DiffRateBank(nn.Module):
+    def __init__(self, patch_number=196, granularity=(1,), class_token=True) -> None:
+        '''
+        A bank of DiffRate modules, one row for each block, so that the kept token number and token mask
+        of all blocks can be computed with a few batched operations instead of one small kernel per candidate.
+        patch_number: the origianl input patch token of each block
+        granularity: the granularity of searched compression rate for each block, its length is the number of blocks
+        class_token: weather there is a class token
+        '''
+        super().__init__()
+        self.patch_number = patch_number
+        self.granularity = tuple(granularity)
+        self.class_token = class_token
+        self.class_token_num = class_token == True
+        self.block_number = len(granularity)
+
+        # blocks with a coarser granularity have less candidates, the rest of their row is padded and never selected
+        candidates = [torch.arange(patch_number, 0, -1*g).float() for g in granularity]
+        candidate_number = max(len(c) for c in candidates)
+        kept_token_candidate = torch.zeros((self.block_number, candidate_number))
+        candidate_mask = torch.zeros((self.block_number, candidate_number), dtype=torch.bool)
+        for i, c in enumerate(candidates):
+            kept_token_candidate[i, :len(c)] = c
+            candidate_mask[i, :len(c)] = True
+        self.register_buffer('kept_token_candidate', kept_token_candidate)
+        self.register_buffer('candidate_mask', candidate_mask)
+        self.selected_probability = nn.Parameter(torch.zeros((self.block_number, candidate_number)))
+        self.selected_probability.requires_grad_(True)
+
+        # the learn target of each block
+        self.kept_token_number = [self.patch_number + self.class_token_num] * self.block_number
+
+        self.update_kept_token_number()
+
+    def update_kept_token_number(self, resolve=True):
+        '''
+        resolve: whether to copy the kept token number to the host, the caller is in charge of it if set to False
+        '''
+        selected_probability = self.selected_probability.masked_fill(~self.candidate_mask, -math.inf)
+        self.selected_probability_softmax = selected_probability.softmax(dim=-1)
+        # which will be used to calculate FLOPs, leveraging STE in Ceil to keep gradient backpropagation
+        kept_token_number = ste_ceil((self.kept_token_candidate*self.selected_probability_softmax).sum(dim=-1)) + self.class_token_num
+        self.kept_token_number_tensor = kept_token_number.detach()
+        if resolve:
+            self.kept_token_number = kept_token_number.int().tolist()
+        return kept_token_number
+
+    def get_token_probability(self):
+        # token i is kept by every candidate larger than i, so the probability of all blocks is a reverse cumulative sum
+        token_number = self.patch_number + self.class_token_num
+        index = (self.kept_token_candidate.long() + self.class_token_num - 1).clamp(min=0)
+        token_probability = torch.zeros((self.block_number, token_number), device=self.selected_probability_softmax.device)
+        token_probability = token_probability.scatter_add(1, index, self.selected_probability_softmax)
+        token_probability = token_probability.flip(-1).cumsum(dim=-1).flip(-1)
+        return token_probability
+
+    def get_token_mask(self, token_number):
+        '''
+        token_number: [block_number] tensor, the token number before compression of each block,
+            only the compressed tokens in this operation are set as 0
+        return: [block_number, patch_number+class_token] mask, the rows of blocks without compression are all 1
+        '''
+        token_probability = self.get_token_probability()
+        kept_token_number = self.kept_token_number_tensor[:, None]
+        token_number = token_number[:, None]
+        position = torch.arange(token_probability.shape[-1], device=token_probability.device)[None, :]
+
+        # translate probability to 0/1 mask
+        token_mask = 1 - ((position >= kept_token_number) & (position < token_number)).float()
+        token_mask = token_mask - token_probability.detach() + token_probability   # ste trick, similar to gumbel softmax
+        token_mask = torch.where(kept_token_number < token_number, token_mask, torch.ones_like(token_mask))
+        return token_mask
+
+
+def update_diffrate_info(diffrate_info, prune_ddp, merge_ddp, training):
+    '''
+    Resolve the kept token number of all blocks for the coming forward and store them in diffrate_info.
+    training is the mode of the model, the banks created by a patch applied in eval mode are still in training mode.
+    During training, the differentiable kept token numbers and the token masks of all blocks are also updated,
+    and the integer kept token numbers are copied to the host in a single transfer, which is the only
+    host synchronization of the forward.
+    '''
+    if training:
+        prune_kept_num = prune_ddp.update_kept_token_number(resolve=False)
+        merge_kept_num = merge_ddp.update_kept_token_number(resolve=False)
+        diffrate_info["prune_kept_num"] = prune_kept_num
+        diffrate_info["merge_kept_num"] = merge_kept_num
+
+        # the token number before pruning and merging of each block, it is a decreasing sequence
+        token_number = prune_ddp.patch_number + prune_ddp.class_token_num
+        kept_token_number = torch.stack((prune_kept_num, merge_kept_num), dim=-1).detach()
+        remain_token_number = kept_token_number.clamp(max=token_number).flatten().cummin(dim=0).values.view(-1, 2)
+        last_token_number = torch.cat((remain_token_number.new_full((1,), token_number), remain_token_number[:-1, 1]))
+        mid_token_number = remain_token_number[:, 0]
+        diffrate_info["prune_mask"] = prune_ddp.get_token_mask(last_token_number)
+        diffrate_info["merge_mask"] = merge_ddp.get_token_mask(mid_token_number)
+        diffrate_info["token_number"] = token_number
+
+        prune_ddp.kept_token_number, merge_ddp.kept_token_number = kept_token_number.t().int().tolist()
+    diffrate_info["kept_token_number"] = list(zip(prune_ddp.kept_token_number, merge_ddp.kept_token_number))
+
+
+def add_search_targets(model, target_number):
+    '''
+    Give the model one prune and one merge DiffRateBank per search target, in model.prune_ddps and model.merge_ddps.
+    The banks of the first target are the current ones, the others start from scratch. The target used by
+    the forward is chosen by select_search_target, the arch parameters of all targets are in arch_parameters().
+    '''
+    if target_number == 1:
+        return
+    def new_bank(bank):
+        return DiffRateBank(bank.patch_number, bank.granularity, bank.class_token).to(bank.selected_probability.device)
+    model.prune_ddps = nn.ModuleList([model.prune_ddp] + [new_bank(model.prune_ddp) for _ in range(target_number - 1)])
+    model.merge_ddps = nn.ModuleList([model.merge_ddp] + [new_bank(model.merge_ddp) for _ in range(target_number - 1)])
+
+
+def select_search_target(model, target_index):
+    '''
+    Run the following forwards of the model with the compression rate of the target_index-th search target.
+    '''
+    if hasattr(model, "prune_ddps"):
+        model.prune_ddp = model.prune_ddps[target_index]
+        model.merge_ddp = model.merge_ddps[target_index]
+
+
+def convert_block_ddp_state_dict(state_dict, model):
+    '''
+    Stack the per-block arch parameters of the checkpoints written before DiffRateBank, e.g.
+    blocks.{i}.prune_ddp.selected_probability, into the rows of the banks of the model. The other entries are kept.
+    '''
+    pattern = re.compile(r'blocks\.(\d+)\.(prune_ddp|merge_ddp)\.(selected_probability|kept_token_candidate)$')
+    converted, rows = {}, {}
+    for k, v in state_dict.items():
+        match = pattern.match(k)
+        if match is None:
+            converted[k] = v
+        elif match.group(3) == 'selected_probability':
+            rows.setdefault(match.group(2), {})[int(match.group(1))] = v
+    for name, bank_rows in rows.items():
+        bank = getattr(model, name, None)
+        if not isinstance(bank, DiffRateBank) or f'{name}.selected_probability' in converted:
+            continue
+        if sorted(bank_rows) != list(range(bank.block_number)):
+            raise ValueError(f"the checkpoint holds the {name} of blocks {sorted(bank_rows)}, the model has {bank.block_number} blocks")
+        selected_probability = torch.zeros_like(bank.selected_probability)
+        for i, row in bank_rows.items():
+            if len(row) != int(bank.candidate_mask[i].sum()):
+                raise ValueError(f"the {name} of block {i} has {len(row)} candidates in the checkpoint, "
+                                 f"{int(bank.candidate_mask[i].sum())} in the model, check the granularity")
+            selected_probability[i, :len(row)] = row
+        converted[f'{name}.selected_probability'] = selected_probability
+        converted[f'{name}.kept_token_candidate'] = bank.kept_token_candidate.clone()
+        converted[f'{name}.candidate_mask'] = bank.candidate_mask.clone()
+    return converted
+
+
+def load_arch_state_dict(model, state_dict):
+    '''
+    Load the arch state of a full or arch-only checkpoint into the model, the per-block checkpoints written before
+    DiffRateBank are converted, see convert_block_ddp_state_dict. A checkpoint without the arch state of the
+    model raises instead of silently resuming from the initial compression rates.
+    '''
+    state_dict = convert_block_ddp_state_dict(state_dict, model)
+    missing_keys = model.load_state_dict(state_dict, strict=False).missing_keys
+    missing_keys = [k for k in missing_keys if k.find('ddp') > -1]
+    if missing_keys:
+        raise ValueError(f"the checkpoint does not hold the arch state {missing_keys}")
+    # the kept token numbers are derived from the loaded arch parameters
+    with torch.no_grad():
+        for module in model.modules():
+            if hasattr(module, 'update_kept_token_number'):
+                module.update_kept_token_number()
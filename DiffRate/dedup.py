@@ -0,0 +1,80 @@
+'''
+Near-duplicate frames of videos, collapsed into weighted samples for the search and the teacher extraction
+'''
+
+import numpy as np
+import torch
+
+
+def perceptual_hash(samples: torch.Tensor) -> torch.Tensor:
+    """
+    The 64 bit difference hash of each frame of a batch [B, C, H, W] (uint8 or normalized), as a bool tensor
+    [B, 64]: the frame is reduced to a 8x9 grayscale thumbnail, and each bit compares two neighbouring pixels.
+    """
+    gray = samples.float().mean(dim=1, keepdim=True)
+    thumbnail = torch.nn.functional.adaptive_avg_pool2d(gray, (8, 9)).flatten(1, 2)
+    return (thumbnail[..., 1:] > thumbnail[..., :-1]).flatten(1)
+
+
+# number of set bits of each byte
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def popcount(x: np.ndarray) -> np.ndarray:
+    """
+    The number of set bits of each element of a uint64 array.
+    """
+    if hasattr(np, 'bitwise_count'):    # numpy >= 2.0
+        return np.bitwise_count(x)
+    return POPCOUNT[x.view(np.uint8).reshape(*x.shape, 8)].sum(axis=-1)
+
+
+def dedup_groups(hashes, threshold, video_starts=None, frame_idxs=None, window=32):
+    """
+    Collapse the runs of near-duplicate consecutive samples into their first sample: a sample joins the run
+    of the previous one if the hamming distance of its hash to the first sample of the run is at most
+    threshold. A run never crosses the start of a video, given by the first sample index of each video
+    or, with the frame index of each sample, by a frame index which does not follow the previous one.
+
+    The distances of every sample to the next window samples are computed at once, so that the loop only
+    steps from the first sample of each run to the next, the longer runs scan the rest of their video.
+
+    Returns:
+        (indices, weights): the index of the first sample of each run and the number of samples of the run.
+    """
+    # the 64 bits of each hash in one integer
+    hashes = np.ascontiguousarray(hashes, dtype=np.uint8).view(np.uint64).reshape(-1)
+    n = len(hashes)
+    boundary = np.zeros(n, dtype=bool)
+    boundary[:1] = True
+    if video_starts is not None:
+        video_starts = np.asarray(video_starts, dtype=np.int64)
+        boundary[video_starts[video_starts < n]] = True
+    if frame_idxs is not None:
+        frame_idxs = np.asarray(frame_idxs, dtype=np.int64)
+        boundary[1:] |= frame_idxs[1:] != frame_idxs[:-1] + 1
+    starts = np.flatnonzero(boundary)
+    ends = np.append(starts[1:], n)
+    video_end = ends[np.cumsum(boundary) - 1]
+
+    # the offset of the first next sample of the same video farther than threshold, 0 if not in the window
+    far = np.zeros(n, dtype=np.int64)
+    for offset in range(1, min(window, n - 1) + 1):
+        distance = popcount(hashes[:-offset] ^ hashes[offset:])
+        found = (far[:-offset] == 0) & (distance > threshold) & (np.arange(offset, n) < video_end[:-offset])
+        far[:-offset][found] = offset
+
+    indices = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        anchor = start
+        while anchor < end:
+            indices.append(anchor)
+            if far[anchor] > 0:
+                anchor += int(far[anchor])
+                continue
+            rest = anchor + window + 1
+            distance = popcount(hashes[rest:end] ^ hashes[anchor])
+            beyond = np.flatnonzero(distance > threshold)
+            anchor = rest + int(beyond[0]) if len(beyond) > 0 else end
+    indices = np.array(indices, dtype=np.int64)
+    return indices, np.diff(np.append(indices, n)).astype(np.float32)
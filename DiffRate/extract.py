@@ -0,0 +1,93 @@
+'''
+Offline extraction of the CLIP teacher features of a video dataset into its feature store, so that the
+search never runs the teacher, see extract_features.py
+'''
+
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from .dedup import dedup_groups, perceptual_hash
+from .utils import thread_map
+
+
+class VideoDecodeDataset(Dataset):
+    """
+    The uint8 frames of some videos of a CharadesDataset, decoded and preprocessed in data loader workers.
+    """
+    def __init__(self, dataset, video_indices):
+        self.dataset = dataset
+        self.video_indices = video_indices
+
+    def __len__(self):
+        return len(self.video_indices)
+
+    def __getitem__(self, i):
+        video_idx = self.video_indices[i]
+        return video_idx, self.dataset.preprocess_video(self.dataset.video_paths[video_idx])
+
+
+@torch.no_grad()
+def extract(dataset, batch_size=256, num_workers=8, rank=0, world_size=1, decode_threads=0, dedup_threshold=-1, verbose=True):
+    """
+    Run the teacher of dataset over the videos of the shard of this rank which are not in its feature store.
+    The videos are decoded in data loader workers while the teacher runs on batches of frames gathered
+    across videos. A video is flagged in the store once all of its frames are written, so an interrupted
+    extraction resumes at video granularity. A video which decodes fewer frames than its samples in the
+    index is reported and left out of the store.
+
+    Args:
+     - dataset: a CharadesDataset built with extract=True and skip_dump=False
+     - batch_size: the number of frames of each teacher batch
+     - num_workers: the number of decoding processes
+     - rank, world_size: the videos of this rank are video_idx % world_size == rank
+     - decode_threads: if > 0, decode the videos in a pool of threads of this process instead of the workers
+     - dedup_threshold: if >= 0, the teacher only runs on the first frame of each run of near-duplicate frames
+       of a video, see DiffRate.dedup.dedup_groups, and its features are copied to the other frames of the run
+    """
+    store = dataset.feature_store
+    video_indices = [v for v in range(rank, len(dataset.video_paths), world_size) if not store.has_video(v)]
+    if verbose:
+        print(f"[rank {rank}] {len(video_indices)} videos to extract")
+    decode_dataset = VideoDecodeDataset(dataset, video_indices)
+    if decode_threads > 0:
+        loader = thread_map(decode_dataset.__getitem__, range(len(decode_dataset)), num_threads=decode_threads)
+    else:
+        loader = DataLoader(
+            decode_dataset, batch_size=None, shuffle=False,
+            num_workers=num_workers, prefetch_factor=4 if num_workers > 0 else None,
+        )
+
+    def representatives(frames):
+        if dedup_threshold < 0:
+            return torch.arange(len(frames)), torch.ones(len(frames), dtype=torch.long)
+        indices, weights = dedup_groups(np.packbits(perceptual_hash(frames).numpy(), axis=1), dedup_threshold)
+        return torch.from_numpy(indices), torch.from_numpy(weights).long()
+
+    pending, pending_frames = [], 0
+    def flush():
+        groups = [representatives(f) for _, f in pending]
+        frames = torch.cat([f[indices] for (_, f), (indices, _) in zip(pending, groups)])
+        outputs = torch.cat([dataset.teacher_features(chunk) for chunk in frames.split(batch_size)])
+        outputs = outputs.split([len(indices) for indices, _ in groups])
+        for (video_idx, f), output, (_, weights) in zip(pending, outputs, groups):
+            try:
+                store.put_video(video_idx, f, output.repeat_interleave(weights, dim=0))
+            except ValueError as e:
+                # the other videos are still extracted, this one stays missing from the store
+                print(f"[rank {rank}] Warning: {e}")
+        pending.clear()
+
+    start = time.time()
+    for i, (video_idx, frames) in enumerate(loader):
+        pending.append((video_idx, frames))
+        pending_frames += len(frames)
+        if pending_frames >= batch_size:
+            flush()
+            pending_frames = 0
+        if verbose and i % 100 == 0:
+            print(f"[rank {rank}] {i}/{len(video_indices)} videos, {time.time() - start:.0f}s")
+    if pending:
+        flush()
@@ -0,0 +1,218 @@
+'''
+Latency lookup table of a patched model, measured on the target device, and the differentiable
+latency term used by the search in place of the flop term
+
+    python -m DiffRate.latency --model vit_base_patch16_clip_224.openai --device cpu --output latency.json
+'''
+
+import argparse
+import json
+import time
+from typing import Callable, List
+
+import torch
+import torch.nn as nn
+
+
+def measure_latency(
+    fn: Callable[[], torch.Tensor],
+    device: torch.device,
+    runs: int = 40,
+    throw_out: float = 0.25,
+) -> float:
+    """
+    Measure the average latency of fn() in milliseconds, the first runs * throw_out runs are warm up.
+    """
+    is_cuda = device.type == "cuda"
+    warm_up = int(runs * throw_out)
+    for _ in range(warm_up):
+        fn()
+    if is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(runs - warm_up):
+        fn()
+    if is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) * 1000 / max(runs - warm_up, 1)
+
+
+def candidate_token_numbers(model: nn.Module) -> List[int]:
+    """
+    All the token numbers a block of the patched model can see, i.e. every kept token number candidate
+    of the prune and merge banks, and the token number of the input.
+    """
+    token_numbers = {model.patch_embed.num_patches + 1}
+    for ddp in (model.prune_ddp, model.merge_ddp):
+        candidates = (ddp.kept_token_candidate + ddp.class_token_num)[ddp.candidate_mask]
+        token_numbers.update(int(n) for n in candidates.tolist())
+    return sorted(token_numbers)
+
+
+@torch.no_grad()
+def measure_latency_table(
+    model: nn.Module,
+    device: torch.device = 0,
+    input_size: tuple = (3, 224, 224),
+    batch_size: int = 64,
+    runs: int = 40,
+    throw_out: float = 0.25,
+    use_fp16: bool = False,
+    token_numbers: List[int] = None,
+) -> dict:
+    """
+    Benchmark the attention half (norm1 + attn) and the mlp half (norm2 + mlp) of one DiffRateBlock at every
+    candidate token number, together with the cost of everything outside of the blocks (patch embedding,
+    head...). All blocks of a vision transformer have the same shape, so one block stands for all of them.
+
+    Args:
+     - model: the model patched by DiffRate.patch.deit, DiffRate.patch.clip or DiffRate.patch.mae
+     - device: the device to benchmark on, cpu included
+     - input_size: the input size of the model (channels, h, w)
+     - batch_size: the batch size to benchmark with, the table is only valid for this batch size
+     - runs: the number of runs of each measurement
+     - throw_out: the percentage of runs to throw out at the start of each measurement
+     - use_fp16: whether or not to benchmark with float16 and autocast
+     - token_numbers: the token numbers to measure, all candidates of the model by default
+
+    Returns:
+     - the latency table, see LatencyTable
+    """
+    if not isinstance(device, torch.device):
+        device = torch.device(device)
+    if token_numbers is None:
+        token_numbers = candidate_token_numbers(model)
+    model = model.eval().to(device)
+    block = model.blocks[0]
+    C = model.embed_dim
+
+    attn_ms, mlp_ms = [], []
+    with torch.autocast(device.type, enabled=use_fp16):
+        for N in token_numbers:
+            x = torch.rand(batch_size, N, C, device=device)
+            size = torch.ones(batch_size, N, 1, device=device)
+            attn_ms.append(measure_latency(lambda: x + block.attn(block.norm1(x), size)[0], device, runs, throw_out))
+            mlp_ms.append(measure_latency(lambda: x + block.mlp(block.norm2(x)), device, runs, throw_out))
+
+        # the model without compression, minus its blocks, leaves the cost of everything else
+        prune_kept_num, merge_kept_num = model.get_kept_num()
+        full = [model.patch_embed.num_patches + 1] * len(model.blocks)
+        model.set_kept_num(full, full)
+        input = torch.rand(batch_size, *input_size, device=device)
+        model_ms = measure_latency(lambda: model(input, return_flop=False), device, runs, throw_out)
+        model.set_kept_num(prune_kept_num, merge_kept_num)
+
+    blocks_ms = len(model.blocks) * (attn_ms[token_numbers.index(full[0])] + mlp_ms[token_numbers.index(full[0])]) \
+        if full[0] in token_numbers else 0.
+    return {
+        "device": str(device),
+        "batch_size": batch_size,
+        "use_fp16": use_fp16,
+        "token_number": list(token_numbers),
+        "attn_ms": attn_ms,
+        "mlp_ms": mlp_ms,
+        "other_ms": max(model_ms - blocks_ms, 0.),
+    }
+
+
+class LatencyTable(nn.Module):
+    """
+    The latency of a patched model under its current compression rate, estimated from a measured table
+    (see measure_latency_table). The latency of each block is linearly interpolated between the measured token
+    numbers, so that it is differentiable with respect to the kept token numbers just like calculate_flop_training,
+    and it is computed on device without synchronization.
+    """
+    def __init__(self, table: dict):
+        super().__init__()
+        self.table = table
+        self.other_ms = float(table["other_ms"])
+        self.register_buffer("token_number", torch.tensor(table["token_number"], dtype=torch.float32), persistent=False)
+        self.register_buffer("attn_ms", torch.tensor(table["attn_ms"], dtype=torch.float32), persistent=False)
+        self.register_buffer("mlp_ms", torch.tensor(table["mlp_ms"], dtype=torch.float32), persistent=False)
+
+    @classmethod
+    def load(cls, path: str) -> "LatencyTable":
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.table, f, indent=4)
+
+    def interpolate(self, latency: torch.Tensor, N: torch.Tensor) -> torch.Tensor:
+        # piecewise linear, extrapolated with the first and the last segment outside of the table
+        index = torch.searchsorted(self.token_number, N.detach().contiguous()).clamp(1, len(self.token_number) - 1)
+        x0, x1 = self.token_number[index - 1], self.token_number[index]
+        y0, y1 = latency[index - 1], latency[index]
+        return y0 + (N - x0) * (y1 - y0) / (x1 - x0)
+
+    def forward(self, model: nn.Module) -> torch.Tensor:
+        """
+        The latency in milliseconds of the last training forward of model.
+        """
+        with torch.cuda.amp.autocast(enabled=False):
+            prune_kept_num = model._diffrate_info["prune_kept_num"].float()
+            merge_kept_num = model._diffrate_info["merge_kept_num"].float()
+            token_number = torch.full_like(prune_kept_num[:1], model.patch_embed.num_patches + 1)
+
+            # same as chaining ste_min over the blocks: the value is the running minimum, and the gradient of the
+            # output token number of a block goes to its own prune and merge kept numbers
+            kept_num = torch.minimum(prune_kept_num, merge_kept_num)
+            kept_num = torch.minimum(kept_num.cummin(dim=0).values, token_number)
+            output_number = kept_num.detach() + (prune_kept_num + merge_kept_num) - (prune_kept_num + merge_kept_num).detach()
+            input_number = torch.cat((token_number, output_number[:-1]))
+
+            latency = self.interpolate(self.attn_ms, input_number).sum() + self.interpolate(self.mlp_ms, output_number).sum()
+        return latency + self.other_ms
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('DiffRate latency table', add_help=False)
+    parser.add_argument('--model', default='vit_base_patch16_clip_224.openai', type=str, help='name of the model')
+    parser.add_argument('--device', default='cuda', help='device to benchmark on')
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--input-size', default=224, type=int, help='images input size')
+    parser.add_argument('--nb_classes', default=512, type=int, help='number of the classification types')
+    parser.add_argument('--granularity', type=int, default=4, help='the token number gap between each compression rate candidate')
+    parser.add_argument('--runs', default=40, type=int, help='number of runs of each measurement')
+    parser.add_argument('--fp16', action='store_true', default=False, help='benchmark with float16 and autocast')
+    parser.add_argument('--fused-attn', action='store_true', default=False, help='run the attention of deit and clip with the fused scaled_dot_product_attention')
+    parser.add_argument('--output', default='latency.json', type=str, help='path of the latency table')
+    return parser
+
+
+def main(args):
+    from timm.models import create_model
+    import DiffRate
+
+    if args.model.endswith('.openai'):
+        class QuickGELU(torch.nn.Module):
+            def forward(self, x: torch.Tensor):
+                return x * torch.sigmoid(1.702 * x)
+        kwargs = {'act_layer': QuickGELU}
+    else:
+        kwargs = {}
+    # the latency does not depend on the weights
+    model = create_model(args.model, pretrained=False, num_classes=args.nb_classes, **kwargs)
+
+    if 'deit' in args.model:
+        DiffRate.patch.deit(model, prune_granularity=args.granularity, merge_granularity=args.granularity, fused_attn=args.fused_attn)
+    elif 'mae' in args.model:
+        DiffRate.patch.mae(model, prune_granularity=args.granularity, merge_granularity=args.granularity)
+    elif 'clip' in args.model:
+        DiffRate.patch.clip(model, prune_granularity=args.granularity, merge_granularity=args.granularity, fused_attn=args.fused_attn)
+    else:
+        raise ValueError("only support deit, mae and clip for the latency table")
+
+    table = measure_latency_table(
+        model, device=args.device, input_size=(3, args.input_size, args.input_size),
+        batch_size=args.batch_size, runs=args.runs, use_fp16=args.fp16,
+    )
+    table["model"] = args.model
+    LatencyTable(table).save(args.output)
+    print(f"Latency table of {len(table['token_number'])} token numbers saved to {args.output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('DiffRate latency table', parents=[get_args_parser()])
+    main(parser.parse_args())
@@ -20,6 +20,11 @@ def get_merge_func(metric: torch.Tensor, kept_number: int, class_token: bool = T
         node_max, node_idx = similarity.max(dim=-1)
         dst_idx = node_idx[..., None]
     def merge(x: torch.Tensor, mode="mean", training=False) -> torch.Tensor:
+        if mode == "source":
+            # x is the source [B, N], the merged tokens are assigned to their destination token
+            merged = (x >= kept_number) & (x < kept_number + compress_number)
+            dst = dst_idx[..., 0].gather(1, (x.long() - kept_number).clamp(0, compress_number - 1))
+            return torch.where(merged, dst.to(x.dtype), x)
         src = x[:,kept_number:]
         dst = x[:,:kept_number]
         n, t1, c = src.shape
@@ -30,19 +35,37 @@ def get_merge_func(metric: torch.Tensor, kept_number: int, class_token: bool = T
             return dst
     return merge, node_max
 
+def get_source(B: int, N: int, device=None) -> torch.Tensor:
+    '''
+    The source of each original token, which is the index of the current token it belongs to, -1 if it is pruned.
+    It is stored as a compact [B, N] int32 tensor instead of a [B, N', N] matrix.
+    '''
+    return torch.arange(N, device=device, dtype=torch.int32)[None, ...].expand(B, N)
+
+def sort_source(source: torch.Tensor, idx: torch.Tensor) -> torch.Tensor:
+    '''
+    Update the source after the tokens are gathered by idx [B, N'].
+    '''
+    B, N = idx.shape
+    position = torch.empty_like(idx).scatter_(1, idx, torch.arange(N, device=idx.device)[None, ...].expand(B, N))
+    sorted_source = position.gather(1, source.long().clamp(min=0)).to(source.dtype)
+    return torch.where(source >= 0, sorted_source, source)
+
+def prune_source(source: torch.Tensor, kept_number: int) -> torch.Tensor:
+    '''
+    Update the source after the tokens are pruned to the first kept_number tokens.
+    '''
+    return torch.where(source >= kept_number, torch.full_like(source, -1), source)
+
 def uncompress(x, source):
     '''
     input: 
         x: [B, N', C]
-        source: [B, N', N]
-        size: [B, N', 1]
+        source: [B, N]
     output:
         x: [B, N, C]
-        source: [B, N, N]
-        size: [B, N, 1]
     '''
-    index = source.argmax(dim=1)
-    # print(index)
+    index = source.long().clamp(min=0)
     uncompressed_x = torch.gather(x, dim=1, index=index.unsqueeze(-1).expand(-1,-1,x.shape[-1]))
     return uncompressed_x
 
@@ -11,7 +11,7 @@ from DiffRate.merge import get_merge_func
 from DiffRate.patch.deit import DiffRateAttention
 
 from DiffRate.utils import ste_min
-from DiffRate.merge import tokentofeature, uncompress
+from DiffRate.merge import tokentofeature, uncompress, get_source, sort_source
 
 import pdb
 
@@ -37,8 +37,7 @@ class DiffRateDownsampling(Downsampling):
         if len(x.shape) == 3:
             if self.training:
                 mask = self._diffrate_info["mask"]
-                last_token_number = mask[0].sum().int()
-                x_ = uncompress(x[:,:last_token_number], self._diffrate_info["source"][:,:last_token_number])
+                x_ = uncompress(x, self._diffrate_info["source"])
                 B, N, C = x_.shape
                 x_sort = torch.zeros((B,N,C),device=x.device)
                 x_sort = x_sort.scatter_reduce(1, self._diffrate_info["index"].unsqueeze(-1).expand(B, N, C), x,reduce='sum')
@@ -58,7 +57,7 @@ class DiffRateDownsampling(Downsampling):
 
         # refine
         B, N, C = x.shape
-        self._diffrate_info["source"] = torch.eye(N, device=x.device)[None, ...].expand(B, N, N)
+        self._diffrate_info["source"] = get_source(B, N, device=x.device)
         self._diffrate_info["size"] = torch.ones([B,N,1], device=x.device)
         self._diffrate_info["mask"] = torch.ones((B,N),device=x.device)
         self._diffrate_info["index"] = torch.arange((N), device=x.device).unsqueeze(0).expand(B,N).long()
@@ -87,7 +86,7 @@ class DiffRateMetaFormerBlock(MetaFormerBlock):
             ## sort
             x = torch.gather(x, dim=1, index=idx.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
             self._diffrate_info["size"] = torch.gather(self._diffrate_info["size"], dim=1, index=idx.unsqueeze(-1))
-            self._diffrate_info["source"] = torch.gather(self._diffrate_info["source"], dim=1, index=idx.unsqueeze(-1).expand(-1, -1, self._diffrate_info["source"].shape[-1]))
+            self._diffrate_info["source"] = sort_source(self._diffrate_info["source"], idx)
             self._diffrate_info["index"] = torch.gather(self._diffrate_info["index"], dim=1, index=idx)
 
             ## merge
@@ -97,7 +96,7 @@ class DiffRateMetaFormerBlock(MetaFormerBlock):
                 self._diffrate_info["merge_kept_num"].append(merge_kept_num)
                 if merge_kept_num < last_token_number:
                     merge_mask = self.merge_ddp.get_token_mask(last_token_number)
-                    x_compressed, size_compressed, source_compressed = x[:, last_token_number:], self._diffrate_info["size"][:,last_token_number:], self._diffrate_info["source"][:,last_token_number:]
+                    x_compressed, size_compressed = x[:, last_token_number:], self._diffrate_info["size"][:,last_token_number:]
                     merge_func, node_max = get_merge_func(metric=x[:, :last_token_number].detach(), kept_number=int(merge_kept_num))
                     x = merge_func(x[:,:last_token_number],  mode="mean", training=True)
                     # optimize proportional attention in ToMe by considering similarity
@@ -105,8 +104,7 @@ class DiffRateMetaFormerBlock(MetaFormerBlock):
                     size = merge_func(size,  mode="sum", training=True)
                     x = torch.cat([x, x_compressed], dim=1)
                     self._diffrate_info["size"] = torch.cat([size, size_compressed], dim=1)
-                    source = merge_func(self._diffrate_info["source"][:, :last_token_number], mode="amax", training=True)
-                    self._diffrate_info["source"] = torch.cat([source, source_compressed], dim=1)
+                    self._diffrate_info["source"] = merge_func(self._diffrate_info["source"], mode="source", training=True)
                     mask = mask * merge_mask
 
                 self._diffrate_info["mask"] = mask
@@ -118,7 +116,7 @@ class DiffRateMetaFormerBlock(MetaFormerBlock):
 
                     x = merge(x,mode='mean')
                     self._diffrate_info["size"] = merge(self._diffrate_info["size"], mode='sum')
-                    self._diffrate_info["source"] = merge(self._diffrate_info["source"], mode="amax")
+                    self._diffrate_info["source"] = merge(self._diffrate_info["source"], mode="source")
                 
 
         else:
@@ -148,7 +146,7 @@ def make_diffrate_class(transformer_class):
             self._diffrate_info["mask"] =  torch.ones((B,3136),device=x.device)
             self._diffrate_info["prune_kept_num"] = []
             self._diffrate_info["merge_kept_num"] = []
-            self._diffrate_info["source"] = torch.eye(3136, device=x.device)[None, ...].expand(B, 3136, 3136)
+            self._diffrate_info["source"] = get_source(B, 3136, device=x.device)
             x = super().forward(x)
             if return_flop:
                 if self.training:
@@ -273,6 +271,7 @@ def apply_patch(
         "size": None,
         "mask": None,           # only for training
         "source": None,
+        "fused_attn": False,    # the token importance needs the whole attention map
     }
 
     block_index = 0
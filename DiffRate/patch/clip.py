@@ -11,28 +11,49 @@
 
 
 import torch
+from timm.data.constants import OPENAI_CLIP_MEAN, OPENAI_CLIP_STD
 from timm.models.vision_transformer import Attention, Block, VisionTransformer
 
 
 from .deit import DiffRateBlock, DiffRateAttention
+from DiffRate.ddp import DiffRateBank, update_diffrate_info
+from DiffRate.merge import get_source, sort_source
+from DiffRate.reuse import reuse_stats
 
-from DiffRate.utils import ste_min
+from DiffRate.utils import ste_min, add_input_normalization, normalize_input
 
 
 
 
 def make_diffrate_class(transformer_class):
     class DiffRateVisionTransformer(transformer_class):
-        def forward(self, x, return_flop=True, return_tokens=False, lsh_tables=None) -> torch.Tensor:
-            '''forward -> forward_inner -> forward_features -> forward_head'''
+        def forward(self, x, return_flop=True, return_tokens=False, lsh_tables=None, from_prefix=False, ranking=None,
+                    temporal_state=None, frame_idxs=None) -> torch.Tensor:
+            '''forward -> forward_inner -> forward_features -> forward_head
+            from_prefix: x is the output tokens of block 0 [B, N, C] given by forward_prefix, e.g. from a prefix cache
+            ranking: the ranking given by forward_prefix with the tokens, only needed to trace the source
+            temporal_state: a DiffRate.temporal.TemporalReuseState, x is the next frame of its streams, in eval mode
+            frame_idxs: the index of the frame of each stream [B], consecutive to the previous frame if not given
+            '''
             B = x.shape[0]
             self._diffrate_info["size"] = torch.ones([B,self.patch_embed.num_patches+1,1], device=x.device)
             self._diffrate_info["mask"] =  torch.ones((B,self.patch_embed.num_patches+1),device=x.device)
-            self._diffrate_info["prune_kept_num"] = []
-            self._diffrate_info["merge_kept_num"] = []
+            update_diffrate_info(self._diffrate_info, self.prune_ddp, self.merge_ddp, self.training)
+            # the temporal reuse matches the tokens of consecutive frames by their source
+            trace_source = self._diffrate_info["trace_source"]
+            self._diffrate_info["trace_source"] = trace_source or temporal_state is not None
             if self._diffrate_info["trace_source"]:
-                self._diffrate_info["source"] = torch.eye(self.patch_embed.num_patches+1, device=x.device)[None, ...].expand(B, self.patch_embed.num_patches+1, self.patch_embed.num_patches+1)
-            ret = self.forward_inner(x, return_tokens, lsh_tables=lsh_tables)
+                self._diffrate_info["source"] = get_source(B, self.patch_embed.num_patches+1, device=x.device)
+                if from_prefix:
+                    assert ranking is not None, "tracing the source from the prefix requires its ranking"
+                    self._diffrate_info["source"] = sort_source(self._diffrate_info["source"], ranking.to(x.device))
+            if lsh_tables is not None:
+                self._diffrate_info["lsh_tables"] = lsh_tables
+            if temporal_state is not None:
+                assert not self.training and lsh_tables is None and not return_tokens, "temporal reuse is an inference mode of its own"
+                temporal_state.step(frame_idxs, batch_size=B, device=x.device)
+            ret = self.forward_inner(x, return_tokens, lsh_tables=lsh_tables, from_prefix=from_prefix, temporal_state=temporal_state)
+            self._diffrate_info["trace_source"] = trace_source
 
             if return_tokens:
                 ret, tokens = ret
@@ -49,8 +70,32 @@ def make_diffrate_class(transformer_class):
 
             return ret
 
-        def forward_inner(self, x, return_tokens=False, lsh_tables=None) -> torch.Tensor:
-            x = self.forward_features(x, return_tokens, lsh_tables=lsh_tables)
+        @torch.no_grad()
+        def forward_prefix(self, x):
+            '''
+            The frozen prefix of the search: the patch embedding and the non-compressed block 0, in eval mode.
+            Returns the output tokens of block 0 [B, N, C] and their index in the input tokens [B, N], i.e. the
+            class-attention ranking of block 0.
+            '''
+            assert not self.training, "the prefix is computed in eval mode"
+            B = x.shape[0]
+            self._diffrate_info["size"] = torch.ones([B,self.patch_embed.num_patches+1,1], device=x.device)
+            self._diffrate_info["mask"] =  torch.ones((B,self.patch_embed.num_patches+1),device=x.device)
+            update_diffrate_info(self._diffrate_info, self.prune_ddp, self.merge_ddp, self.training)
+            trace_source = self._diffrate_info["trace_source"]
+            self._diffrate_info["trace_source"] = True
+            self._diffrate_info["source"] = get_source(B, self.patch_embed.num_patches+1, device=x.device)
+            x = self.patch_embed(x)
+            x = self._pos_embed(x)
+            x = self.norm_pre(x)
+            x = self.blocks[0](x)
+            self._diffrate_info["trace_source"] = trace_source
+            # block 0 only sorts the tokens, so the source is a permutation
+            ranking = self._diffrate_info["source"].argsort(dim=1)
+            return x, ranking
+
+        def forward_inner(self, x, return_tokens=False, lsh_tables=None, from_prefix=False, temporal_state=None) -> torch.Tensor:
+            x = self.forward_features(x, return_tokens, lsh_tables=lsh_tables, from_prefix=from_prefix, temporal_state=temporal_state)
             if return_tokens:
                 x, tokens = x
             x = self.forward_head(x)
@@ -59,14 +104,28 @@ def make_diffrate_class(transformer_class):
                 return x, tokens
             return x
             
-        def forward_features(self, x: torch.Tensor, return_tokens=False, lsh_tables=None) -> torch.Tensor:
-            x = self.patch_embed(x)
-            x = self._pos_embed(x)
-            x = self.norm_pre(x)
+        def forward_features(self, x: torch.Tensor, return_tokens=False, lsh_tables=None, from_prefix=False, temporal_state=None) -> torch.Tensor:
+            if from_prefix:
+                # x is already the output of block 0
+                assert not return_tokens, "the tokens of block 0 are not cached"
+                start = 1
+            else:
+                if temporal_state is not None:
+                    x = self.forward_temporal_embed(x, temporal_state.block(-1))
+                else:
+                    x = self.patch_embed(x)
+                x = self._pos_embed(x)
+                x = self.norm_pre(x)
+                start = 0
 
             if return_tokens:
                 tokens = []
             for i, block in enumerate(self.blocks):
+                if i < start:
+                    continue
+                if temporal_state is not None:
+                    x = block.forward_temporal(x, temporal_state.block(i))
+                    continue
                 if lsh_tables is not None:
                     lsh_table = lsh_tables[i]
                 else:
@@ -105,6 +164,32 @@ def make_diffrate_class(transformer_class):
             return outcome
             '''
         
+        def forward_temporal_embed(self, x: torch.Tensor, cache) -> torch.Tensor:
+            '''
+            The patch embedding of the next frame of video streams [B, 3, H, W], where only the patches whose pixels
+            changed since the previous frame of their stream are embedded, the static ones keep their embedding,
+            and so their block outputs downstream, see DiffRate.temporal.
+            '''
+            x = normalize_input(self.patch_embed, x)
+            proj = self.patch_embed.proj
+            p = proj.kernel_size[0]
+            B, _, H, W = x.shape
+            # the patches [B, N, 3 * p * p], in the order of the conv weights
+            patches = x.unfold(2, p, p).unfold(3, p, p).permute(0, 2, 3, 1, 4, 5).reshape(B, (H // p) * (W // p), -1)
+            changed = cache.changed("pixels", patches, pixels=True)
+            weight = proj.weight.reshape(proj.out_channels, -1)
+            # the changed patches, and the classifier which always runs
+            cache.state.add_flops(changed.sum() * weight.numel() + B * self.embed_dim * self.num_classes)
+            x = cache.tokenwise("embed", patches, changed, lambda t: torch.nn.functional.linear(t, weight, proj.bias))
+            return self.patch_embed.norm(x)
+
+        def reuse_stats(self):
+            '''
+            The counters of the reuse tables of the last forward with lsh_tables, see DiffRate.reuse.reuse_stats
+            '''
+            assert self._diffrate_info["lsh_tables"] is not None, "the model has not run with reuse tables"
+            return reuse_stats(self._diffrate_info["lsh_tables"])
+
         def parameters(self, recurse=True):
             # original network parameter
             params = []
@@ -123,23 +208,20 @@ def make_diffrate_class(transformer_class):
     
 
         def get_kept_num(self):
-            prune_kept_num = []
-            merge_kept_num = []
-            for block in self.blocks:
-                prune_kept_num.append(int(block.prune_ddp.kept_token_number))
-                merge_kept_num.append(int(block.merge_ddp.kept_token_number))
+            prune_kept_num = [int(n) for n in self.prune_ddp.kept_token_number]
+            merge_kept_num = [int(n) for n in self.merge_ddp.kept_token_number]
             return prune_kept_num, merge_kept_num
         
         def set_kept_num(self, prune_kept_numbers, merge_kept_numbers):
             assert len(prune_kept_numbers) == len(self.blocks) and len(merge_kept_numbers) == len(self.blocks)
-            for block, prune_kept_number, merge_kept_number in zip(self.blocks, prune_kept_numbers, merge_kept_numbers):
-                block.prune_ddp.kept_token_number = prune_kept_number
-                block.merge_ddp.kept_token_number = merge_kept_number
+            self.prune_ddp.kept_token_number = [int(n) for n in prune_kept_numbers]
+            self.merge_ddp.kept_token_number = [int(n) for n in merge_kept_numbers]
         
         def calculate_flop_training(self):
             C = self.embed_dim
             patch_number = float(self.patch_embed.num_patches)
-            N = torch.tensor(patch_number+1, device=self.blocks[0].prune_ddp.selected_probability.device)
+            # filled on device, copying a host scalar would synchronize
+            N = torch.full((), patch_number+1, device=self.prune_ddp.selected_probability.device)
             flops = 0
             patch_embedding_flops = N*C*(self.patch_embed.patch_size[0]*self.patch_embed.patch_size[1]*3)
             classifier_flops = C*self.num_classes
@@ -160,14 +242,12 @@ def make_diffrate_class(transformer_class):
         def calculate_flop_inference(self):
             C = self.embed_dim
             patch_number = float(self.patch_embed.num_patches)
-            N = torch.tensor(patch_number+1, device=self.blocks[0].prune_ddp.selected_probability.device)
+            N = torch.tensor(patch_number+1, device=self.prune_ddp.selected_probability.device)
             flops = 0
             patch_embedding_flops = N*C*(self.patch_embed.patch_size[0]*self.patch_embed.patch_size[1]*3)
             classifier_flops = C*self.num_classes
             with torch.cuda.amp.autocast(enabled=False):
-                for block in (self.blocks):
-                    prune_kept_number = block.prune_ddp.kept_token_number
-                    merge_kept_number = block.merge_ddp.kept_token_number
+                for prune_kept_number, merge_kept_number in zip(self.prune_ddp.kept_token_number, self.merge_ddp.kept_token_number):
                     mhsa_flops = 4*N*C*C + 2*N*N*C
                     flops += mhsa_flops
                     N = ste_min(N, prune_kept_number, merge_kept_number)
@@ -182,11 +262,13 @@ def make_diffrate_class(transformer_class):
 
 
 def apply_patch(
-    model: VisionTransformer, trace_source: bool = False, prune_granularity=1, merge_granularity=1
+    model: VisionTransformer, trace_source: bool = False, prune_granularity=1, merge_granularity=1, fused_attn: bool = False
 ):
     """
     Applies DiffRate to this transformer.
+    fused_attn: run the attention with the fused scaled_dot_product_attention, requires pytorch >= 2.0
     """
+    assert not fused_attn or hasattr(torch.nn.functional, "scaled_dot_product_attention"), "fused_attn requires pytorch >= 2.0"
     DiffRateVisionTransformer = make_diffrate_class(model.__class__)
 
     model.__class__ = DiffRateVisionTransformer
@@ -196,18 +278,33 @@ def apply_patch(
         "source": None,
         "class_token": model.cls_token is not None,
         "trace_source": trace_source,
+        "fused_attn": fused_attn,
+        "lsh_tables": None,     # the reuse tables of the last forward, see reuse_stats
     }
 
     block_index = 0
     non_compressed_block_index = [0]
+    prune_granularities, merge_granularities = [], []
     for module in model.modules():
         if isinstance(module, Block):
             module.__class__ = DiffRateBlock
             if block_index in non_compressed_block_index:
-                module.introduce_diffrate(model.patch_embed.num_patches, model.patch_embed.num_patches+1, model.patch_embed.num_patches+1)
+                prune_granularities.append(model.patch_embed.num_patches+1)
+                merge_granularities.append(model.patch_embed.num_patches+1)
             else:
-                module.introduce_diffrate(model.patch_embed.num_patches, prune_granularity, merge_granularity)
+                prune_granularities.append(prune_granularity)
+                merge_granularities.append(merge_granularity)
+            module.introduce_diffrate(block_index)
             block_index += 1
             module._diffrate_info = model._diffrate_info
         elif isinstance(module, Attention):
-            module.__class__ = DiffRateAttention
\ No newline at end of file
+            module.__class__ = DiffRateAttention
+            module._diffrate_info = model._diffrate_info
+    model.prune_ddp = DiffRateBank(model.patch_embed.num_patches, prune_granularities)
+    model.merge_ddp = DiffRateBank(model.patch_embed.num_patches, merge_granularities)
+
+    # uint8 frames are normalized in the model, see add_input_normalization
+    pretrained_cfg = getattr(model, "pretrained_cfg", None) or {}
+    add_input_normalization(
+        model.patch_embed, pretrained_cfg.get("mean", OPENAI_CLIP_MEAN), pretrained_cfg.get("std", OPENAI_CLIP_STD)
+    )
@@ -14,10 +14,11 @@ from typing import Tuple
 import torch
 from timm.models.vision_transformer import Attention, Block, VisionTransformer
 import torch.nn as nn
+import torch.nn.functional as F
 
 # import DiffRate.ddp as ddp
-from DiffRate.ddp import DiffRate
-from DiffRate.merge import get_merge_func
+from DiffRate.ddp import DiffRateBank, update_diffrate_info
+from DiffRate.merge import get_merge_func, get_source, sort_source, prune_source
 
 from DiffRate.utils import ste_min
 
@@ -31,9 +32,9 @@ class DiffRateBlock(Block):
      - Apply DiffRate between the attention and mlp blocks
      - Compute and propogate token size and potentially the token sources.
     """
-    def introduce_diffrate(self,patch_number, prune_granularity, merge_granularity):
-        self.prune_ddp = DiffRate(patch_number,prune_granularity)
-        self.merge_ddp = DiffRate(patch_number,merge_granularity)
+    def introduce_diffrate(self, block_index):
+        # the compression rate of each block is stored in the DiffRateBank of the model, at row block_index
+        self.diffrate_index = block_index
         
     
     def forward(self, x: torch.Tensor, return_tokens=False, lsh_table=None) -> torch.Tensor:
@@ -56,31 +57,29 @@ class DiffRateBlock(Block):
         self._diffrate_info["size"] = torch.gather(self._diffrate_info["size"], dim=1, index=idx.unsqueeze(-1))
         mask = torch.gather( mask, dim=1, index=idx)
         if self._diffrate_info["trace_source"]:
-            self._diffrate_info["source"] = torch.gather(self._diffrate_info["source"], dim=1, index=idx.unsqueeze(-1).expand(-1, -1, self._diffrate_info["source"].shape[-1]))
+            self._diffrate_info["source"] = sort_source(self._diffrate_info["source"], idx)
 
         
+        # kept token number of this block, resolved for all blocks before the forward
+        prune_kept_num, merge_kept_num = self._diffrate_info["kept_token_number"][self.diffrate_index]
+
         if self.training:
             # pruning, pruning only needs to generate masks during training
-            last_token_number = mask[0].sum().int()
-            prune_kept_num = self.prune_ddp.update_kept_token_number()      # expected prune compression rate, has gradiet
-            self._diffrate_info["prune_kept_num"].append(prune_kept_num)
+            last_token_number = self._diffrate_info["token_number"]
             if prune_kept_num < last_token_number:        # make sure the kept token number is a decreasing sequence
-                prune_mask = self.prune_ddp.get_token_mask(last_token_number)
+                prune_mask = self._diffrate_info["prune_mask"][self.diffrate_index]
                 mask = mask * prune_mask.expand(B, -1)
 
-            mid_token_number = min(last_token_number, int(prune_kept_num)) # token number after pruning
+            mid_token_number = min(last_token_number, prune_kept_num) # token number after pruning
                 
             # merging
-            merge_kept_num = self.merge_ddp.update_kept_token_number()
-            self._diffrate_info["merge_kept_num"].append(merge_kept_num)
-
             if merge_kept_num < mid_token_number:
-                merge_mask = self.merge_ddp.get_token_mask(mid_token_number)
+                merge_mask = self._diffrate_info["merge_mask"][self.diffrate_index]
                 x_compressed, size_compressed = x[:, mid_token_number:], self._diffrate_info["size"][:,mid_token_number:]
-                merge_func, node_max = get_merge_func(metric=x[:, :mid_token_number].detach(), kept_number=int(merge_kept_num))
+                merge_func, node_max = get_merge_func(metric=x[:, :mid_token_number].detach(), kept_number=merge_kept_num)
                 x = merge_func(x[:,:mid_token_number],  mode="mean", training=True)
                 # optimize proportional attention in ToMe by considering similarity
-                size = torch.cat((self._diffrate_info["size"][:, :int(merge_kept_num)],self._diffrate_info["size"][:, int(merge_kept_num):mid_token_number]*node_max[..., None]),dim=1)
+                size = torch.cat((self._diffrate_info["size"][:, :merge_kept_num],self._diffrate_info["size"][:, merge_kept_num:mid_token_number]*node_max[..., None]),dim=1)
                 size = size.clamp(1)
                 size = merge_func(size,  mode="sum", training=True)
                 x = torch.cat([x, x_compressed], dim=1)
@@ -88,47 +87,87 @@ class DiffRateBlock(Block):
                 mask = mask * merge_mask
 
             self._diffrate_info["mask"] = mask
+            self._diffrate_info["token_number"] = min(mid_token_number, merge_kept_num)
             ret = x + self.drop_path2(self.mlp(self.norm2(x)))
             
         else:
-            # pruning
-            prune_kept_num = self.prune_ddp.kept_token_number
-            x = x[:, :prune_kept_num]
-            self._diffrate_info["size"] = self._diffrate_info["size"][:, :prune_kept_num]
-            if self._diffrate_info["trace_source"]:
-                self._diffrate_info["source"] = self._diffrate_info["source"][:, :prune_kept_num]
-                
-            
-            # merging
-            merge_kept_num = self.merge_ddp.kept_token_number
-            if merge_kept_num < prune_kept_num:
-                merge,node_max = get_merge_func(x.detach(), kept_number=merge_kept_num)
-                x = merge(x,mode='mean')
-                # optimize proportional attention in ToMe by considering similarity, this is benefit to the accuracy of off-the-shelf model.
-                self._diffrate_info["size"] = torch.cat((self._diffrate_info["size"][:, :merge_kept_num],self._diffrate_info["size"][:, merge_kept_num:]*node_max[..., None] ),dim=1)
-                self._diffrate_info["size"] = merge(self._diffrate_info["size"], mode='sum')
-                if self._diffrate_info["trace_source"]:
-                    self._diffrate_info["source"] = merge(self._diffrate_info["source"], mode="amax")
-
-            ret = x + self.drop_path2(self.mlp(self.norm2(x)))
+            x = self.compress_inference(x, prune_kept_num, merge_kept_num)
 
-            # Reusing
+            # Reusing, the mlp only runs on the tokens without a similar token in the table, see DiffRate.reuse
             if lsh_table is not None:
-                for i in range(B):
-                    tok = x[i].squeeze()
-                    for j, t in enumerate(tok):
-                        if j == 0:
-                            continue
-                        val = lsh_table.query(t)
-                        if val:
-                            ret[i, j] = val[1]
-                        else:
-                            lsh_table.add(t, ret[i, j])
+                ret = lsh_table.reuse(x, lambda x: x + self.drop_path2(self.mlp(self.norm2(x))))
+            else:
+                ret = x + self.drop_path2(self.mlp(self.norm2(x)))
 
         if return_tokens:
             return ret, x
 
         return ret
+
+    def compress_inference(self, x: torch.Tensor, prune_kept_num: int, merge_kept_num: int) -> torch.Tensor:
+        # pruning
+        x = x[:, :prune_kept_num]
+        self._diffrate_info["size"] = self._diffrate_info["size"][:, :prune_kept_num]
+        if self._diffrate_info["trace_source"]:
+            self._diffrate_info["source"] = prune_source(self._diffrate_info["source"], prune_kept_num)
+            
+        
+        # merging
+        if merge_kept_num < prune_kept_num:
+            merge,node_max = get_merge_func(x.detach(), kept_number=merge_kept_num)
+            x = merge(x,mode='mean')
+            # optimize proportional attention in ToMe by considering similarity, this is benefit to the accuracy of off-the-shelf model.
+            self._diffrate_info["size"] = torch.cat((self._diffrate_info["size"][:, :merge_kept_num],self._diffrate_info["size"][:, merge_kept_num:]*node_max[..., None] ),dim=1)
+            self._diffrate_info["size"] = merge(self._diffrate_info["size"], mode='sum')
+            if self._diffrate_info["trace_source"]:
+                self._diffrate_info["source"] = merge(self._diffrate_info["source"], mode="source")
+        return x
+
+    def forward_temporal(self, x: torch.Tensor, cache) -> torch.Tensor:
+        """
+        The inference forward of a frame of video streams [B, N, C], where only the tokens which changed since the
+        previous frame of their stream run through the block, see DiffRate.temporal:
+         - attention: the qkv of the unchanged tokens are cached, and only the changed tokens are queries, the
+           unchanged ones copy their previous output, computed in the context of the previous frame
+         - mlp: the unchanged tokens copy their previous output
+        The tokens are matched with the previous frame by their source, which has to be traced.
+        """
+        B, N, C = x.shape
+        H = self.attn.num_heads
+        size = self._diffrate_info["size"]
+        changed = cache.changed("attn", x, source=self._diffrate_info["source"], outputs=("qkv", "attn"))
+        qkv = cache.tokenwise("qkv", x, changed, lambda x: self.attn.qkv(self.norm1(x)))
+        q, k, v = qkv.reshape(B, N, 3, H, C // H).permute(2, 0, 3, 1, 4).unbind(0)
+
+        # the queries of the changed tokens first (the class token is always changed), padded to the largest
+        # number of changed tokens of the streams
+        M = int(changed.sum(dim=1).max())
+        index = changed.float().argsort(dim=1, descending=True, stable=True)[:, :M]
+        q = q.gather(2, index[:, None, :, None].expand(-1, H, -1, C // H))
+        attn = (q @ k.transpose(-2, -1)) * self.attn.scale
+        attn = attn + size.log()[:, None, None, :, 0]     # proportional attention
+        attn = attn.softmax(dim=-1)
+        x_attn = self.attn.proj((attn @ v).transpose(1, 2).reshape(B, M, C))
+        x_attn = x.gather(1, index[..., None].expand(-1, -1, C)) + self.drop_path1(x_attn)
+        x = cache.scatter("attn", index, x_attn, x.shape)
+        cache.state.add_flops(3 * changed.sum() * C * C + B * M * (C * C + 2 * N * C))
+
+        # sorting, by the class token attention of the current frame
+        cls_attn = attn[:, :, 0, 1:].mean(dim=1)  # [B, N-1]
+        _, idx = torch.sort(cls_attn, descending=True)
+        idx = torch.cat((torch.zeros_like(idx[:, :1]), idx+1), dim=1)
+        x = torch.gather(x, dim=1, index=idx.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+        self._diffrate_info["size"] = torch.gather(self._diffrate_info["size"], dim=1, index=idx.unsqueeze(-1))
+        if self._diffrate_info["trace_source"]:
+            self._diffrate_info["source"] = sort_source(self._diffrate_info["source"], idx)
+
+        prune_kept_num, merge_kept_num = self._diffrate_info["kept_token_number"][self.diffrate_index]
+        x = self.compress_inference(x, prune_kept_num, merge_kept_num)
+
+        # the tokens were sorted, pruned and merged by the current frame, not in the order of the previous one
+        changed = cache.changed("mlp", x, source=self._diffrate_info["source"], outputs=("mlp",))
+        cache.state.add_flops(8 * changed.sum() * C * C)
+        return cache.tokenwise("mlp", x, changed, lambda x: x + self.drop_path2(self.mlp(self.norm2(x))))
                 
 
                 
@@ -143,9 +182,9 @@ class DiffRateAttention(Attention):
 
     def softmax_with_policy(self, attn, policy, eps=1e-6):
         B, N = policy.size()
-        B, H, N, N = attn.size()
+        B, H, M, N = attn.size()    # M < N when only the attention of the first M tokens is computed
         attn_policy = policy.reshape(B, 1, 1, N)  # * policy.reshape(B, 1, N, 1)
-        eye = torch.eye(N, dtype=attn_policy.dtype, device=attn_policy.device).view(1, 1, N, N)
+        eye = torch.eye(N, dtype=attn_policy.dtype, device=attn_policy.device)[:M].view(1, 1, M, N)
         attn_policy = attn_policy + (1.0 - attn_policy) * eye
         max_att = torch.max(attn, dim=-1, keepdim=True)[0]
         attn = attn - max_att
@@ -171,6 +210,9 @@ class DiffRateAttention(Attention):
             qkv[2],
         )  # make torchscript happy (cannot use tensor as tuple)
 
+        if self._diffrate_info["fused_attn"]:
+            return self.forward_fused(q, k, v, size, mask)
+
         attn = (q @ k.transpose(-2, -1)) * self.scale
 
         # Apply proportional attention
@@ -191,6 +233,43 @@ class DiffRateAttention(Attention):
         # Return attention map as well here
         return x, attn
 
+    def forward_fused(
+        self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, size: torch.Tensor = None, mask: torch.Tensor = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Run the attention with the fused scaled_dot_product_attention and return the attention of the
+        class token [B, H, 1, N] instead of the whole map, which is all DiffRateBlock needs for ranking.
+        During training, the token mask is appended to the values as an extra channel, so the masked tokens
+        are excluded from the softmax and still receive gradient. Unlike softmax_with_policy, the masked
+        tokens do not attend to themselves, which only changes their own (masked) outputs.
+        """
+        B, H, N, D = q.shape
+        # Apply proportional attention as an additive mask
+        bias = size.log()[:, None, None, :, 0].to(q.dtype) if size is not None else None
+
+        if self.training:
+            policy = mask[:, None, :, None].to(v.dtype).expand(B, H, N, 1)
+            pad = v.new_zeros((B, H, N, -(D + 1) % 8))    # keep the head dim aligned for the fused kernels
+            v = torch.cat([v * policy, policy, pad], dim=-1)
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=bias, dropout_p=self.attn_drop.p if self.training else 0.)
+        if self.training:
+            x = x[..., :D] / x[..., D:D+1]
+
+        x = x.transpose(1, 2).reshape(B, N, H * D)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+
+        # the class token attention is only used for sorting, so it does not need gradient
+        with torch.no_grad():
+            cls_attn = (q[:, :, :1] @ k.transpose(-2, -1)) * self.scale
+            if bias is not None:
+                cls_attn = cls_attn + bias
+            if self.training:
+                cls_attn = self.softmax_with_policy(cls_attn, mask)
+            else:
+                cls_attn = cls_attn.softmax(dim=-1)
+        return x, cls_attn
+
 
 def make_diffrate_class(transformer_class):
     class DiffRateVisionTransformer(transformer_class):
@@ -198,10 +277,9 @@ def make_diffrate_class(transformer_class):
             B = x.shape[0]
             self._diffrate_info["size"] = torch.ones([B,self.patch_embed.num_patches+1,1], device=x.device)
             self._diffrate_info["mask"] =  torch.ones((B,self.patch_embed.num_patches+1),device=x.device)
-            self._diffrate_info["prune_kept_num"] = []
-            self._diffrate_info["merge_kept_num"] = []
+            update_diffrate_info(self._diffrate_info, self.prune_ddp, self.merge_ddp, self.training)
             if self._diffrate_info["trace_source"]:
-                self._diffrate_info["source"] = torch.eye(self.patch_embed.num_patches+1, device=x.device)[None, ...].expand(B, self.patch_embed.num_patches+1, self.patch_embed.num_patches+1)
+                self._diffrate_info["source"] = get_source(B, self.patch_embed.num_patches+1, device=x.device)
             x = super().forward(x)
             if return_flop:
                 if self.training:
@@ -229,24 +307,21 @@ def make_diffrate_class(transformer_class):
             return iter(params)    
 
         def get_kept_num(self):
-            prune_kept_num = []
-            merge_kept_num = []
-            for block in self.blocks:
-                prune_kept_num.append(int(block.prune_ddp.kept_token_number))
-                merge_kept_num.append(int(block.merge_ddp.kept_token_number))
+            prune_kept_num = [int(n) for n in self.prune_ddp.kept_token_number]
+            merge_kept_num = [int(n) for n in self.merge_ddp.kept_token_number]
             return prune_kept_num, merge_kept_num
                 
 
         def set_kept_num(self, prune_kept_numbers, merge_kept_numbers):
             assert len(prune_kept_numbers) == len(self.blocks) and len(merge_kept_numbers) == len(self.blocks)
-            for block, prune_kept_number, merge_kept_number in zip(self.blocks, prune_kept_numbers, merge_kept_numbers):
-                block.prune_ddp.kept_token_number = prune_kept_number
-                block.merge_ddp.kept_token_number = merge_kept_number
+            self.prune_ddp.kept_token_number = [int(n) for n in prune_kept_numbers]
+            self.merge_ddp.kept_token_number = [int(n) for n in merge_kept_numbers]
         
         def calculate_flop_training(self):
             C = self.embed_dim
             patch_number = float(self.patch_embed.num_patches)
-            N = torch.tensor(patch_number+1, device=self.blocks[0].prune_ddp.selected_probability.device)
+            # filled on device, copying a host scalar would synchronize
+            N = torch.full((), patch_number+1, device=self.prune_ddp.selected_probability.device)
             flops = 0
             patch_embedding_flops = N*C*(self.patch_embed.patch_size[0]*self.patch_embed.patch_size[1]*3)
             classifier_flops = C*self.num_classes
@@ -267,14 +342,12 @@ def make_diffrate_class(transformer_class):
         def calculate_flop_inference(self):
             C = self.embed_dim
             patch_number = float(self.patch_embed.num_patches)
-            N = torch.tensor(patch_number+1, device=self.blocks[0].prune_ddp.selected_probability.device)
+            N = torch.tensor(patch_number+1, device=self.prune_ddp.selected_probability.device)
             flops = 0
             patch_embedding_flops = N*C*(self.patch_embed.patch_size[0]*self.patch_embed.patch_size[1]*3)
             classifier_flops = C*self.num_classes
             with torch.cuda.amp.autocast(enabled=False):
-                for block in (self.blocks):
-                    prune_kept_number = block.prune_ddp.kept_token_number
-                    merge_kept_number = block.merge_ddp.kept_token_number
+                for prune_kept_number, merge_kept_number in zip(self.prune_ddp.kept_token_number, self.merge_ddp.kept_token_number):
                     mhsa_flops = 4*N*C*C + 2*N*N*C
                     flops += mhsa_flops
                     N = ste_min(N, prune_kept_number, merge_kept_number)
@@ -289,11 +362,13 @@ def make_diffrate_class(transformer_class):
 
 
 def apply_patch(
-    model: VisionTransformer, trace_source: bool = False,prune_granularity=1, merge_granularity=1
+    model: VisionTransformer, trace_source: bool = False, prune_granularity=1, merge_granularity=1, fused_attn: bool = False
 ):
     """
     Applies DiffRate to this transformer.
+    fused_attn: run the attention with the fused scaled_dot_product_attention, requires pytorch >= 2.0
     """
+    assert not fused_attn or hasattr(torch.nn.functional, "scaled_dot_product_attention"), "fused_attn requires pytorch >= 2.0"
     DiffRateVisionTransformer = make_diffrate_class(model.__class__)
 
     model.__class__ = DiffRateVisionTransformer
@@ -303,18 +378,26 @@ def apply_patch(
         "source": None,
         "class_token": model.cls_token is not None,
         "trace_source": trace_source,
+        "fused_attn": fused_attn,
     }
 
     block_index = 0
     non_compressed_block_index = [0]
+    prune_granularities, merge_granularities = [], []
     for module in model.modules():
         if isinstance(module, Block):
             module.__class__ = DiffRateBlock
             if block_index in non_compressed_block_index:
-                module.introduce_diffrate(model.patch_embed.num_patches, model.patch_embed.num_patches+1, model.patch_embed.num_patches+1)
+                prune_granularities.append(model.patch_embed.num_patches+1)
+                merge_granularities.append(model.patch_embed.num_patches+1)
             else:
-                module.introduce_diffrate(model.patch_embed.num_patches, prune_granularity, merge_granularity)
+                prune_granularities.append(prune_granularity)
+                merge_granularities.append(merge_granularity)
+            module.introduce_diffrate(block_index)
             block_index += 1
             module._diffrate_info = model._diffrate_info
         elif isinstance(module, Attention):
             module.__class__ = DiffRateAttention
+            module._diffrate_info = model._diffrate_info
+    model.prune_ddp = DiffRateBank(model.patch_embed.num_patches, prune_granularities)
+    model.merge_ddp = DiffRateBank(model.patch_embed.num_patches, merge_granularities)
@@ -15,6 +15,7 @@ from timm.models.vision_transformer import Attention, Block, VisionTransformer
 
 
 from .deit import DiffRateBlock, DiffRateAttention
+from DiffRate.ddp import DiffRateBank, update_diffrate_info
 
 from DiffRate.utils import ste_min
 
@@ -27,8 +28,7 @@ def make_diffrate_class(transformer_class):
             B = x.shape[0]
             self._diffrate_info["size"] = torch.ones([B,self.patch_embed.num_patches+1,1], device=x.device)
             self._diffrate_info["mask"] =  torch.ones((B,self.patch_embed.num_patches+1),device=x.device)
-            self._diffrate_info["prune_kept_num"] = []
-            self._diffrate_info["merge_kept_num"] = []
+            update_diffrate_info(self._diffrate_info, self.prune_ddp, self.merge_ddp, self.training)
             x = super().forward(x)
             if return_flop:
                 if self.training:
@@ -92,23 +92,20 @@ def make_diffrate_class(transformer_class):
     
 
         def get_kept_num(self):
-            prune_kept_num = []
-            merge_kept_num = []
-            for block in self.blocks:
-                prune_kept_num.append(int(block.prune_ddp.kept_token_number))
-                merge_kept_num.append(int(block.merge_ddp.kept_token_number))
+            prune_kept_num = [int(n) for n in self.prune_ddp.kept_token_number]
+            merge_kept_num = [int(n) for n in self.merge_ddp.kept_token_number]
             return prune_kept_num, merge_kept_num
         
         def set_kept_num(self, prune_kept_numbers, merge_kept_numbers):
             assert len(prune_kept_numbers) == len(self.blocks) and len(merge_kept_numbers) == len(self.blocks)
-            for block, prune_kept_number, merge_kept_number in zip(self.blocks, prune_kept_numbers, merge_kept_numbers):
-                block.prune_ddp.kept_token_number = prune_kept_number
-                block.merge_ddp.kept_token_number = merge_kept_number
+            self.prune_ddp.kept_token_number = [int(n) for n in prune_kept_numbers]
+            self.merge_ddp.kept_token_number = [int(n) for n in merge_kept_numbers]
         
         def calculate_flop_training(self):
             C = self.embed_dim
             patch_number = float(self.patch_embed.num_patches)
-            N = torch.tensor(patch_number+1, device=self.blocks[0].prune_ddp.selected_probability.device)
+            # filled on device, copying a host scalar would synchronize
+            N = torch.full((), patch_number+1, device=self.prune_ddp.selected_probability.device)
             flops = 0
             patch_embedding_flops = N*C*(self.patch_embed.patch_size[0]*self.patch_embed.patch_size[1]*3)
             classifier_flops = C*self.num_classes
@@ -129,14 +126,12 @@ def make_diffrate_class(transformer_class):
         def calculate_flop_inference(self):
             C = self.embed_dim
             patch_number = float(self.patch_embed.num_patches)
-            N = torch.tensor(patch_number+1, device=self.blocks[0].prune_ddp.selected_probability.device)
+            N = torch.tensor(patch_number+1, device=self.prune_ddp.selected_probability.device)
             flops = 0
             patch_embedding_flops = N*C*(self.patch_embed.patch_size[0]*self.patch_embed.patch_size[1]*3)
             classifier_flops = C*self.num_classes
             with torch.cuda.amp.autocast(enabled=False):
-                for block in (self.blocks):
-                    prune_kept_number = block.prune_ddp.kept_token_number
-                    merge_kept_number = block.merge_ddp.kept_token_number
+                for prune_kept_number, merge_kept_number in zip(self.prune_ddp.kept_token_number, self.merge_ddp.kept_token_number):
                     mhsa_flops = 4*N*C*C + 2*N*N*C
                     flops += mhsa_flops
                     N = ste_min(N, prune_kept_number, merge_kept_number)
@@ -165,19 +160,27 @@ def apply_patch(
         "source": None,
         "class_token": model.cls_token is not None,
         "trace_source": trace_source,
+        "fused_attn": False,
     }
 
     block_index = 0
     # non_compressed_block_index = [0]
     non_compressed_block_index = [0, len(model.blocks)-1]
+    prune_granularities, merge_granularities = [], []
     for module in model.modules():
         if isinstance(module, Block):
             module.__class__ = DiffRateBlock
             if block_index in non_compressed_block_index:
-                module.introduce_diffrate(model.patch_embed.num_patches, model.patch_embed.num_patches+1, model.patch_embed.num_patches+1)
+                prune_granularities.append(model.patch_embed.num_patches+1)
+                merge_granularities.append(model.patch_embed.num_patches+1)
             else:
-                module.introduce_diffrate(model.patch_embed.num_patches, prune_granularity, merge_granularity)
+                prune_granularities.append(prune_granularity)
+                merge_granularities.append(merge_granularity)
+            module.introduce_diffrate(block_index)
             block_index += 1
             module._diffrate_info = model._diffrate_info
         elif isinstance(module, Attention):
-            module.__class__ = DiffRateAttention
\ No newline at end of file
+            module.__class__ = DiffRateAttention
+            module._diffrate_info = model._diffrate_info
+    model.prune_ddp = DiffRateBank(model.patch_embed.num_patches, prune_granularities)
+    model.merge_ddp = DiffRateBank(model.patch_embed.num_patches, merge_granularities)
\ No newline at end of file
@@ -0,0 +1,121 @@
+'''
+Cache of the frozen prefix of the search (patch embedding and the non-compressed block 0)
+
+Only the compression rates are trained during the search and block 0 is never compressed, so its output
+only depends on the sample. build_prefix_cache runs the prefix once over a deterministically transformed
+dataset and stores the output tokens of block 0 (fp16) with their class-attention ranking in memory-mapped
+.npy files, and PrefixCacheDataset serves them to model(tokens, from_prefix=True).
+'''
+
+import json
+import os
+from typing import Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Dataset
+
+
+def check_prefix(model: nn.Module):
+    for ddp in (model.prune_ddp, model.merge_ddp):
+        if int(ddp.candidate_mask[0].sum()) != 1:
+            raise ValueError("the prefix cache requires block 0 to be non-compressed")
+
+
+@torch.no_grad()
+def build_prefix_cache(
+    model: nn.Module,
+    dataset: Dataset,
+    path: str,
+    batch_size: int = 64,
+    num_workers: int = 10,
+    device: torch.device = "cuda",
+    key: dict = None,
+    verbose: bool = False,
+):
+    """
+    Run the frozen prefix of model over dataset in order and store it to path:
+     - tokens.npy: the output tokens of block 0 [len(dataset), N, C] in float16
+     - ranking.npy: the index of each output token in the input tokens [len(dataset), N], see forward_prefix
+     - targets.npy: the targets of the dataset, so that the samples do not need to be loaded again
+     - meta.json: the shapes and the key, written last, the cache is only valid if it exists
+
+    Args:
+     - model: the model patched by DiffRate.patch.clip
+     - dataset: the training set, its transform must be deterministic, the items are (..., samples, targets)
+     - path: the directory of the cache
+     - key: what the cache is built from (json values), e.g. the model, the hash of its weights and the training
+       subset, checked by check_prefix_cache before the cache is used
+    """
+    check_prefix(model)
+    os.makedirs(path, exist_ok=True)
+    was_training = model.training
+    model.eval().to(device)
+
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, drop_last=False)
+    length = len(dataset)
+    N, C = model.patch_embed.num_patches + 1, model.embed_dim
+    tokens = np.lib.format.open_memmap(os.path.join(path, "tokens.npy"), mode="w+", dtype=np.float16, shape=(length, N, C))
+    ranking = np.lib.format.open_memmap(os.path.join(path, "ranking.npy"), mode="w+", dtype=np.int16, shape=(length, N))
+    targets = None
+
+    start = 0
+    for i, items in enumerate(loader):
+        samples, target = items[-2], items[-1]
+        x, idx = model.forward_prefix(samples.to(device, non_blocking=True))
+        end = start + x.shape[0]
+        tokens[start:end] = x.half().cpu().numpy()
+        ranking[start:end] = idx.short().cpu().numpy()
+        target = torch.as_tensor(target).numpy()
+        if targets is None:
+            targets = np.lib.format.open_memmap(os.path.join(path, "targets.npy"), mode="w+", dtype=target.dtype, shape=(length, *target.shape[1:]))
+        targets[start:end] = target
+        start = end
+        if verbose and i % 100 == 0:
+            print(f"Prefix cache: {start}/{length}")
+
+    for array in (tokens, ranking, targets):
+        array.flush()
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"length": length, "token_number": N, "embed_dim": C, "key": key}, f)
+    model.train(was_training)
+
+
+def is_prefix_cache(path: str) -> bool:
+    return os.path.exists(os.path.join(path, "meta.json"))
+
+
+def check_prefix_cache(path: str, key: dict):
+    """
+    Raise if the prefix cache at path was built from something else than key, see build_prefix_cache.
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        built_key = json.load(f).get("key")
+    if built_key != key:
+        raise ValueError(f"the prefix cache {path} was built for {built_key}, not {key}, remove it or choose another --prefix-cache")
+
+
+class PrefixCacheDataset(Dataset):
+    """
+    The items of a prefix cache built by build_prefix_cache: (index, tokens, target), with the ranking
+    of the tokens appended if return_ranking. The memory maps are opened lazily in each worker.
+    """
+    def __init__(self, path: str, return_ranking: bool = False):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.return_ranking = return_ranking
+        self.arrays = None
+
+    def __len__(self) -> int:
+        return self.meta["length"]
+
+    def __getitem__(self, idx: int) -> Tuple[int, torch.Tensor, torch.Tensor]:
+        if self.arrays is None:
+            self.arrays = [np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r") for name in ("tokens", "ranking", "targets")]
+        tokens, ranking, targets = self.arrays
+        item = (idx, torch.from_numpy(np.array(tokens[idx], dtype=np.float32)), torch.from_numpy(np.array(targets[idx])))
+        if self.return_ranking:
+            item = item + (torch.from_numpy(ranking[idx].astype(np.int64)),)
+        return item
@@ -0,0 +1,308 @@
+'''
+Reuse of the mlp outputs of similar tokens at inference
+
+Each block holds an LSHReuseTable of the tokens it has seen: the input tokens of the mlp are hashed by random
+projections into buckets, and a token whose best match in its bucket is similar enough reuses the stored
+output instead of running the mlp. The tables are resident on the device of the model, and a whole batch
+is hashed, looked up and inserted with a few tensor operations.
+
+    tables = DiffRate.reuse.make_reuse_tables(model, threshold=0.98, policy="lru", max_bytes=16 << 20)
+    outputs = model(x, return_flop=False, lsh_tables=tables)
+    print(model.reuse_stats())
+    DiffRate.reuse.save_reuse_tables(tables, path, model)    # and DiffRate.reuse.load_reuse_tables(path, model) to start warm
+'''
+
+import json
+import os
+from typing import Callable, List, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from DiffRate.utils import backbone_hash
+
+
+EVICTION_POLICIES = ("lru", "lfu", "age")
+
+
+class LSHReuseTable:
+    """
+    A locality sensitive hash table of (token, output) pairs of one block, with a fixed memory budget: a token
+    inserted in a full bucket evicts one of its entries, chosen by the eviction policy:
+     - lru: the least recently used entry
+     - lfu: the least frequently used entry, the least recently used among equals
+     - age: the oldest entry, and the entries older than max_age lookups expire, e.g. for long video streams
+
+    Args:
+     - dim: the channel number of the tokens
+     - num_bits: the number of random projections, the table has 2 ** num_bits buckets
+     - bucket_size: the number of entries of each bucket, which each lookup compares
+     - threshold: the cosine similarity above which a stored output is reused
+     - policy: the eviction policy, one of EVICTION_POLICIES
+     - max_entries, max_bytes: the budget of the table, which sets num_bits to the most buckets of bucket_size
+       entries that fit, so that a larger budget adds buckets and the cost of a lookup does not grow
+     - max_age: the number of lookups an entry lives with the age policy, forever by default
+     - device: the device of the table, the one of the model
+     - seed: the seed of the random projections
+    """
+    def __init__(
+        self,
+        dim: int,
+        num_bits: int = 10,
+        bucket_size: int = 4,
+        threshold: float = 0.98,
+        policy: str = "lru",
+        max_entries: int = None,
+        max_bytes: int = None,
+        max_age: int = None,
+        device: torch.device = "cpu",
+        seed: int = 0,
+    ):
+        assert policy in EVICTION_POLICIES, f"unknown eviction policy {policy}"
+        if max_bytes is not None:
+            max_entries = min(max_entries or max_bytes, max_bytes // self.entry_bytes(dim))
+        if max_entries is not None:
+            assert max_entries > 0, "the budget does not fit one entry"
+            bucket_size = min(bucket_size, max_entries)
+            num_bits = (max_entries // bucket_size).bit_length() - 1
+        num_buckets = 2 ** num_bits
+        generator = torch.Generator().manual_seed(seed)
+        state = {
+            "projection": torch.randn(dim, num_bits, generator=generator),
+            # the keys are the normalized tokens, the outputs are stored in float16
+            "keys": torch.zeros(num_buckets, bucket_size, dim, dtype=torch.float16),
+            "values": torch.zeros(num_buckets, bucket_size, dim, dtype=torch.float16),
+            "valid": torch.zeros(num_buckets, bucket_size, dtype=torch.bool),
+            # the lookup step at which each entry was inserted and last used, and its number of uses
+            "inserted": torch.zeros(num_buckets, bucket_size, dtype=torch.long),
+            "last_used": torch.zeros(num_buckets, bucket_size, dtype=torch.long),
+            "use_count": torch.zeros(num_buckets, bucket_size, dtype=torch.long),
+        }
+        self.load_state({"dim": dim, "num_bits": num_bits, "bucket_size": bucket_size, "threshold": threshold,
+                         "policy": policy, "max_age": max_age, "step": 0}, state, device)
+
+    STATE_NAMES = ("projection", "keys", "values", "valid", "inserted", "last_used", "use_count")
+
+    def config(self) -> dict:
+        return {"dim": self.dim, "num_bits": self.num_bits, "bucket_size": self.bucket_size, "threshold": self.threshold,
+                "policy": self.policy, "max_age": self.max_age, "step": self.step}
+
+    def state(self) -> dict:
+        return {name: getattr(self, name) for name in self.STATE_NAMES}
+
+    def load_state(self, config: dict, state: dict, device: torch.device = "cpu"):
+        """
+        Set the table from its config and state, the state tensors are used as is on their device (without copy).
+        """
+        for name, value in config.items():
+            setattr(self, name, value)
+        for name in self.STATE_NAMES:
+            setattr(self, name, state[name].to(device))
+        self.bit_weights = (2 ** torch.arange(self.num_bits)).to(device)
+        # the counters stay on device, they are copied to the host by stats()
+        self.lookups = torch.zeros((), dtype=torch.long, device=device)
+        self.hits = torch.zeros((), dtype=torch.long, device=device)
+        self.evictions = torch.zeros((), dtype=torch.long, device=device)
+
+    @classmethod
+    def from_state(cls, config: dict, state: dict, device: torch.device = "cpu") -> "LSHReuseTable":
+        table = cls.__new__(cls)
+        table.load_state(config, state, device)
+        return table
+
+    @staticmethod
+    def entry_bytes(dim: int) -> int:
+        # float16 key and value, and the flag and three counters of the entry
+        return 2 * 2 * dim + 1 + 3 * 8
+
+    @property
+    def capacity(self) -> int:
+        return self.valid.numel()
+
+    @property
+    def memory_bytes(self) -> int:
+        return self.capacity * self.entry_bytes(self.dim)
+
+    def hash(self, tokens: torch.Tensor) -> torch.Tensor:
+        """
+        The bucket of each token [T, C] -> [T].
+        """
+        return ((tokens.float() @ self.projection) > 0).long() @ self.bit_weights
+
+    def expire(self):
+        if self.policy == "age" and self.max_age is not None:
+            self.valid &= self.inserted > self.step - self.max_age
+
+    def lookup(self, tokens: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Find the best match of each token [T, C] in its bucket.
+
+        Returns:
+         - hit: whether the match is above the threshold [T]
+         - outputs: the stored output of the match [T, C], only meaningful for hits
+         - buckets: the bucket of each token [T]
+        """
+        self.step += 1
+        self.expire()
+        buckets = self.hash(tokens)
+        keys = nn.functional.normalize(tokens.float(), dim=-1)
+        similarity = (self.keys[buckets].float() @ keys[:, :, None])[..., 0]    # [T, bucket_size]
+        similarity = similarity.masked_fill(~self.valid[buckets], -2.)
+        best_similarity, slot = similarity.max(dim=-1)
+        hit = best_similarity >= self.threshold
+        self.lookups += hit.numel()
+        self.hits += hit.sum()
+
+        self.last_used[buckets[hit], slot[hit]] = self.step
+        self.use_count.index_put_((buckets[hit], slot[hit]), torch.ones_like(slot[hit]), accumulate=True)
+        return hit, self.values[buckets, slot], buckets
+
+    def eviction_order(self, buckets: torch.Tensor) -> torch.Tensor:
+        """
+        The slots of each bucket [T] in eviction order [T, bucket_size], the empty slots first.
+        """
+        if self.policy == "lru":
+            score = self.last_used[buckets]
+        elif self.policy == "lfu":
+            # the use count first, the last use to break ties
+            score = self.use_count[buckets] * (self.step + 1) + self.last_used[buckets]
+        else:
+            score = self.inserted[buckets]
+        score = score.masked_fill(~self.valid[buckets], -1)
+        return score.argsort(dim=-1)
+
+    def insert(self, tokens: torch.Tensor, outputs: torch.Tensor, buckets: torch.Tensor = None):
+        """
+        Store the outputs [T, C] of tokens [T, C], in the free or evicted slots of their buckets.
+        """
+        if buckets is None:
+            buckets = self.hash(tokens)
+        # rank of each token among the tokens of the same bucket, so that they go to different slots
+        buckets, order = buckets.sort()
+        tokens, outputs = tokens[order], outputs[order]
+        first = torch.searchsorted(buckets, buckets, right=False)
+        rank = torch.arange(len(buckets), device=buckets.device) - first
+        # only the last bucket_size tokens of a bucket fit, the earlier ones would be overwritten in the same step
+        count = torch.bincount(buckets, minlength=self.valid.shape[0])
+        keep = rank >= count[buckets] - self.bucket_size
+        buckets, tokens, outputs = buckets[keep], tokens[keep], outputs[keep]
+        rank = rank[keep] - (count[buckets] - self.bucket_size).clamp(min=0)
+
+        slot = self.eviction_order(buckets).gather(1, rank[:, None])[:, 0]
+        self.evictions += self.valid[buckets, slot].sum()
+        self.keys[buckets, slot] = nn.functional.normalize(tokens.float(), dim=-1).half()
+        self.values[buckets, slot] = outputs.half()
+        self.valid[buckets, slot] = True
+        self.inserted[buckets, slot] = self.step
+        self.last_used[buckets, slot] = self.step
+        self.use_count[buckets, slot] = 0
+
+    def reuse(self, x: torch.Tensor, fn: Callable[[torch.Tensor], torch.Tensor], start: int = 1) -> torch.Tensor:
+        """
+        fn(x) for a token-wise fn, e.g. the mlp half of a block, where the tokens of x [B, N, C] after the first
+        start tokens (the class token) reuse the stored output of a similar token, and fn only runs on the others.
+        """
+        B, N, C = x.shape
+        tokens = x[:, start:].reshape(-1, C)
+        hit, outputs, buckets = self.lookup(tokens)
+        miss = (~hit).nonzero()[:, 0]
+        computed = fn(tokens[miss][None])[0]
+        self.insert(tokens[miss], computed, buckets[miss])
+
+        outputs = outputs.to(computed.dtype)
+        outputs[miss] = computed
+        return torch.cat((fn(x[:, :start]), outputs.view(B, N - start, C)), dim=1)
+
+    def stats(self) -> dict:
+        lookups, hits = int(self.lookups), int(self.hits)
+        return {
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": hits / max(lookups, 1),
+            "evictions": int(self.evictions),
+            "entries": int(self.valid.sum()),
+            "capacity": self.capacity,
+            "memory_bytes": self.memory_bytes,
+            # the mlp flops of the reused tokens, as in calculate_flop_inference
+            "saved_flops": hits * 8 * self.dim * self.dim,
+        }
+
+
+def model_name(model: nn.Module) -> str:
+    pretrained_cfg = getattr(model, "pretrained_cfg", None) or {}
+    name = pretrained_cfg.get("architecture", type(model).__name__)
+    return f"{name}.{pretrained_cfg['tag']}" if pretrained_cfg.get("tag") else name
+
+
+def snapshot_header(model: nn.Module) -> dict:
+    """
+    What the outputs stored in the reuse tables of model depend on: the model, its compression schedule and its weights.
+    """
+    prune_kept_num, merge_kept_num = model.get_kept_num()
+    return {
+        "model": model_name(model),
+        "prune_kept_num": prune_kept_num,
+        "merge_kept_num": merge_kept_num,
+        "weights_hash": backbone_hash(model),
+    }
+
+
+def save_reuse_tables(tables: List[LSHReuseTable], path: str, model: nn.Module):
+    """
+    Save the reuse tables of model to the directory path, so that another job on the same corpus starts warm:
+     - {name}.npy: the state of the tables stacked over the blocks, see LSHReuseTable.STATE_NAMES, the keys
+       and outputs in float16
+     - meta.json: the header (model name, schedule and weights hash, see snapshot_header) and the config of each
+       table, written last, the snapshot is only valid if it exists
+    """
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    for name in LSHReuseTable.STATE_NAMES:
+        np.save(os.path.join(path, f"{name}.npy"), torch.stack([table.state()[name].cpu() for table in tables]).numpy())
+    with open(meta_path, "w") as f:
+        json.dump({**snapshot_header(model), "tables": [table.config() for table in tables]}, f)
+
+
+def load_reuse_tables(path: str, model: nn.Module, strict: bool = True) -> List[LSHReuseTable]:
+    """
+    Load the reuse tables saved by save_reuse_tables for model. The arrays are memory-mapped copy-on-write and
+    the tables of a model on cpu use them without copying, so loading is instant whatever their size.
+
+    Args:
+     - strict: raise if the snapshot was saved for another model, schedule or weights, whose outputs differ
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if strict:
+        header = snapshot_header(model)
+        mismatch = [name for name in header if meta[name] != header[name]]
+        if mismatch:
+            raise ValueError(f"the reuse tables of {path} were saved with another {', '.join(mismatch)}")
+    device = next(model.parameters()).device
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="c") for name in LSHReuseTable.STATE_NAMES}
+    return [
+        LSHReuseTable.from_state(config, {name: torch.from_numpy(array[i]) for name, array in arrays.items()}, device)
+        for i, config in enumerate(meta["tables"])
+    ]
+
+
+def make_reuse_tables(model: nn.Module, **kwargs) -> List[LSHReuseTable]:
+    """
+    One LSHReuseTable per block of a patched model, on the device of the model, see LSHReuseTable for kwargs,
+    the budgets are per block.
+    """
+    device = next(model.parameters()).device
+    return [LSHReuseTable(model.embed_dim, device=device, seed=i, **kwargs) for i in range(len(model.blocks))]
+
+
+def reuse_stats(tables: List[LSHReuseTable]) -> dict:
+    """
+    The counters of each block, see LSHReuseTable.stats, and their total.
+    """
+    blocks = [table.stats() for table in tables]
+    total = {name: sum(block[name] for block in blocks) for name in ("lookups", "hits", "evictions", "entries", "capacity", "memory_bytes", "saved_flops")}
+    total["hit_rate"] = total["hits"] / max(total["lookups"], 1)
+    return {"blocks": blocks, "total": total}
@@ -0,0 +1,145 @@
+'''
+Export a searched DiffRate model to a plain module with a static compression schedule
+'''
+
+import copy
+import math
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from timm.models.vision_transformer import Attention
+
+
+class DiffRateStaticBlock(nn.Module):
+    """
+    The inference forward of DiffRateBlock, with the token numbers baked in as constants so that the
+    module has static shapes and no data dependent branching:
+     - token_number: the token number of the input
+     - prune_kept_num: the token number after pruning
+     - merge_kept_num: the token number after merging
+    """
+    def __init__(self, block: nn.Module, token_number: int, prune_kept_num: int, merge_kept_num: int, fused_attn: bool = False):
+        super().__init__()
+        self.norm1 = block.norm1
+        self.attn = block.attn
+        self.attn.__class__ = Attention
+        del self.attn._diffrate_info
+        self.drop_path1 = block.drop_path1
+        self.norm2 = block.norm2
+        self.mlp = block.mlp
+        self.drop_path2 = block.drop_path2
+
+        self.token_number = token_number
+        self.prune_kept_num = min(token_number, prune_kept_num)
+        self.merge_kept_num = min(self.prune_kept_num, merge_kept_num)
+        self.fused_attn = fused_attn
+
+    def attention(self, x: torch.Tensor, size: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        B, N, C = x.shape
+        H = self.attn.num_heads
+        q, k, v = self.attn.qkv(x).reshape(B, N, 3, H, C // H).permute(2, 0, 3, 1, 4).unbind(0)
+        bias = size.log()[:, None, None, :, 0]   # proportional attention
+
+        if self.fused_attn:
+            x = F.scaled_dot_product_attention(q, k, v, attn_mask=bias.to(q.dtype))
+            cls_attn = ((q[:, :, :1] @ k.transpose(-2, -1)) * self.attn.scale + bias).softmax(dim=-1)
+        else:
+            attn = ((q @ k.transpose(-2, -1)) * self.attn.scale + bias).softmax(dim=-1)
+            x = attn @ v
+            cls_attn = attn[:, :, :1]
+
+        x = self.attn.proj(x.transpose(1, 2).reshape(B, N, C))
+        return x, cls_attn[:, :, 0, 1:].mean(dim=1)
+
+    def merge(self, x: torch.Tensor, size: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # same as get_merge_func, with scatter_add instead of scatter_reduce, which is not supported by onnx
+        kept_number = self.merge_kept_num
+        metric = x.detach()
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        similarity = metric[:, kept_number:] @ metric[:, :kept_number].transpose(-1, -2)
+        similarity[..., :, 0] = -math.inf
+        node_max, node_idx = similarity.max(dim=-1)
+        index = node_idx[..., None]
+
+        count = torch.ones_like(x[:, :kept_number, :1]).scatter_add(1, index, torch.ones_like(x[:, kept_number:, :1]))
+        x = x[:, :kept_number].scatter_add(1, index.expand(-1, -1, x.shape[-1]), x[:, kept_number:]) / count
+        size = torch.cat((size[:, :kept_number], size[:, kept_number:] * node_max[..., None]), dim=1)
+        size = size[:, :kept_number].scatter_add(1, index, size[:, kept_number:])
+        return x, size
+
+    def forward(self, x: torch.Tensor, size: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        x_attn, cls_attn = self.attention(self.norm1(x), size)
+        x = x + self.drop_path1(x_attn)
+
+        # sorting, the class token is always the first
+        idx = torch.argsort(cls_attn, dim=1, descending=True) + 1
+        idx = torch.cat((torch.zeros_like(idx[:, :1]), idx), dim=1)[:, :self.prune_kept_num]
+
+        # pruning
+        x = torch.gather(x, dim=1, index=idx.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+        size = torch.gather(size, dim=1, index=idx.unsqueeze(-1))
+
+        # merging
+        if self.merge_kept_num < self.prune_kept_num:
+            x, size = self.merge(x, size)
+
+        x = x + self.drop_path2(self.mlp(self.norm2(x)))
+        return x, size
+
+
+class DiffRateStaticVisionTransformer(nn.Module):
+    """
+    A plain vision transformer running a fixed DiffRate schedule, see export().
+    """
+    def __init__(self, model: nn.Module, blocks: nn.ModuleList):
+        super().__init__()
+        self.model = model
+        self.blocks = blocks
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = self.model.patch_embed(x)
+        x = self.model._pos_embed(x)
+        x = self.model.norm_pre(x)
+        size = torch.ones_like(x[..., :1])
+        for block in self.blocks:
+            x, size = block(x, size)
+        x = self.model.norm(x)
+        return self.model.forward_head(x)
+
+
+def export(model: nn.Module) -> DiffRateStaticVisionTransformer:
+    """
+    Export a DeiT or CLIP model patched by DiffRate to a plain nn.Module running its current compression
+    schedule (see get_kept_num), for serving. The kept token number of each block is a constant, so the
+    module can be traced by torch.jit.trace, compiled with torch.compile(dynamic=False) or exported to onnx.
+    The patched model is left untouched and the exported module runs in eval mode.
+
+    Args:
+     - model: the model patched by DiffRate.patch.deit or DiffRate.patch.clip
+
+    Returns:
+     - the exported module, which takes images and returns the same outputs as model(images, return_flop=False)
+    """
+    if type(model).__module__ not in ("DiffRate.patch.deit", "DiffRate.patch.clip"):
+        raise NotImplementedError(f"export only supports the deit and clip patches, got {type(model).__module__}")
+    prune_kept_num, merge_kept_num = model.get_kept_num()
+    fused_attn = model._diffrate_info["fused_attn"]
+
+    # the diffrate plumbing is not copied, it may hold non-leaf tensors of the last forward
+    banks = [name for name in ("prune_ddp", "merge_ddp", "prune_ddps", "merge_ddps") if hasattr(model, name)]
+    memo = {id(model._diffrate_info): None, **{id(getattr(model, name)): None for name in banks}}
+    model = copy.deepcopy(model, memo).eval()
+    diffrate_blocks = model.blocks
+    model.__class__ = type(model).__bases__[0]
+    del model._diffrate_info, model.blocks
+    for name in banks:
+        delattr(model, name)
+
+    blocks = nn.ModuleList()
+    token_number = model.patch_embed.num_patches + 1
+    for block, prune_kept, merge_kept in zip(diffrate_blocks, prune_kept_num, merge_kept_num):
+        blocks.append(DiffRateStaticBlock(block, token_number, prune_kept, merge_kept, fused_attn=fused_attn))
+        token_number = blocks[-1].merge_kept_num
+    return DiffRateStaticVisionTransformer(model, blocks).eval()
@@ -0,0 +1,180 @@
+'''
+Temporal token reuse across consecutive frames of video streams at inference
+
+Each row of the batch is a stream. For every block, the state keeps the tokens of the previous frames of the
+streams: a token whose input barely changed since it was last computed copies its cached output, and only the
+changed tokens (and the class token) run through the block, see DiffRateBlock.forward_temporal. As the blocks sort,
+prune and merge the tokens of each frame on their own, a token is compared with the token of the previous frame
+made of the same patches, given by their traced source, not with the token at its position. Before the blocks,
+only the patches whose pixels changed are embedded again, see forward_temporal_embed in DiffRate.patch.clip.
+
+    state = DiffRate.temporal.TemporalReuseState(threshold=0.05)
+    for frame_idxs, frames in stream:      # one frame of each stream [B, 3, H, W]
+        outputs = model(frames, return_flop=False, temporal_state=state, frame_idxs=frame_idxs)
+    print(state.stats())    # computed tokens of each block and flops per frame
+'''
+
+from typing import Callable, List, Tuple
+
+import torch
+
+
+class TemporalBlockCache:
+    """
+    The cached tokens of one block: for each stage (e.g. the attention and the mlp halves), the input of each
+    token when it was last computed, which it is compared with, and the outputs of the stage.
+    """
+    def __init__(self, state: "TemporalReuseState"):
+        self.state = state
+        self.references = {}
+        self.sources = {}
+        self.outputs = {}
+        self.computed = {}
+        self.total = {}
+
+    def changed(self, stage: str, x: torch.Tensor, pixels: bool = False, source: torch.Tensor = None,
+                outputs: Tuple[str, ...] = ()) -> torch.Tensor:
+        """
+        The tokens of x [B, N, C] whose relative change since they were last computed is above the threshold of
+        the state [B, N]. The class token, the streams which were reset and the tokens never computed are changed.
+        With pixels, x are the patches of the input [B, N, 3 * p * p] instead, which change if their mean absolute
+        difference is above the pixel threshold of the state.
+
+        With the source of the tokens [B, N0] (see DiffRate.merge.get_source), the cached reference and the cached
+        outputs of the stages in outputs are first reordered to the tokens of x, see match_source: a token is
+        compared with the token of the previous frame made of the same patches, and is changed if there is none.
+        """
+        reference = self.references.get(stage)
+        previous_source, self.sources[stage] = self.sources.get(stage), source
+        if reference is None or reference.shape != x.shape:
+            changed = torch.ones(x.shape[:2], dtype=torch.bool, device=x.device)
+            self.references[stage] = x
+        else:
+            if source is not None:
+                match = match_source(source, previous_source, x.shape[1], reference.shape[1])
+                reference = reference.gather(1, match.clamp(min=0)[..., None].expand(-1, -1, reference.shape[-1]))
+                for output_stage in outputs:
+                    output = self.outputs.get(output_stage)
+                    if output is not None and output.shape[:2] == x.shape[:2]:
+                        self.outputs[output_stage] = output.gather(1, match.clamp(min=0)[..., None].expand(-1, -1, output.shape[-1]))
+            if pixels:
+                changed = (x - reference).abs().mean(dim=-1) > self.state.pixel_threshold
+            else:
+                delta = (x - reference).norm(dim=-1) / reference.norm(dim=-1).clamp(min=1e-6)
+                changed = delta > self.state.threshold
+                changed[:, 0] = True
+            if source is not None:
+                changed |= match < 0
+            changed |= self.state.reset[:, None]
+            # the reference of a token only moves when it is computed, so that slow drifts are caught
+            self.references[stage] = torch.where(changed[..., None], x, reference)
+        self.computed[stage] = self.computed.get(stage, 0) + changed.sum()
+        self.total[stage] = self.total.get(stage, 0) + changed.numel()
+        return changed
+
+    def tokenwise(self, stage: str, x: torch.Tensor, changed: torch.Tensor, fn: Callable[[torch.Tensor], torch.Tensor]) -> torch.Tensor:
+        """
+        fn(x) for a token-wise fn, only run on the changed tokens of x [B, N, C], the others copy their cached output.
+        """
+        rows, cols = changed.nonzero(as_tuple=True)
+        computed = fn(x[rows, cols][None])[0]
+        output = self.outputs.get(stage)
+        if output is None or output.shape[:2] != x.shape[:2]:
+            output = computed.new_zeros((*x.shape[:2], computed.shape[-1]))
+        else:
+            output = output.clone()
+        output[rows, cols] = computed.to(output.dtype)
+        self.outputs[stage] = output
+        return output
+
+    def scatter(self, stage: str, index: torch.Tensor, computed: torch.Tensor, shape: torch.Size) -> torch.Tensor:
+        """
+        The cached output of stage [B, N, C] with the tokens at index [B, M] replaced by computed [B, M, C].
+        """
+        output = self.outputs.get(stage)
+        if output is None or output.shape != shape:
+            output = computed.new_zeros(shape)
+        else:
+            output = output.to(computed.dtype, copy=True)
+        output.scatter_(1, index[..., None].expand(-1, -1, shape[-1]), computed)
+        self.outputs[stage] = output
+        return output
+
+
+def match_source(source: torch.Tensor, previous_source: torch.Tensor, N: int, M: int) -> torch.Tensor:
+    """
+    The index of the token of the previous frame [B, N] made of the same original tokens as each of the N current
+    tokens, -1 if there is none, given the sources [B, N0] of the current and of the M previous tokens.
+    """
+    B = source.shape[0]
+    source, previous_source = source.long(), previous_source.long()
+    # the pruned original tokens go to an extra token
+    current = torch.where(source >= 0, source, N)
+    previous = torch.where(previous_source >= 0, previous_source, M)
+    # a current token matches if all its original tokens belong to the same previous token, which has no other
+    first = torch.full((B, N + 1), M, dtype=torch.long, device=source.device).scatter_reduce(1, current, previous, "amin")
+    last = torch.full((B, N + 1), -1, dtype=torch.long, device=source.device).scatter_reduce(1, current, previous, "amax")
+    size = torch.zeros((B, N + 1), dtype=torch.long, device=source.device).scatter_add_(1, current, torch.ones_like(current))
+    previous_size = torch.zeros((B, M + 1), dtype=torch.long, device=source.device).scatter_add_(1, previous, torch.ones_like(previous))
+    first, last, size = first[:, :N], last[:, :N], size[:, :N]
+    matched = (first == last) & (first < M) & (size == previous_size.gather(1, first.clamp(max=M)))
+    return torch.where(matched, first, -1)
+
+
+class TemporalReuseState:
+    """
+    The state of a batch of video streams, passed to the forward of a patched CLIP model with the index of the
+    frame of each stream. A stream whose frame does not follow its previous frame (a new video) is reset.
+
+    Args:
+     - threshold: the relative change of a token input, ||x - x_ref|| / ||x_ref||, above which it is recomputed
+     - pixel_threshold: the mean absolute change of a (normalized) input patch above which it is embedded again,
+       see forward_temporal_embed in DiffRate.patch.clip, the unchanged patches keep their embedding
+    """
+    def __init__(self, threshold: float = 0.05, pixel_threshold: float = 0.02):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.frame_idxs = None
+        self.reset = None
+        self.blocks = {}
+        self.frames = 0
+        self.flops = 0
+
+    def step(self, frame_idxs: torch.Tensor = None, batch_size: int = None, device: torch.device = "cpu"):
+        """
+        Start a new frame of the streams, consecutive to the previous one when frame_idxs is not given.
+        """
+        if frame_idxs is None:
+            frame_idxs = self.frame_idxs + 1 if self.frame_idxs is not None else torch.zeros(batch_size, dtype=torch.long)
+        frame_idxs = torch.as_tensor(frame_idxs, device=device).long()
+        if self.frame_idxs is None or self.frame_idxs.shape != frame_idxs.shape:
+            self.reset = torch.ones_like(frame_idxs, dtype=torch.bool)
+        else:
+            self.reset = frame_idxs != self.frame_idxs + 1
+        self.frame_idxs = frame_idxs
+        self.frames += len(frame_idxs)
+
+    def add_flops(self, flops):
+        # tensors of the computed token numbers stay on device until stats()
+        self.flops = self.flops + flops
+
+    def block(self, index: int) -> TemporalBlockCache:
+        '''
+        The cache of block index, -1 for the patch embedding.
+        '''
+        if index not in self.blocks:
+            self.blocks[index] = TemporalBlockCache(self)
+        return self.blocks[index]
+
+    def stats(self) -> dict:
+        """
+        The fraction of the tokens computed by each stage of the patch embedding and of each block, and the flops
+        per frame, counted as calculate_flop_inference, since the state was created.
+        """
+        return {
+            "blocks": [
+                {stage: int(cache.computed[stage]) / max(cache.total[stage], 1) for stage in cache.computed}
+                for _, cache in sorted(self.blocks.items())
+            ],
+            "flops": float(self.flops) / max(self.frames, 1),
+        }
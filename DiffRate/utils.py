@@ -2,16 +2,23 @@
 This file is modified based on https://github.com/facebookresearch/ToMe/blob/main/tome/utils.py
 '''
 
+import hashlib
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Union
 
 import math
+import warnings
 import torch
 from tqdm import tqdm
 
 class STE_Min(torch.autograd.Function):
     @staticmethod
     def forward(ctx, x_in1, x_in2, x_in3=math.inf):
+        if all(isinstance(x_in, torch.Tensor) for x_in in (x_in1, x_in2, x_in3)):
+            # keep the comparison on device, the builtin min would synchronize with the host
+            return torch.minimum(torch.minimum(x_in1, x_in2), x_in3)
         x = min(x_in1, x_in2, x_in3)
         return x
     
@@ -34,6 +41,94 @@ ste_ceil = STE_Ceil.apply
 ste_min = STE_Min.apply
 
 
+class SyncCounter:
+    """
+    Count the host-device synchronizations issued inside a `with` block, e.g. one search step.
+
+    It relies on the CUDA sync debug mode, which warns on every synchronizing operation,
+    so the count is always 0 when CUDA is not available.
+
+    Args:
+     - enabled: whether to count, the debug mode adds some overhead to every CUDA call
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled and torch.cuda.is_available()
+        self.count = 0
+
+    def __enter__(self):
+        self.count = 0
+        if self.enabled:
+            self._catch_warnings = warnings.catch_warnings(record=True)
+            self._records = self._catch_warnings.__enter__()
+            warnings.simplefilter("always")
+            self._sync_debug_mode = torch.cuda.get_sync_debug_mode()
+            torch.cuda.set_sync_debug_mode("warn")
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            torch.cuda.set_sync_debug_mode(self._sync_debug_mode)
+            self._catch_warnings.__exit__(*exc)
+            self.count = sum("synchronizing CUDA operation" in str(record.message) for record in self._records)
+        return False
+
+
+def thread_map(fn, items, num_threads=4):
+    """
+    Yield fn(item) for each item in order, computed in a pool of num_threads threads. OpenCV releases the GIL
+    while decoding, so videos are decoded concurrently, and at most 2 * num_threads results are computed ahead.
+    """
+    with ThreadPoolExecutor(num_threads) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= 2 * num_threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def normalize_input(module: torch.nn.Module, x: torch.Tensor) -> torch.Tensor:
+    """
+    The input x of a module set up by add_input_normalization: uint8 images are rescaled and normalized with
+    its mean and std, in float32 as the CLIPProcessor, and float inputs are returned as is.
+    """
+    if x.dtype != torch.uint8:
+        return x
+    return (x.float() * (1 / 255) - module.input_mean) / module.input_std
+
+
+def _normalize_input_hook(module: torch.nn.Module, args: tuple):
+    if args[0].dtype != torch.uint8:
+        return None
+    return (normalize_input(module, args[0]),) + tuple(args[1:])
+
+
+def add_input_normalization(module: torch.nn.Module, mean: Tuple[float], std: Tuple[float]):
+    """
+    Normalize uint8 images [B, 3, H, W] with mean and std (of images in [0, 1]) before module, usually the
+    patch embedding, so that the data pipeline can carry uint8 frames. Float inputs are left untouched.
+    """
+    module.register_buffer("input_mean", torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1), persistent=False)
+    module.register_buffer("input_std", torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1), persistent=False)
+    module.register_forward_pre_hook(_normalize_input_hook)
+
+
+def backbone_hash(model: torch.nn.Module) -> str:
+    """
+    The sha256 of the frozen weights of the model (everything but the arch state), which identifies the
+    backbone an arch-only checkpoint was searched on.
+    """
+    sha = hashlib.sha256()
+    for k, v in sorted(model.state_dict().items()):
+        if k.find('ddp') > -1:
+            continue
+        sha.update(k.encode())
+        sha.update(v.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()
+
+
 def benchmark(
     model: torch.nn.Module,
     device: torch.device = 0,
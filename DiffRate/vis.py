@@ -33,26 +33,26 @@ def make_visualization(
     Create a visualization like in the paper.
 
     Args:
-     -
+     - img: the input image
+     - source: [B, N] index of the token each original patch belongs to, -1 if it is pruned
+     - patch_size: the patch size of the model
+     - class_token: whether the first original token is the class token
 
     Returns:
      - A PIL image the same size as the input.
     """
 
     img = np.array(img.convert("RGB")) / 255.0
-    source = source.detach().cpu()      # [B, N', N]
+    source = source.detach().cpu()      # [B, N]
 
     h, w, _ = img.shape
     ph = h // patch_size
     pw = w // patch_size
 
     if class_token:
-        source = source[:, :, 1:]
+        source = source[:, 1:]
 
-    vis = source.argmax(dim=1)      # [B,N] 
-    vis = vis + 1
-    prune_mask = source.sum(dim=1)
-    vis = vis * prune_mask
+    vis = source.long() + 1      # [B,N], the pruned tokens are 0
     num_groups = int(vis.max().item() + 1)       
 
     cmap = generate_colormap(num_groups)    
@@ -0,0 +1,54 @@
+'''
+Frames per second of the frame sampling of the video datasets, from the original full resolution grab loop
+to seeking, decode-time resize and crop, and concurrent decoding of several videos
+
+    python benchmark_sampling.py --videos $path_to_videos$/*.mp4 --num-videos 32 --threads 8
+'''
+
+import argparse
+import time
+
+from DiffRate.utils import thread_map
+from dataset import sample_frames
+
+
+def benchmark(name, video_paths, num_threads=0, **kwargs):
+    start = time.perf_counter()
+    if num_threads > 0:
+        counts = list(thread_map(lambda video_path: len(sample_frames(video_path, **kwargs)), video_paths, num_threads))
+    else:
+        counts = [len(sample_frames(video_path, **kwargs)) for video_path in video_paths]
+    elapsed = time.perf_counter() - start
+    print(f"{name:<32} {sum(counts):>8} frames {elapsed:>8.2f}s {sum(counts) / elapsed:>10.1f} frames/s")
+    return counts
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Frame sampling benchmark', add_help=False)
+    parser.add_argument('--videos', nargs='+', required=True, help='video files to sample')
+    parser.add_argument('--num-videos', default=32, type=int, help='number of videos to sample')
+    parser.add_argument('--frame-rate', default=1, type=int, help='number of frames sampled per second')
+    parser.add_argument('--size', default=224, type=int, help='shortest edge of the resized frames')
+    parser.add_argument('--crop-size', default=224, type=int, help='size of the center crop')
+    parser.add_argument('--threads', default=8, type=int, help='number of decoding threads')
+    return parser
+
+
+def main(args):
+    video_paths = args.videos[:args.num_videos]
+    frame_size = dict(size=args.size, crop_size=(args.crop_size, args.crop_size))
+    baseline = benchmark('grab, full resolution', video_paths, frame_rate=args.frame_rate, seek=False)
+    benchmarks = [
+        ('seek, full resolution', dict(seek=True)),
+        ('seek, resize and crop', dict(seek=True, **frame_size)),
+        (f'seek, resize and crop, {args.threads} threads', dict(seek=True, num_threads=args.threads, **frame_size)),
+    ]
+    for name, kwargs in benchmarks:
+        counts = benchmark(name, video_paths, frame_rate=args.frame_rate, **kwargs)
+        if counts != baseline:
+            print(f"  the sampled frame counts differ from the grab loop on {sum(a != b for a, b in zip(counts, baseline))} videos")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Frame sampling benchmark', parents=[get_args_parser()])
+    main(parser.parse_args())
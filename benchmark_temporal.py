@@ -0,0 +1,120 @@
+'''
+FLOPs and wall-clock per frame of a compressed CLIP model over video clips, run frame by frame as streams,
+against the same model with temporal reuse, see DiffRate.temporal: the patches whose pixels did not change
+since the previous frame skip the patch embedding, and the tokens which did not change skip the blocks
+
+    python benchmark_temporal.py --videos $path_to_videos$/*.mp4 --num-videos 16 --compression-rate $output_dir$/compression_rate.json --target_flops 8.7
+'''
+
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+from timm.models import create_model
+
+import DiffRate
+from dataset import sample_frames
+from main import model_name_dict
+
+
+class QuickGELU(torch.nn.Module):
+    def forward(self, x: torch.Tensor):
+        return x * torch.sigmoid(1.702 * x)
+
+
+@torch.no_grad()
+def run(model, clips, batch_size, device, temporal_state=None):
+    """
+    Run the clips frame by frame, batch_size clips at a time as streams, and return the features of every
+    frame and the elapsed seconds.
+    """
+    outputs, elapsed = [], 0.
+    for i in range(0, len(clips), batch_size):
+        streams = clips[i:i + batch_size]
+        for t in range(max(len(clip) for clip in streams)):
+            # the streams which ended repeat their last frame, which is reused, and their outputs are dropped
+            frames = torch.stack([clip[min(t, len(clip) - 1)] for clip in streams]).to(device)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            if temporal_state is None:
+                x = model(frames, return_flop=False)
+            else:
+                frame_idxs = torch.tensor([(i + j) * 100000 + t for j in range(len(streams))])
+                x = model(frames, return_flop=False, temporal_state=temporal_state, frame_idxs=frame_idxs)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            elapsed += time.perf_counter() - start
+            outputs += [x[j] for j, clip in enumerate(streams) if t < len(clip)]
+    return torch.stack(outputs), elapsed
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Temporal reuse benchmark', add_help=False)
+    parser.add_argument('--videos', nargs='+', required=True, help='video files to run')
+    parser.add_argument('--num-videos', default=16, type=int, help='number of videos to run')
+    parser.add_argument('--frame-rate', default=1, type=int, help='number of frames sampled per second')
+    parser.add_argument('--model', default='vit_base_patch16_clip_224.openai', type=str, help='name of the model')
+    parser.add_argument('--granularity', default=4, type=int, help='the token number gap between each compression rate candidate')
+    parser.add_argument('--compression-rate', default='compression_rate.json', type=str, help='the compression rates, e.g. the compression_rate.json of the output_dir of a search')
+    parser.add_argument('--target_flops', default=None, type=str, help='the compression rate of --compression-rate to run, uncompressed by default')
+    parser.add_argument('--batch-size', default=1, type=int, help='number of streams run together')
+    parser.add_argument('--threshold', default=0.05, type=float, help='relative change of a token above which it is recomputed')
+    parser.add_argument('--pixel-threshold', default=0.02, type=float, help='mean absolute change of a normalized patch above which it is embedded again')
+    parser.add_argument('--device', default='cuda', help='device of the model')
+    return parser
+
+
+def main(args):
+    device = torch.device(args.device)
+    model = create_model(args.model, pretrained=True, act_layer=QuickGELU)
+    DiffRate.patch.clip(model, prune_granularity=args.granularity, merge_granularity=args.granularity)
+    if args.target_flops is not None:
+        with open(args.compression_rate, 'r') as f:
+            compression_rates = json.load(f)
+        model_name = model_name_dict.get(args.model, args.model)
+        if args.target_flops not in compression_rates.get(model_name, {}):
+            raise ValueError(f"{args.compression_rate} does not contain {model_name} with {args.target_flops}G flops, "
+                             f"it has {', '.join(f'{name}: {list(rates)}' for name, rates in compression_rates.items())}")
+        compression_rate = compression_rates[model_name][args.target_flops]
+        model.set_kept_num(eval(compression_rate['prune_kept_num']), eval(compression_rate['merge_kept_num']))
+    model = model.eval().to(device)
+
+    crop_size = model.patch_embed.img_size
+    clips = [
+        torch.from_numpy(np.stack(frames)).permute(0, 3, 1, 2)
+        for frames in (
+            sample_frames(video_path, args.frame_rate, size=crop_size[0], crop_size=crop_size)
+            for video_path in args.videos[:args.num_videos]
+        )
+        if len(frames) > 0
+    ]
+    num_frames = sum(len(clip) for clip in clips)
+    print(f"{len(clips)} videos, {num_frames} frames")
+
+    # warm up
+    run(model, clips[:1], 1, device)
+    baseline, elapsed = run(model, clips, args.batch_size, device)
+    flops = float(model.calculate_flop_inference())
+    print(f"{'compressed':<24} {flops / 1e9:>8.2f} GFLOPs/frame {elapsed / num_frames * 1e3:>8.2f} ms/frame")
+
+    state = DiffRate.temporal.TemporalReuseState(threshold=args.threshold, pixel_threshold=args.pixel_threshold)
+    outputs, temporal_elapsed = run(model, clips, args.batch_size, device, temporal_state=state)
+    stats = state.stats()
+    similarity = torch.nn.functional.cosine_similarity(outputs.float(), baseline.float(), dim=-1)
+    print(f"{'compressed, temporal':<24} {stats['flops'] / 1e9:>8.2f} GFLOPs/frame {temporal_elapsed / num_frames * 1e3:>8.2f} ms/frame")
+    print(f"  {flops / stats['flops']:.2f}x fewer flops, {elapsed / temporal_elapsed:.2f}x faster, "
+          f"cosine similarity to the compressed model {similarity.mean():.4f} (min {similarity.min():.4f})")
+    print(f"  embedded patches {stats['blocks'][0]['pixels']:.1%}, recomputed tokens per block "
+          + " ".join(f"{block['attn']:.0%}/{block['mlp']:.0%}" for block in stats['blocks'][1:]))
+    # the tokens are matched with the previous frame by the patches they are made of, see DiffRate.temporal
+    blocks = stats['blocks'][1:]
+    print(f"  reused tokens: attention {1 - np.mean([block['attn'] for block in blocks]):.1%}, "
+          f"mlp {1 - np.mean([block['mlp'] for block in blocks]):.1%}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Temporal reuse benchmark', parents=[get_args_parser()])
+    main(parser.parse_args())
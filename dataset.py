@@ -2,6 +2,10 @@
 # All rights reserved.
 import os
 import json
+import itertools
+import random
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 
 import torch
 from torchvision import datasets, transforms
@@ -10,18 +14,21 @@ from torchvision.datasets.folder import ImageFolder, default_loader
 from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.data import create_transform
 
-from transformers import CLIPProcessor, CLIPModel
+from transformers import CLIPConfig, CLIPProcessor, CLIPModel
 from datasets import load_dataset
 from pathlib import Path
 import cv2
-from joblib import dump, load
 import numpy as np
+from PIL import Image
 
 import sys
 if '/workspace' not in sys.path:
     sys.path.append('/workspace')
 from vgenie.dataset import How2qaDataset, VideoinstructDataset, KineticsDataset, Hmdb51Dataset, MsrvttDataset
 
+from DiffRate.dedup import perceptual_hash, dedup_groups
+from DiffRate.utils import thread_map
+
 
 class INatDataset(ImageFolder):
     def __init__(self, root, train=True, year=2018, transform=None, target_transform=None,
@@ -106,34 +113,233 @@ def count_sampled_frames(video_path, sample_fps=1):
 
     return sampled_frames
 
-def sample_frames(video_path, frame_rate=1):
+# gaps of fewer frames are cheaper to grab through than to seek over
+SEEK_MIN_GAP = 16
+
+# version of the decoded crops, the feature stores of another version are extracted again, see FeatureStore
+PREPROCESSING_VERSION = 1
+
+def resize_center_crop(frame, size, crop_size):
+    """
+    Resize the shortest edge of an RGB HWC uint8 frame to size and center crop it to crop_size (height, width),
+    as the (PIL) CLIP image processor does: bicubic resize, the long edge truncated to int(size * long / short).
+    """
+    h, w = frame.shape[:2]
+    crop_h, crop_w = crop_size
+    short, long = min(h, w), max(h, w)
+    new_short, new_long = size, int(size * long / short)
+    new_h, new_w = (new_short, new_long) if h <= w else (new_long, new_short)
+    frame = np.asarray(Image.fromarray(frame).resize((new_w, new_h), resample=Image.BICUBIC))
+    top, left = (new_h - crop_h) // 2, (new_w - crop_w) // 2
+    return frame[top:top + crop_h, left:left + crop_w]
+
+def iter_sampled_frames(video_path, frame_rate=1, size=None, crop_size=None, seek=True):
+    """
+    Decode a video sequentially and yield its RGB frames sampled at frame_rate.
+
+    Args:
+        video_path (str): Path to the video file.
+        frame_rate (int): The number of frames to sample per second.
+        size (int), crop_size (tuple): If given, each frame is resized and center cropped right after decoding,
+            see resize_center_crop, so that the color conversion and the caller only see small frames.
+        seek (bool): Seek to the sampled frames which are far enough (the backend seeks by timestamp),
+            and grab through the others, or through all of them if the container does not support seeking.
+    """
     cap = cv2.VideoCapture(str(video_path))
     assert cap.isOpened()
-    # Calculate the frame interval based on the desired frame rate
-    frame_interval = int(cap.get(cv2.CAP_PROP_FPS) / frame_rate)
-    frame_num = 0
-    frames = []
-    # Iterate through the frames until we reach the desired frame rate
-    while True:
-        if frame_num % frame_interval != 0:
-            ret = cap.grab()
-            # Check if the frame was successfully read
-            if not ret:
-                break
-            frame_num += 1
-        else:
-            # Read the frame
+    frame_interval = max(int(cap.get(cv2.CAP_PROP_FPS) / frame_rate), 1)
+    # pos is the index of the next decoded frame, frame_num the index of the next sampled frame
+    pos, frame_num = 0, 0
+    try:
+        while True:
+            if seek and frame_num - pos >= SEEK_MIN_GAP:
+                seek = cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+                if seek:
+                    pos = frame_num
+            while pos < frame_num:
+                if not cap.grab():
+                    return
+                pos += 1
             ret, frame = cap.read()
-            # Check if the frame was successfully read
             if not ret:
-                break
-            frame_num += 1
-
+                return
+            pos += 1
+            frame_num += frame_interval
             frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frames.append(frame)
-    # Release the video capture object
-    cap.release()
-    return frames
+            if size is not None:
+                frame = resize_center_crop(frame, size, crop_size)
+            yield frame
+    finally:
+        cap.release()
+
+def sample_frames(video_path, frame_rate=1, size=None, crop_size=None, seek=True):
+    """
+    The list of the sampled frames of a video, see iter_sampled_frames.
+    """
+    return list(iter_sampled_frames(video_path, frame_rate, size, crop_size, seek))
+
+def _video_key(video_path):
+    stat = os.stat(video_path)
+    return str(video_path), stat.st_size, stat.st_mtime_ns
+
+
+def update_video_index(video_paths, index_path, num_workers=None):
+    """
+    Get the number of sampled frames of each video from the index at index_path, an .npz of arrays keyed
+    by the path, size and mtime of each video. Only the new or modified videos are counted, in a process
+    pool, and the index is updated with them.
+
+    Args:
+        video_paths (list): Paths to the video files.
+        index_path (str): Path to the index, created if it does not exist.
+        num_workers (int): The number of processes counting the frames, all cpus by default.
+
+    Returns:
+        np.ndarray: Number of sampled frames of each video.
+    """
+    index_path = Path(index_path)
+    paths, sizes, mtimes, counts = [], np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64)
+    if index_path.exists():
+        with np.load(index_path) as index:
+            paths, sizes, mtimes, counts = list(index['paths']), index['sizes'], index['mtimes'], index['counts']
+    position = {path: i for i, path in enumerate(paths)}
+
+    keys = [_video_key(video_path) for video_path in video_paths]
+    num_frames = np.zeros(len(keys), np.int64)
+    missing = []
+    for i, (path, size, mtime) in enumerate(keys):
+        j = position.get(path)
+        if j is not None and sizes[j] == size and mtimes[j] == mtime:
+            num_frames[i] = counts[j]
+        else:
+            missing.append(i)
+
+    if len(missing) > 0:
+        print(f"Counting the frames of {len(missing)} videos")
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            missing_counts = executor.map(count_sampled_frames, [keys[i][0] for i in missing], chunksize=16)
+            num_frames[missing] = list(missing_counts)
+
+        # the videos which are not asked for are kept in the index
+        index = {path: (size, mtime, count) for path, size, mtime, count in zip(paths, sizes, mtimes, counts)}
+        index.update({keys[i][0]: (keys[i][1], keys[i][2], num_frames[i]) for i in missing})
+        paths = list(index.keys())
+        sizes, mtimes, counts = (np.array(column, dtype=np.int64) for column in zip(*index.values()))
+        tmp_path = index_path.with_suffix('.tmp.npz')
+        np.savez(tmp_path, paths=np.array(paths), sizes=sizes, mtimes=mtimes, counts=counts)
+        os.replace(tmp_path, index_path)
+        print("Saved the video index to", index_path)
+
+    return num_frames
+
+
+class VideoFrameCache:
+    """
+    LRU cache of the preprocessed frames and teacher outputs of whole videos, keyed by video and bounded
+    by the total bytes of its tensors. Each data loader worker has its own copy of the dataset, so the
+    cache is per worker. hits and misses count the lookups.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def nbytes(value):
+        return sum(t.numel() * t.element_size() for t in value)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        size = self.nbytes(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= self.nbytes(self.entries.pop(key))
+        while self.bytes + size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= self.nbytes(evicted)
+        self.entries[key] = value
+        self.bytes += size
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'videos': len(self.entries), 'bytes': self.bytes}
+
+
+class FeatureStore:
+    """
+    The uint8 frames and teacher outputs of a split, one row per sample in two contiguous .npy files
+    (pixels.npy and embeddings.npy), with offsets.npy, the first row of each video, and written.npy, the flag of
+    the videos which are stored. The files are memory-mapped lazily in each data loader worker, so the workers
+    share their pages through the os cache, and the rows are returned as zero-copy tensors, in the
+    (idx, pixel_values, output) items of the training datasets.
+
+    Only the creating process (create=True, rank 0) creates or truncates the files, the others expect an up to
+    date store and only open it, so that the ranks of a distributed run do not race on the shared files.
+    meta.json holds the preprocessing version of the frames, see PREPROCESSING_VERSION.
+    """
+    def __init__(self, path, offsets, length, pixel_shape, embedding_dim, writable=False, create=True, version=PREPROCESSING_VERSION):
+        self.path = Path(path)
+        self.writable = writable
+        self.arrays = None
+        offsets_path = self.path / 'offsets.npy'
+        meta_path = self.path / 'meta.json'
+        # the store is rebuilt when the videos of the split, the layout or the preprocessing change, offsets.npy is written last
+        if not offsets_path.exists() or not np.array_equal(np.load(offsets_path), offsets) \
+                or np.load(self.path / 'pixels.npy', mmap_mode='r').dtype != np.uint8 \
+                or not meta_path.exists() or json.loads(meta_path.read_text()).get('version') != version:
+            if not create:
+                raise RuntimeError(f"the feature store {self.path} is not up to date, it is created by rank 0")
+            print("Creating the feature store", self.path)
+            legacy = next(self.path.parent.glob('*_o_*.npz'), None) or next(self.path.parent.glob('*_o_*.pkl'), None)
+            if legacy is not None:
+                print(f"Warning: the per-frame feature files in {self.path.parent} (e.g. {legacy.name}) are not read "
+                      "anymore, the features are extracted again into the store and the files can be removed")
+            self.path.mkdir(parents=True, exist_ok=True)
+            if offsets_path.exists():
+                offsets_path.unlink()
+            np.lib.format.open_memmap(self.path / 'pixels.npy', mode='w+', dtype=np.uint8, shape=(length, *pixel_shape))
+            np.lib.format.open_memmap(self.path / 'embeddings.npy', mode='w+', dtype=np.float32, shape=(length, embedding_dim))
+            np.save(self.path / 'written.npy', np.zeros(len(offsets), dtype=bool))
+            meta_path.write_text(json.dumps({'version': version}))
+            np.save(offsets_path, offsets)
+
+    def open(self):
+        if self.arrays is None:
+            # copy-on-write if read only, so that the rows are still writable tensors without copying them
+            mode = 'r+' if self.writable else 'c'
+            self.arrays = [np.load(self.path / f'{name}.npy', mmap_mode=mode) for name in ('pixels', 'embeddings', 'offsets', 'written')]
+        return self.arrays
+
+    def has_video(self, video_idx):
+        return bool(self.open()[3][video_idx])
+
+    def __getitem__(self, idx):
+        pixels, embeddings, _, _ = self.open()
+        return idx, torch.from_numpy(pixels[idx]), torch.from_numpy(embeddings[idx])
+
+    def put_video(self, video_idx, pixel_values, outputs):
+        pixels, embeddings, offsets, written = self.open()
+        start = int(offsets[video_idx])
+        end = int(offsets[video_idx + 1]) if video_idx + 1 < len(offsets) else len(pixels)
+        # the last sampled frame has no sample, a shorter decode would leave zero rows served as features
+        if len(pixel_values) < end - start:
+            raise ValueError(f"video {video_idx} decoded {len(pixel_values)} frames for the {end - start} samples of the "
+                             f"index, it is not written to the feature store {self.path}")
+        pixels[start:end] = pixel_values[:end - start].numpy()
+        embeddings[start:end] = outputs[:end - start].float().numpy()
+        # flagged after the rows are written, the other workers see both through the shared mapping
+        written[video_idx] = True
+
 
 # Build dataset from the frames
 class CharadesDataset(torch.utils.data.Dataset):
@@ -147,7 +353,14 @@ class CharadesDataset(torch.utils.data.Dataset):
             use_cache=True,
             device='cpu',
             dataset_name='charades',
+            num_workers=None,
+            frame_cache_bytes=2 << 30,
+            extract=True,
         ):
+        '''
+        extract: run the CLIP teacher on the videos which are not in the feature store, if False they are
+            expected to be extracted beforehand by python extract_features.py and the teacher is not loaded
+        '''
         
         CACHE_DIR='/mnt/ssd1/cache'
 
@@ -176,121 +389,399 @@ class CharadesDataset(torch.utils.data.Dataset):
         self.num_video = num_video
         self.skip_dump = skip_dump
         self.use_cache = use_cache
+        self.extract = extract
+        self.frame_cache = VideoFrameCache(frame_cache_bytes)
         print(f'Loading {num_video} videos')
         
-        self.model = CLIPModel.from_pretrained(
-            base_model_name,
-            cache_dir=CACHE_DIR
-        ).to(self.device)
-        self.nb_classes = self.model.config.vision_config.projection_dim
+        if extract:
+            self.model = CLIPModel.from_pretrained(
+                base_model_name,
+                cache_dir=CACHE_DIR
+            ).to(self.device)
+            self.nb_classes = self.model.config.vision_config.projection_dim
+        else:
+            self.model = None
+            self.nb_classes = CLIPConfig.from_pretrained(base_model_name, cache_dir=CACHE_DIR).projection_dim
         self.processor = CLIPProcessor.from_pretrained(base_model_name, cache_dir=CACHE_DIR)
 
         base_model_name_renamed = base_model_name.replace('/', '_')
         self.cache_file_dir = Path(dataset_dir) / dataset_name / base_model_name_renamed
         self.cache_file_dir.mkdir(parents=True, exist_ok=True)
 
-        dataset_info_path = self.cache_file_dir.parent / f'{split}_dataset_info.pkl'
-        # Initiation takes too long, so we dump the dataset info 
-        if dataset_info_path.exists():
-            print(f"Reusing {dataset_info_path}")
-            self.video_paths, self.idx_to_video, self.video_to_start, self.len = load(dataset_info_path)
-        else:
-            print(f"Populating {dataset_info_path}")
-            self.len = 0
-            self.video_paths = []
-            self.idx_to_video = []
-            self.video_to_start = []
-
-            for video_idx in range(num_video):
-                video_path_str = dataset[video_idx]['video']
-                video_path = Path(video_path_str)
-
-                num_frames = count_sampled_frames(video_path)
-                self.video_paths.append(video_path)
-                sample_cnt = num_frames - 1
-                for _ in range(sample_cnt):
-                    self.idx_to_video.append(video_idx)
-                self.video_to_start.append(self.len)
-                self.len += sample_cnt
-
-            # Dump the dataset info only when wer are using all the videos
-            if num_video == len(dataset):
-                print("Saving dataset info to", dataset_info_path)
-                dump((self.video_paths, self.idx_to_video, self.video_to_start, self.len), dataset_info_path)
+        # the video index and the feature store are created by rank 0 before the other ranks open them
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        is_main_process = not distributed or torch.distributed.get_rank() == 0
+        if distributed and not is_main_process:
+            torch.distributed.barrier()
+
+        # the frame counts of the videos are cached in an index shared by the splits, see update_video_index
+        video_index_path = self.cache_file_dir.parent / 'video_index.npz'
+        self.video_paths = [Path(dataset[video_idx]['video']) for video_idx in range(num_video)]
+        num_frames = update_video_index(self.video_paths, video_index_path, num_workers=num_workers)
+
+        # one sample per sampled frame but the last, the samples of each video are contiguous
+        sample_cnt = np.maximum(num_frames - 1, 0)
+        self.video_to_start = np.concatenate(([0], np.cumsum(sample_cnt)[:-1])).astype(np.int64)
+        self.len = int(sample_cnt.sum())
 
         print("Total number of frames", self.len)
 
-        if num_video != len(self.video_paths):
-            self.len = self.video_to_start[num_video]
+        crop_size = self.processor.image_processor.crop_size
+        self.feature_store = FeatureStore(
+            self.cache_file_dir / f'{split}_store', self.video_to_start, self.len,
+            pixel_shape=(3, crop_size['height'], crop_size['width']), embedding_dim=self.nb_classes,
+            writable=not skip_dump, create=is_main_process,
+        )
+        if distributed and is_main_process:
+            torch.distributed.barrier()
 
     def __len__(self):
         return self.len
 
+    def preprocess_video(self, video_path):
+        '''
+        Decode the sampled frames of a video into uint8 crops [T, 3, H, W], the rescale and normalization
+        are applied by the model (see DiffRate.patch.clip).
+        '''
+        return self.preprocess_frames(list(self.iter_frames(video_path)))
+
+    def iter_frames(self, video_path):
+        '''
+        The sampled frames of a video, resized and center cropped as the CLIP processor at decode time.
+        '''
+        image_processor = self.processor.image_processor
+        crop_size = image_processor.crop_size
+        return iter_sampled_frames(
+            video_path, size=image_processor.size['shortest_edge'], crop_size=(crop_size['height'], crop_size['width']),
+        )
+
+    def preprocess_frames(self, frames):
+        if len(frames) == 0:
+            crop_size = self.processor.image_processor.crop_size
+            return torch.empty((0, 3, crop_size['height'], crop_size['width']), dtype=torch.uint8)
+        return torch.from_numpy(np.stack(frames)).permute(0, 3, 1, 2).contiguous()
+
+    @torch.no_grad()
+    def teacher_features(self, pixel_values):
+        '''
+        The CLIP image features of uint8 frames [B, 3, H, W], computed on self.device.
+        '''
+        image_processor = self.processor.image_processor
+        mean = torch.tensor(image_processor.image_mean).view(1, -1, 1, 1)
+        std = torch.tensor(image_processor.image_std).view(1, -1, 1, 1)
+        pixel_values_device = ((pixel_values.float() * image_processor.rescale_factor - mean) / std).to(self.device)
+        return self.model.get_image_features(pixel_values=pixel_values_device).to('cpu')
+
+    def extract_video(self, video_path):
+        if not self.extract:
+            raise RuntimeError(f"{video_path} is not in the feature store {self.feature_store.path}, run python extract_features.py first")
+        print("Extracting features from video", video_path)
+        pixel_values = self.preprocess_video(video_path)
+        return pixel_values, self.teacher_features(pixel_values)
+
     def __getitem__(self, idx):
-        # Find the video index
-        video_idx = self.idx_to_video[idx]
-        start_idx = self.video_to_start[video_idx]
+        # Find the video index, the last video starting at or before idx (videos without samples share the start of the next one)
+        video_idx = int(np.searchsorted(self.video_to_start, idx, side='right')) - 1
+        start_idx = int(self.video_to_start[video_idx])
 
         frame_idx = idx - start_idx
 
         video_path = self.video_paths[video_idx]
         video_path = Path(video_path)
 
-        p_path = self.cache_file_dir / f'{video_path.stem}_p_{frame_idx}.npz'
-        o_path = self.cache_file_dir / f'{video_path.stem}_o_{frame_idx}.npz'
+        # Try to load from the feature store
+        if self.use_cache and self.feature_store.has_video(video_idx):
+            return self.feature_store[idx]
+
+        # the whole video is decoded and run through the teacher once, and its frames are served from the cache
+        cached = self.frame_cache.get(str(video_path))
+        if cached is None:
+            pixel_values, outputs = self.extract_video(video_path)
+            self.frame_cache.put(str(video_path), (pixel_values, outputs))
+            # Save to the feature store
+            if not self.skip_dump:
+                self.feature_store.put_video(video_idx, pixel_values, outputs)
+        else:
+            pixel_values, outputs = cached
+
+        pixel_values = pixel_values[frame_idx].clone()
+        output = outputs[frame_idx].clone()
+
+        return idx, pixel_values, output
+
+class CharadesStreamDataset(torch.utils.data.IterableDataset):
+    """
+    Stream the samples of a CharadesDataset without random access into the videos. The videos are shuffled
+    every epoch and sharded across the ranks and the data loader workers, each video is read sequentially,
+    from the feature store or decoded at the sampled fps, and the samples of several open videos are drawn
+    from a bounded shuffle buffer, so the memory does not depend on the size of the dataset. The items are
+    (idx, pixel_values, output), as the items of the dataset.
+
+    The ranks hold different videos, so every rank yields the number of whole batches of the rank with the
+    fewest, computed from the video index, so that the collectives of the steps match across the ranks.
+
+    Args:
+        dataset (CharadesDataset): The dataset to stream.
+        shuffle_buffer (int): The number of samples the next sample is drawn from.
+        open_videos (int): The number of videos read concurrently by each worker.
+        sample_stride (int): Keep the samples whose index is a multiple of sample_stride, as the uniform sampling of main.py.
+        rank (int), world_size (int): The shard of this process.
+        seed (int): The seed of the shuffling, the same on all ranks.
+        chunk_size (int): The number of decoded frames preprocessed and run through the teacher at once.
+        batch_size (int), num_workers (int): The batch size and the number of workers of the data loader, whose
+            workers batch their own samples.
+    """
+    def __init__(self, dataset, shuffle_buffer=1024, open_videos=8, sample_stride=1, rank=0, world_size=1, seed=0, chunk_size=16,
+                 batch_size=1, num_workers=0):
+        self.dataset = dataset
+        self.shuffle_buffer = shuffle_buffer
+        self.open_videos = open_videos
+        self.sample_stride = sample_stride
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.epoch = 0
+        self.nb_classes = dataset.nb_classes
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def video_range(self, video_idx):
+        start = int(self.dataset.video_to_start[video_idx])
+        end = int(self.dataset.video_to_start[video_idx + 1]) if video_idx + 1 < len(self.dataset.video_to_start) else self.dataset.len
+        return start, end
+
+    def epoch_videos(self):
+        videos = list(range(len(self.dataset.video_paths)))
+        random.Random(self.seed + self.epoch).shuffle(videos)
+        return videos
+
+    def rank_videos(self):
+        return self.epoch_videos()[self.rank::self.world_size]
+
+    def worker_quotas(self):
+        '''
+        The number of samples each data loader worker of this rank yields in the current epoch, in whole batches:
+        the batches of the ranks with more than the rank with the fewest are dropped from their last workers.
+        '''
+        starts = np.asarray(self.dataset.video_to_start, dtype=np.int64)
+        ends = np.append(starts[1:], self.dataset.len)
+        stride = self.sample_stride
+        counts = (ends - 1) // stride - (starts - 1) // stride
+        videos = np.array(self.epoch_videos(), dtype=np.int64)
+        batches = np.array([
+            [counts[videos[rank::self.world_size][worker::self.num_workers]].sum() // self.batch_size for worker in range(self.num_workers)]
+            for rank in range(self.world_size)
+        ], dtype=np.int64).reshape(self.world_size, self.num_workers)
+        quotas = batches[self.rank].copy()
+        excess = quotas.sum() - batches.sum(axis=1).min()
+        for worker in reversed(range(self.num_workers)):
+            cut = min(quotas[worker], excess)
+            quotas[worker] -= cut
+            excess -= cut
+        return quotas * self.batch_size
 
-        # Try to load from file
-        loaded_from_file = False
-        if all([self.use_cache, p_path.exists(), o_path.exists()]):
-            try:
-                with np.load(p_path, allow_pickle=True) as data:
-                    numpy_array = data['embeddings']
-                pixel_values = torch.tensor(numpy_array)
+    def __len__(self):
+        # the samples of this rank for the current epoch, the same number on all ranks
+        return int(self.worker_quotas().sum())
+
+    def iter_video(self, video_idx):
+        dataset = self.dataset
+        start, end = self.video_range(video_idx)
+        if dataset.use_cache and dataset.feature_store.has_video(video_idx):
+            for idx in range(start, end):
+                if idx % self.sample_stride == 0:
+                    yield dataset.feature_store[idx]
+            return
+
+        video_path = dataset.video_paths[video_idx]
+        if not dataset.extract:
+            raise RuntimeError(f"{video_path} is not in the feature store {dataset.feature_store.path}, run python extract_features.py first")
+        frames = dataset.iter_frames(video_path)
+        idx = start
+        while idx < end:
+            chunk = list(itertools.islice(frames, min(self.chunk_size, end - idx)))
+            if len(chunk) == 0:
+                return
+            pixel_values = dataset.preprocess_frames(chunk)
+            outputs = dataset.teacher_features(pixel_values)
+            for pixel_value, output in zip(pixel_values, outputs):
+                if idx % self.sample_stride == 0:
+                    yield idx, pixel_value, output
+                idx += 1
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        if num_workers != self.num_workers:
+            raise ValueError(f"the stream was set up for {self.num_workers} data loader workers, not {num_workers}")
+        quota = int(self.worker_quotas()[worker_id])
+        videos = iter(self.rank_videos()[worker_id::num_workers])
+        rng = random.Random((self.seed + self.epoch) * self.world_size * num_workers + self.rank * num_workers + worker_id)
+
+        streams, buffer = [], []
+        # the last samples, repeated if the videos hold fewer samples than the index, e.g. a truncated decode
+        recent = deque(maxlen=self.batch_size)
+        for _ in range(quota):
+            # fill the buffer from the open videos, in random order
+            while len(buffer) < self.shuffle_buffer:
+                while len(streams) < self.open_videos:
+                    video_idx = next(videos, None)
+                    if video_idx is None:
+                        break
+                    streams.append(self.iter_video(video_idx))
+                if len(streams) == 0:
+                    break
+                stream = rng.randrange(len(streams))
+                sample = next(streams[stream], None)
+                if sample is None:
+                    streams.pop(stream)
+                else:
+                    buffer.append(sample)
+            if len(buffer) == 0:
+                if len(recent) == 0:
+                    raise RuntimeError(f"the videos of worker {worker_id} of rank {self.rank} hold no samples")
+                buffer.append(recent[0])
+            i = rng.randrange(len(buffer))
+            buffer[i], buffer[-1] = buffer[-1], buffer[i]
+            recent.append(buffer[-1])
+            yield buffer.pop()
+
+
+def compute_frame_hashes(dataset, batch_size=256, num_workers=8):
+    """
+    The perceptual hashes of the samples of a dataset, whose items are (frame_idxs, samples, targets), packed
+    in uint8 [len(dataset), 8], and the frame index of each sample.
+    """
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    hashes, frame_idxs = [np.zeros((0, 8), dtype=np.uint8)], [np.zeros(0, dtype=np.int64)]
+    for frame_idx, samples, _ in loader:
+        hashes.append(np.packbits(perceptual_hash(samples).numpy(), axis=1))
+        frame_idxs.append(np.asarray(frame_idx, dtype=np.int64).reshape(-1))
+    return np.concatenate(hashes), np.concatenate(frame_idxs)
+
+class DedupDataset(torch.utils.data.Dataset):
+    """
+    The representative samples of a dataset whose near-duplicate frames are collapsed, see dedup_groups.
+    The number of frames each sample stands for is appended to its (frame_idxs, samples, targets) items,
+    so that the loss of the search is weighted as on the whole dataset.
+    """
+    def __init__(self, dataset, indices, weights):
+        self.dataset = dataset
+        self.indices = indices
+        self.weights = weights
 
-                with np.load(o_path, allow_pickle=True) as data:
-                    numpy_array = data['embeddings']
-                output = torch.tensor(numpy_array)
+    def __len__(self):
+        return len(self.indices)
 
-                pixel_values = pixel_values.to(torch.float32)
-                output = output.to(torch.float32)
+    def __getitem__(self, i):
+        frame_idx, sample, target = self.dataset[int(self.indices[i])]
+        return frame_idx, sample, target, torch.tensor(self.weights[i])
 
-                # pixel_values = load(p_path)
-                # output = load(o_path)
-                loaded_from_file = True
-            except Exception as e:
-                print("Error loading from file", str(e))
-                pass
+def build_dedup_dataset(dataset, hashes_path, threshold, num_workers=8):
+    """
+    Deduplicate the frames of dataset, the hashes of its samples are computed once by the main process and
+    stored at hashes_path, with their frame indices next to it, which split the runs at the video boundaries.
+    """
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    is_main_process = not distributed or torch.distributed.get_rank() == 0
+    hashes_path = Path(hashes_path)
+    frame_idxs_path = hashes_path.with_name(hashes_path.stem + '_frame_idxs.npy')
+    if is_main_process and not (hashes_path.exists() and frame_idxs_path.exists()
+                                and len(np.load(hashes_path, mmap_mode='r')) == len(dataset)):
+        print("Hashing the frames of the dataset into", hashes_path)
+        hashes_path.parent.mkdir(parents=True, exist_ok=True)
+        hashes, frame_idxs = compute_frame_hashes(dataset, num_workers=num_workers)
+        np.save(frame_idxs_path, frame_idxs)
+        np.save(hashes_path, hashes)
+    if distributed:
+        torch.distributed.barrier()
+    indices, weights = dedup_groups(np.load(hashes_path), threshold, getattr(dataset, 'video_to_start', None), np.load(frame_idxs_path))
+    print(f"Deduplicated {len(dataset)} frames into {len(indices)} samples")
+    return DedupDataset(dataset, indices, weights)
+
+def teacher_targets(dataset, indices=None, batch_size=256, num_workers=8):
+    """
+    The targets of the samples at indices (all by default) of a dataset, whose items are (..., samples, targets),
+    read from the feature store without decoding the frames when there is one.
+    """
+    indices = np.arange(len(dataset)) if indices is None else np.asarray(indices, dtype=np.int64)
+    if isinstance(dataset, DedupDataset):
+        return teacher_targets(dataset.dataset, dataset.indices[indices], batch_size, num_workers)
+    if isinstance(dataset, CharadesDataset):
+        store = dataset.feature_store
+        _, embeddings, _, written = store.open()
+        # the rows of the videos which are not extracted yet are zeros
+        videos = np.unique(np.searchsorted(dataset.video_to_start, indices, side='right') - 1)
+        missing = videos[~written[videos]]
+        if len(missing) > 0:
+            raise RuntimeError(f"{len(missing)} videos (e.g. {dataset.video_paths[missing[0]]}) are not in the feature "
+                               f"store {store.path}, run python extract_features.py first")
+        return np.asarray(embeddings[indices])
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, indices), batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    return np.concatenate([items[-1].float().numpy() for items in loader])
+
+def k_center_greedy(features, k, device='cpu', seed=0, verbose=True):
+    """
+    Select k samples such that the largest cosine distance of any sample to its closest selected sample is
+    (greedily) minimized, starting from a random sample.
 
-        if not loaded_from_file:
-            print("Extracting features from video", video_path)
-            frames = sample_frames(video_path)
+    Args:
+        features (np.ndarray): The features of the samples [N, D].
+        k (int): The number of samples to select.
 
-            pixel_values = self.processor.image_processor(
-                images=frames, return_tensors="pt", padding=True, 
-            )["pixel_values"]
+    Returns:
+        np.ndarray: The indices of the selected samples, in selection order.
+    """
+    features = torch.nn.functional.normalize(torch.from_numpy(np.asarray(features, dtype=np.float32)).to(device), dim=-1)
+    k = min(k, len(features))
+    selected = torch.empty(k, dtype=torch.long, device=device)
+    selected[0] = int(torch.randint(len(features), (1,), generator=torch.Generator().manual_seed(seed)))
+    min_distance = torch.full((len(features),), float('inf'), device=device)
+    for i in range(1, k):
+        min_distance = torch.minimum(min_distance, 1 - features @ features[selected[i - 1]])
+        selected[i] = min_distance.argmax()
+        if verbose and i % 10000 == 0:
+            print(f"k-center greedy: {i}/{k}, radius {min_distance.max().item():.4f}")
+    return selected.cpu().numpy()
+
+def select_train_subset(dataset, sampling_rate, strategy='uniform', path='', key=None, num_workers=8, device='cpu', seed=0):
+    """
+    The indices of the training samples the search runs on, as many as a uniform sampling at sampling_rate:
+     - uniform: every int(1/sampling_rate)-th sample
+     - kcenter: a k-center greedy coreset of the teacher targets, see k_center_greedy, which covers the diverse
+       content instead of over-sampling the long static videos
 
-            pixel_values_device = pixel_values.to(self.device)
-            with torch.no_grad():
-                outputs = self.model.get_image_features(pixel_values=pixel_values_device).to('cpu')
+    The coresets are computed by the main process and stored at path, with the key of the samples they were
+    selected from (e.g. the data path and the preprocessing version) in the json next to it, which is checked on load.
+    """
+    # a range, which does not hold the indices
+    uniform = range(0, len(dataset), int(1/sampling_rate))
+    if strategy == 'uniform':
+        return uniform
+    if strategy != 'kcenter':
+        raise NotImplementedError(f"Unknown train subset strategy {strategy}")
+
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    is_main_process = not distributed or torch.distributed.get_rank() == 0
+    path = Path(path)
+    key_path = path.with_suffix('.json')
+    if is_main_process and not path.exists():
+        print(f"Selecting a {strategy} coreset of {len(uniform)} samples into", path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        indices = k_center_greedy(teacher_targets(dataset, num_workers=num_workers), len(uniform), device=device, seed=seed)
+        np.save(path, np.sort(indices))
+        key_path.write_text(json.dumps(key))
+    if distributed:
+        torch.distributed.barrier()
+    selected_key = json.loads(key_path.read_text()) if key_path.exists() else None
+    if selected_key != key:
+        raise ValueError(f"the train subset {path} was selected for {selected_key}, not {key}, remove it or choose another --train-subset")
+    return np.load(path)
 
-            # Save to file
-            if not self.skip_dump:
-                for i, (p, o) in enumerate(zip(pixel_values, outputs)):
-                    dump(p, self.cache_file_dir / f'{video_path.stem}_p_{i}.pkl', compress=3)
-                    dump(o, self.cache_file_dir / f'{video_path.stem}_o_{i}.pkl', compress=3)
-                    # torch.save(p, self.cache_file_dir / f'{video_path.stem}_p_{i}.pt')
-                    # torch.save(o, self.cache_file_dir / f'{video_path.stem}_o_{i}.pt')
-
-            # pixel_values = pixel_values[frame_idx]
-            pixel_values = self.processor.image_processor(
-                images=frames, return_tensors="pt", padding=True, 
-                # do_rescale=False,
-                # do_normalize=False,
-                # do_convert_rgb=False,
-            )["pixel_values"].float()[frame_idx]
-            output = outputs[frame_idx]
-
-        return pixel_values, output
 
 def build_dataset(is_train, args):
     transform = build_transform(is_train, args)
@@ -311,7 +802,8 @@ def build_dataset(is_train, args):
                               category=args.inat_category, transform=transform)
         nb_classes = dataset.nb_classes
     elif args.data_set == 'CHARADES':
-        dataset = CharadesDataset(args.model, dataset_dir=args.data_path, train=is_train)
+        # the teacher features are extracted beforehand by python extract_features.py
+        dataset = CharadesDataset(args.model, dataset_dir=args.data_path, train=is_train, num_workers=args.num_workers, extract=False)
         nb_classes = dataset.nb_classes
     elif args.data_set == 'HOW2QA':
         if args.model == 'vit_large_patch14_clip_224.openai':
@@ -396,6 +888,10 @@ def build_dataset(is_train, args):
     else:
         raise NotImplementedError(f"Unknown dataset {args.data_set}")
 
+    if is_train and getattr(args, 'dedup_threshold', -1) >= 0:
+        hashes_path = args.frame_hashes or os.path.join(args.output_dir, f'{args.data_set.lower()}_frame_hashes.npy')
+        dataset = build_dedup_dataset(dataset, hashes_path, args.dedup_threshold, num_workers=args.num_workers)
+
     return dataset, nb_classes
 
 
@@ -13,16 +13,22 @@ from timm.data import Mixup
 from timm.utils import accuracy, ModelEma
 
 import utils
+from DiffRate.ddp import select_search_target
+from DiffRate.utils import SyncCounter
 
 
 
 def train_one_epoch(model: torch.nn.Module, criterion,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
                     device: torch.device, epoch: int, loss_scaler, max_norm: float = 0, mixup_fn: Optional[Mixup] = None,
-                    set_training_mode=True,logger=None,target_flops=3.0,warm_up=False):
+                    set_training_mode=True,logger=None,target_flops=3.0,warm_up=False,count_syncs=False,
+                    latency_table=None,target_latency_ms=None,from_prefix=False,
+                    start_step=0,checkpoint_steps=0,save_checkpoint=None):
+    # a resumed epoch starts at start_step, and save_checkpoint(step) is called every checkpoint_steps steps
     model.train(set_training_mode)
     # model.train(False)      # finetune
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    # losses and meters stay on device and are copied to the host only when they are logged
+    metric_logger = utils.MetricLogger(delimiter="  ", lazy=True)
     # metric_logger.add_meter('lr_weight', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     metric_logger.add_meter('lr_architecture', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
@@ -36,8 +42,22 @@ def train_one_epoch(model: torch.nn.Module, criterion,
     else:
         lamb = 5
 
+    # with a latency table, the search is constrained by the estimated latency instead of the flops
+    use_latency = target_latency_ms is not None
+    model_without_ddp = model.module if hasattr(model, 'module') else model
+
+    # several targets are searched on the same batches, each with its own compression rate, see add_search_targets
+    search_targets = [target_latency_ms] if use_latency else list(target_flops) if isinstance(target_flops, (list, tuple)) else [target_flops]
+    multi_target = len(search_targets) > 1
+    # the frozen prefix of the model only depends on the samples, so it is computed once for all targets
+    shared_prefix = multi_target and not from_prefix and hasattr(model_without_ddp, 'forward_prefix')
+    meter_name = lambda name, target: f'{name}_{target}' if multi_target else name
+
+    sync_counter = SyncCounter(enabled=count_syncs)
     for data_iter_step, items in enumerate(metric_logger.log_every(data_loader, logger.info_freq, header,logger)):
-        frame_idxs, samples, targets = items
+        # a deduplicated dataset appends the number of frames each sample stands for, see DedupDataset
+        weights = items[3].to(device, non_blocking=True) if len(items) == 4 else None
+        frame_idxs, samples, targets = items[:3]
 
         samples = samples.to(device, non_blocking=True)
         targets = targets.to(device, non_blocking=True)
@@ -45,41 +65,74 @@ def train_one_epoch(model: torch.nn.Module, criterion,
         if mixup_fn is not None:
             samples, targets = mixup_fn(samples, targets)
 
-        with torch.cuda.amp.autocast():
-            outputs, flops = model(samples)
-            loss_cls = criterion(outputs, targets)
-            loss_flops = ((flops/1e9)-target_flops)**2
-            loss = lamb * loss_flops + loss_cls
-            loss_cls_value = loss_cls.item()
-            loss_flops_value = loss_flops.item()
-        
-        
-        if not math.isfinite(loss_cls_value):
-            logger.info("Loss is {}, stopping training".format(loss_cls_value))
-            sys.exit(1)
-
-        optimizer.zero_grad()
-
-        # this attribute is added by timm on one optimizer (adahessian)
-        is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
-        grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
-                    parameters=model.module.arch_parameters(), create_graph=is_second_order)
-        torch.cuda.synchronize()
+        with sync_counter:
+            if shared_prefix:
+                model_without_ddp.eval()
+                with torch.cuda.amp.autocast():
+                    samples = model_without_ddp.forward_prefix(samples)[0].float()
+                model_without_ddp.train(set_training_mode)
+
+            optimizer.zero_grad()
+            losses_cls = []
+            for target_index, search_target in enumerate(search_targets):
+                select_search_target(model_without_ddp, target_index)
+                with torch.cuda.amp.autocast():
+                    if from_prefix or shared_prefix:     # the samples are the output tokens of block 0
+                        outputs, flops = model(samples, from_prefix=True)
+                    else:
+                        outputs, flops = model(samples)
+                    loss_cls = criterion(outputs, targets) if weights is None else criterion(outputs, targets, weights)
+                    if use_latency:
+                        latency = latency_table(model_without_ddp)
+                        loss_latency = (latency-search_target)**2
+                        loss = lamb * loss_latency + loss_cls
+                    else:
+                        loss_flops = ((flops/1e9)-search_target)**2
+                        loss = lamb * loss_flops + loss_cls
+
+                # this attribute is added by timm on one optimizer (adahessian)
+                is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+                # the gradients of all targets are accumulated, and the step is taken after the last one
+                grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
+                            parameters=model_without_ddp.arch_parameters(), create_graph=is_second_order,
+                            update_grad=target_index == len(search_targets) - 1)
+
+                losses_cls.append(loss_cls)
+                if multi_target:
+                    metric_logger.update(**{meter_name('loss_cls', search_target): loss_cls})
+                if use_latency:
+                    metric_logger.update(loss_latency=loss_latency)
+                    metric_logger.update(latency=latency)
+                else:
+                    metric_logger.update(**{meter_name('loss_flops', search_target): loss_flops})
+                metric_logger.update(**{meter_name('flops', search_target): flops/1e9})
+            select_search_target(model_without_ddp, 0)
+
+        metric_logger.update(loss_cls=sum(losses_cls) / len(losses_cls))
+        metric_logger.update(grad_norm=grad_norm)
+        metric_logger.update(lr_architecture=optimizer.param_groups[0]["lr"])
+        if count_syncs:
+            metric_logger.update(syncs=sync_counter.count)
+        if checkpoint_steps > 0 and (start_step + data_iter_step + 1) % checkpoint_steps == 0:
+            save_checkpoint(start_step + data_iter_step + 1)
+
+        if data_iter_step%logger.info_freq == 0:
+            # the loss is checked when meters are resolved, a non-finite loss makes the running total non-finite
+            metric_logger.resolve()
+            if not math.isfinite(metric_logger.loss_cls.total):
+                logger.info("Loss is {}, stopping training".format(metric_logger.loss_cls.value))
+                sys.exit(1)
 
         if data_iter_step%compression_rate_print_freq == 0:
-            if hasattr(model, 'module'):  # for DDP 
-                prune_kept_num, merge_kept_num = model.module.get_kept_num()
-            else:
-                prune_kept_num, merge_kept_num = model.get_kept_num()
-            logger.info(f'prune kept number:{prune_kept_num}')
-            logger.info(f'merge kept number:{merge_kept_num}')
+            for target_index, search_target in enumerate(search_targets):
+                select_search_target(model_without_ddp, target_index)
+                prune_kept_num, merge_kept_num = model_without_ddp.get_kept_num()
+                if multi_target:
+                    logger.info(f'target {search_target}:')
+                logger.info(f'prune kept number:{prune_kept_num}')
+                logger.info(f'merge kept number:{merge_kept_num}')
+            select_search_target(model_without_ddp, 0)
 
-
-        metric_logger.update(loss_cls=loss_cls_value)
-        metric_logger.update(loss_flops=loss_flops_value)
-        metric_logger.update(flops=flops/1e9)
-        metric_logger.update(grad_norm=grad_norm)
-        metric_logger.update(lr_architecture=optimizer.param_groups[0]["lr"])
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     logger.info(f"Averaged stats:{metric_logger}")
@@ -91,7 +144,7 @@ def evaluate(data_loader, model, device,logger=None):
     cosine_similarity = torch.nn.CosineSimilarity(dim=-1, eps=1e-6)
     criterion = lambda x, y: (1 - cosine_similarity(x, y)).mean()
 
-    metric_logger = utils.MetricLogger(delimiter="  ")
+    metric_logger = utils.MetricLogger(delimiter="  ", lazy=True)
     header = 'Test:'
 
     # switch to evaluation mode
@@ -108,11 +161,9 @@ def evaluate(data_loader, model, device,logger=None):
             output, flops = model(images)
             loss = criterion(output, target)
 
-        torch.cuda.synchronize()
-
         batch_size = images.shape[0]
         metric_logger.update(flops=flops/1e9)
-        metric_logger.update(loss=loss.item())
+        metric_logger.update(loss=loss)
         # metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
         # metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
     if hasattr(model, 'module'):  # for DDP 
@@ -0,0 +1,56 @@
+'''
+Offline extraction of the CLIP teacher features of a video dataset into its feature store, so that the
+search never runs the teacher, see DiffRate.extract
+
+    python extract_features.py --model vit_base_patch16_clip_224.openai --data-path $path_to_dataset$ --split train
+    torchrun --nproc_per_node=4 extract_features.py ...     # one shard of the videos per rank
+'''
+
+import argparse
+import os
+
+import torch.distributed as dist
+
+from dataset import CharadesDataset
+from DiffRate.extract import extract
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('DiffRate teacher feature extraction', add_help=False)
+    parser.add_argument('--model', default='vit_base_patch16_clip_224.openai', type=str, help='name of the model')
+    parser.add_argument('--data-path', type=str, required=True, help='dataset directory, the feature store is written under it')
+    parser.add_argument('--split', default='train', choices=['train', 'test'])
+    parser.add_argument('--num_video', default=-1, type=int, help='number of videos, all by default')
+    parser.add_argument('--device', default='cuda', help='device of the teacher')
+    parser.add_argument('--batch-size', default=256, type=int, help='number of frames of each teacher batch')
+    parser.add_argument('--num_workers', default=8, type=int, help='number of decoding processes')
+    parser.add_argument('--decode-threads', default=0, type=int, help='decode the videos in this many threads instead of the decoding processes')
+    parser.add_argument('--dedup-threshold', default=-1, type=int, help='run the teacher once per run of frames whose perceptual hashes differ by at most this many bits, -1 to disable')
+    parser.add_argument('--rank', default=int(os.environ.get('RANK', 0)), type=int, help='shard of this process')
+    parser.add_argument('--world_size', default=int(os.environ.get('WORLD_SIZE', 1)), type=int, help='number of shards')
+    return parser
+
+
+def main(args):
+    device = args.device
+    if device == 'cuda' and 'LOCAL_RANK' in os.environ:
+        device = f"cuda:{os.environ['LOCAL_RANK']}"
+    # the video index and the feature store are created by rank 0 before the other ranks open them, see CharadesDataset
+    distributed = args.world_size > 1 and 'MASTER_ADDR' in os.environ
+    if distributed:
+        dist.init_process_group('gloo', rank=args.rank, world_size=args.world_size)
+    dataset = CharadesDataset(
+        args.model, dataset_dir=args.data_path, train=args.split == 'train', num_video=args.num_video,
+        skip_dump=False, device=device, num_workers=args.num_workers, extract=True,
+    )
+
+    extract(dataset, batch_size=args.batch_size, num_workers=args.num_workers, rank=args.rank, world_size=args.world_size,
+            decode_threads=args.decode_threads, dedup_threshold=args.dedup_threshold)
+    if distributed:
+        dist.barrier()
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('DiffRate teacher feature extraction', parents=[get_args_parser()])
+    main(parser.parse_args())
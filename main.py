@@ -2,6 +2,8 @@
 # All rights reserved.
 import argparse
 import datetime
+import hashlib
+import inspect
 import numpy as np
 import time
 import torch
@@ -18,9 +20,9 @@ from timm.scheduler import create_scheduler
 from timm.optim import create_optimizer
 from timm.utils import NativeScaler, get_state_dict, ModelEma
 
-from dataset import build_dataset
+from dataset import build_dataset, select_train_subset, CharadesStreamDataset, PREPROCESSING_VERSION
 from engine import train_one_epoch, evaluate
-from samplers import RASampler
+from samplers import RASampler, LazyRASampler, PermutationSampler
 import utils
 import shutil
 import warnings
@@ -30,11 +32,26 @@ from timm.scheduler.cosine_lr import CosineLRScheduler
 import models_mae
 import caformer
 import DiffRate
+from DiffRate.latency import LatencyTable
+from DiffRate.prefix import build_prefix_cache, is_prefix_cache, check_prefix_cache, PrefixCacheDataset
+from DiffRate.ddp import add_search_targets, select_search_target, load_arch_state_dict
 
 
 warnings.filterwarnings('ignore')
 
 
+# the names of the models in compression_rate.json, the other models are named as --model
+model_name_dict = {
+    'vit_deit_tiny_patch16_224':'ViT-T-DeiT',
+    'vit_deit_small_patch16_224':'ViT-S-DeiT',
+    'vit_deit_base_patch16_224': 'ViT-B-DeiT',
+    'vit_base_patch16_mae': 'ViT-B-MAE',
+    'vit_large_patch16_mae': 'ViT-L-MAE',
+    'vit_huge_patch14_mae': 'ViT-H-MAE',
+    'caformer_s36':'CAFormer-S36',
+}
+
+
 def get_args_parser():
     parser = argparse.ArgumentParser('Diffrate training and evaluation script', add_help=False)
     parser.add_argument('--batch-size', default=256, type=int)
@@ -180,14 +197,30 @@ def get_args_parser():
     parser.add_argument('--port', default="15662", type=str,
                         help='number of distributed processes')
     parser.add_argument('--dist_url', default='env://', help='url used to set up distributed training')
+    parser.add_argument('--dist-mode', default='arch', choices=['arch', 'ddp'],
+                        help='arch: run the model unwrapped and all-reduce the arch gradients only, ddp: wrap the model in DistributedDataParallel')
 
-    parser.add_argument('--target_flops', type=float, default=3.0)
+    parser.add_argument('--target_flops', type=float, nargs='+', default=[3.0], help='one or more target flops (G), several targets are searched in one run on the same batches')
+    parser.add_argument('--target_latency_ms', type=float, default=None, help='search under a latency constraint (ms per batch) instead of --target_flops, requires --latency_table')
+    parser.add_argument('--latency_table', type=str, default=None, help='latency table measured by python -m DiffRate.latency')
     parser.add_argument('--granularity', type=int, default=4, help='the token number gap between each compression rate candidate')
     parser.add_argument('--load_compression_rate', action='store_true', help='eval by exiting compression rate in compression_rate.json')
     parser.add_argument('--warmup_compression_rate', action='store_true', default=False, help='inactive computational constraint in first epoch')
     parser.add_argument('--alpha', type=int, default=5_000, help='parameter to weight cosine similarity loss')
     parser.add_argument('--train-sampling-rate', type=float, default=0.1, help='sampling rate for training data')
     parser.add_argument('--test-sampling-rate', type=float, default=0.1, help='sampling rate for testing data')
+    parser.add_argument('--fused-attn', action='store_true', default=False, help='run the attention of deit and clip with the fused scaled_dot_product_attention')
+    parser.add_argument('--train-subset-strategy', default='uniform', choices=['uniform', 'kcenter'], help='how the training samples are selected at --train-sampling-rate: every n-th sample, or a k-center coreset of the teacher targets')
+    parser.add_argument('--train-subset', default='', type=str, help='path of the selected training samples, computed on first use, in output_dir by default')
+    parser.add_argument('--lazy-sampler', action='store_true', default=False, help='generate the training permutation lazily with a Feistel network instead of materializing it, for very large datasets')
+    parser.add_argument('--checkpoint-steps', default=0, type=int, help='also save a checkpoint every this many steps, which resumes the epoch at its next step, requires --lazy-sampler')
+    parser.add_argument('--dedup-threshold', default=-1, type=int, help='collapse the consecutive training frames whose perceptual hashes differ by at most this many bits into one weighted sample, -1 to disable')
+    parser.add_argument('--frame-hashes', default='', type=str, help='path of the perceptual hashes of the training frames, computed on first use, in output_dir by default')
+    parser.add_argument('--stream', action='store_true', default=False, help='stream the training videos of CHARADES sequentially through a shuffle buffer instead of sampling frames at random')
+    parser.add_argument('--shuffle-buffer', default=1024, type=int, help='number of samples the next streamed sample is drawn from')
+    parser.add_argument('--open-videos', default=8, type=int, help='number of videos each data loader worker streams concurrently')
+    parser.add_argument('--prefix-cache', default='', type=str, help='directory of the cache of the frozen prefix (patch embedding and block 0) of the training set, built on first use')
+    parser.add_argument('--count-syncs', action='store_true', default=False, help='report the number of host-device synchronizations of each search step')
     return parser
 
 
@@ -209,17 +242,63 @@ def main(args):
 
     cudnn.benchmark = True
 
+    if args.checkpoint_steps > 0 and (not args.lazy_sampler or args.stream):
+        raise ValueError("--checkpoint-steps requires --lazy-sampler, whose epochs can be resumed at any sample")
+    if args.dedup_threshold >= 0 and ('clip' not in args.model or args.prefix_cache):
+        raise ValueError("frame deduplication only supports clip models on the video datasets, without a prefix cache")
     dataset_train, args.nb_classes = build_dataset(is_train=True, args=args)
     dataset_val, _ = build_dataset(is_train=False, args=args)
 
-    # Do uniform sampling
-    indices = list(range(0, len(dataset_train), int(1/args.train_sampling_rate)))
-    dataset_train = torch.utils.data.Subset(dataset_train, indices=indices)
+    # the checkpoint is read before the training data loader starts sampling, which a mid-epoch checkpoint resumes
+    if args.autoresume and os.path.exists(os.path.join(args.output_dir, 'checkpoint.pth')):
+        args.resume = os.path.join(args.output_dir, 'checkpoint.pth')
+    resume_checkpoint = None
+    if args.resume:
+        if args.resume.startswith('https'):
+            resume_checkpoint = torch.hub.load_state_dict_from_url(
+                args.resume, map_location='cpu', check_hash=True)
+        else:
+            resume_checkpoint = torch.load(args.resume, map_location='cpu')
+    # the step of a mid-epoch checkpoint, its epoch resumes at the first sample of the next step
+    start_step = resume_checkpoint.get('step', 0) if resume_checkpoint is not None and not args.eval else 0
 
-    if True:  # args.distributed:
+    # Do uniform sampling
+    if args.stream:
+        if args.data_set != 'CHARADES' or args.prefix_cache or args.dedup_threshold >= 0 or args.train_subset_strategy != 'uniform':
+            raise ValueError("--stream only supports CHARADES with the uniform sampling, without a prefix cache or deduplication")
+        dataset_train = CharadesStreamDataset(
+            dataset_train, shuffle_buffer=args.shuffle_buffer, open_videos=args.open_videos,
+            sample_stride=int(1/args.train_sampling_rate), rank=utils.get_rank(), world_size=utils.get_world_size(), seed=args.seed,
+            batch_size=args.batch_size, num_workers=args.num_workers,
+        )
+    else:
+        # the coreset is only reused for the same teacher targets, of the same samples
+        subset_key = {
+            'model': args.model, 'data_set': args.data_set, 'data_path': os.path.abspath(args.data_path),
+            'preprocessing': PREPROCESSING_VERSION, 'train_sampling_rate': args.train_sampling_rate,
+            'train_subset_strategy': args.train_subset_strategy, 'dedup_threshold': args.dedup_threshold,
+            'length': len(dataset_train), 'seed': args.seed,
+        }
+        subset_hash = hashlib.sha256(json.dumps(subset_key, sort_keys=True).encode()).hexdigest()[:12]
+        subset_path = args.train_subset or os.path.join(
+            args.output_dir, f'{args.data_set.lower()}_{args.train_subset_strategy}_{args.train_sampling_rate}_{subset_hash}.npy')
+        indices = select_train_subset(dataset_train, args.train_sampling_rate, args.train_subset_strategy, subset_path,
+                                      key=subset_key, num_workers=args.num_workers, device=device, seed=args.seed)
+        dataset_train = torch.utils.data.Subset(dataset_train, indices=indices)
+
+    if args.stream:
+        # the stream shards and shuffles the videos itself
+        sampler_train = None
+        sampler_val = torch.utils.data.SequentialSampler(dataset_val)
+    elif True:  # args.distributed:
         num_tasks = utils.get_world_size()
         global_rank = utils.get_rank()
-        if args.repeated_aug:
+        if args.lazy_sampler:
+            sampler_cls = LazyRASampler if args.repeated_aug else PermutationSampler
+            sampler_train = sampler_cls(
+                dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True, seed=args.seed
+            )
+        elif args.repeated_aug:
             sampler_train = RASampler(
                 dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
             )
@@ -241,18 +320,34 @@ def main(args):
         sampler_train = torch.utils.data.RandomSampler(dataset_train)
         sampler_val = torch.utils.data.SequentialSampler(dataset_val)
 
+    if start_step > 0 and (not args.lazy_sampler or args.stream):
+        raise ValueError(f"{args.resume} was saved in the middle of an epoch, it is resumed with --lazy-sampler")
+    if args.lazy_sampler and resume_checkpoint is not None and not args.eval and 'epoch' in resume_checkpoint:
+        # the resumed epoch is set before the data loader starts sampling it, from the sample after the checkpoint
+        sampler_train.set_epoch(resume_checkpoint['epoch'] + (start_step == 0), start=start_step * args.batch_size)
+
     num_samples = int(args.test_sampling_rate * len(dataset_val))
     sampler_val = torch.utils.data.RandomSampler(dataset_val, replacement=True, num_samples=num_samples)
 
     # leveraging MultiEpochsDataLoader for faster data loading
-    data_loader_train = MultiEpochsDataLoader(
-        dataset_train, sampler=sampler_train,
-        batch_size=args.batch_size,
-        num_workers=args.num_workers,
-        pin_memory=args.pin_mem,
-        drop_last=True,
+    # with a prefix cache, the training samples are served from the cache once the model is built
+    if args.stream:
+        data_loader_train = torch.utils.data.DataLoader(
+            dataset_train,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_mem,
+            drop_last=True,
+        )
+    elif not args.prefix_cache:
+        data_loader_train = MultiEpochsDataLoader(
+            dataset_train, sampler=sampler_train,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_mem,
+            drop_last=True,
 
-    )
+        )
 
     data_loader_val = MultiEpochsDataLoader(
         dataset_val, sampler=sampler_val,
@@ -384,35 +479,31 @@ def main(args):
     
     # DiffRate Patch
     if 'deit' in args.model:
-        DiffRate.patch.deit(model, prune_granularity=args.granularity, merge_granularity=args.granularity)
+        DiffRate.patch.deit(model, prune_granularity=args.granularity, merge_granularity=args.granularity, fused_attn=args.fused_attn)
     elif 'mae' in args.model:
         DiffRate.patch.mae(model, prune_granularity=args.granularity, merge_granularity=args.granularity)
     elif 'caformer' in args.model:
         DiffRate.patch.caformer(model, prune_granularity=args.granularity, merge_granularity=args.granularity)
     elif 'clip' in args.model:
-        DiffRate.patch.clip(model, prune_granularity=args.granularity, merge_granularity=args.granularity)
+        DiffRate.patch.clip(model, prune_granularity=args.granularity, merge_granularity=args.granularity, fused_attn=args.fused_attn)
     else:
         raise ValueError("only support deit, mae, caformer and clip in this codebase")
 
-    model_name_dict = {
-        'vit_deit_tiny_patch16_224':'ViT-T-DeiT',
-        'vit_deit_small_patch16_224':'ViT-S-DeiT',
-        'vit_deit_base_patch16_224': 'ViT-B-DeiT',
-        'vit_base_patch16_mae': 'ViT-B-MAE',
-        'vit_large_patch16_mae': 'ViT-L-MAE',
-        'vit_huge_patch14_mae': 'ViT-H-MAE',
-        'caformer_s36':'CAFormer-S36',
-    }
     if args.load_compression_rate:
         with open('compression_rate.json', 'r') as f:
             compression_rate = json.load(f)
             model_name = model_name_dict[args.model]
-            if not str(args.target_flops) in compression_rate[model_name]:
-                raise ValueError(f"compression_rate.json does not contaion {model_name} with {args.target_flops}G flops")
-            prune_kept_num = eval(compression_rate[model_name][str(args.target_flops)]['prune_kept_num'])
-            merge_kept_num = eval(compression_rate[model_name][str(args.target_flops)]['merge_kept_num'])
+            target_flops = args.target_flops[0]
+            if not str(target_flops) in compression_rate[model_name]:
+                raise ValueError(f"compression_rate.json does not contaion {model_name} with {target_flops}G flops")
+            prune_kept_num = eval(compression_rate[model_name][str(target_flops)]['prune_kept_num'])
+            merge_kept_num = eval(compression_rate[model_name][str(target_flops)]['merge_kept_num'])
             model.set_kept_num(prune_kept_num, merge_kept_num)
 
+    # one compression rate per target flops, a latency search has a single target
+    search_targets = [f'{args.target_latency_ms}ms'] if args.target_latency_ms is not None else args.target_flops
+    add_search_targets(model, len(search_targets))
+
 
 
 
@@ -454,9 +545,42 @@ def main(args):
 
     model.to(device)
 
+    # the checkpoints only hold the searched compression rate, the backbone is referred to by the hash of its weights
+    backbone = {'model': args.model, 'hash': utils.backbone_hash(model)}
+
+    if args.prefix_cache:
+        if 'clip' not in args.model or args.data_set in ('CIFAR', 'IMNET', 'INAT', 'INAT19'):
+            raise ValueError("the prefix cache only supports clip models on datasets with deterministic transforms")
+        # the cache is only reused for the same backbone and the same training samples
+        prefix_key = {
+            'model': args.model, 'backbone': backbone['hash'], 'data_set': args.data_set,
+            'data_path': os.path.abspath(args.data_path), 'train_sampling_rate': args.train_sampling_rate,
+            'train_subset_strategy': args.train_subset_strategy,
+            'preprocessing': PREPROCESSING_VERSION,
+            'train_subset': hashlib.sha256(np.asarray(dataset_train.indices, dtype=np.int64).tobytes()).hexdigest(),
+        }
+        if utils.is_main_process() and not is_prefix_cache(args.prefix_cache):
+            logger.info(f"Building the prefix cache of {len(dataset_train)} samples in {args.prefix_cache}")
+            build_prefix_cache(model, dataset_train, args.prefix_cache, batch_size=args.batch_size,
+                               num_workers=args.num_workers, device=device, key=prefix_key)
+        if args.distributed:
+            torch.distributed.barrier()
+        check_prefix_cache(args.prefix_cache, prefix_key)
+        n_train = len(dataset_train)
+        dataset_train = PrefixCacheDataset(args.prefix_cache)
+        assert len(dataset_train) == n_train, f"{args.prefix_cache} was built for another training set"
+        data_loader_train = MultiEpochsDataLoader(
+            dataset_train, sampler=sampler_train,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_mem,
+            drop_last=True,
+        )
+
     model_without_ddp = model
-    if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+    if args.distributed and args.dist_mode == 'ddp':
+        # a forward of one search target does not use the compression rates of the others
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=len(search_targets) > 1)
         model_without_ddp = model.module
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     logger.info(f'number of params: {n_parameters}')
@@ -471,16 +595,29 @@ def main(args):
         return
 
 
-    optimizer = torch.optim.AdamW(model_without_ddp.arch_parameters(), lr=args.arch_lr, weight_decay=0)
-    loss_scaler = utils.NativeScalerWithGradNormCount()
+    # the fused AdamW updates all the arch parameters in one kernel
+    fused = device.type == 'cuda' and 'fused' in inspect.signature(torch.optim.AdamW).parameters
+    optimizer = torch.optim.AdamW(model_without_ddp.arch_parameters(), lr=args.arch_lr, weight_decay=0, **({'fused': True} if fused else {}))
+    # without DDP, only the arch gradients are averaged over the processes, once per step
+    loss_scaler = utils.NativeScalerWithGradNormCount(all_reduce_grads=args.distributed and args.dist_mode == 'arch')
     lr_scheduler = CosineLRScheduler(optimizer, t_initial=args.epochs, lr_min=args.arch_min_lr, cycle_decay=args.decay_rate)
 
+    latency_table = None
+    if args.target_latency_ms is not None:
+        if args.latency_table is None:
+            raise ValueError("--target_latency_ms requires a --latency_table measured by python -m DiffRate.latency")
+        latency_table = LatencyTable.load(args.latency_table).to(device)
+        logger.info(f"Search under {args.target_latency_ms}ms with the latency table {args.latency_table}")
 
 
     if 'clip' in args.model:
         cosine_similarity = torch.nn.CosineSimilarity(dim=-1, eps=1e-6)
         alpha = args.alpha
-        criterion = lambda x, y: (1 - cosine_similarity(x, y).mean()) * alpha
+        def criterion(x, y, weights=None):
+            # the deduplicated samples are weighted by the number of frames they stand for
+            similarity = cosine_similarity(x, y)
+            similarity = similarity.mean() if weights is None else (similarity * weights).sum() / weights.sum()
+            return (1 - similarity) * alpha
         # mse_loss = torch.nn.MSELoss()
         # alpha = args.alpha
         # criterion = lambda x, y: mse_loss(x, y) * alpha
@@ -493,28 +630,46 @@ def main(args):
         criterion = torch.nn.CrossEntropyLoss()
 
 
-    if args.autoresume and os.path.exists(os.path.join(args.output_dir, 'checkpoint.pth')):
-        args.resume = os.path.join(args.output_dir, 'checkpoint.pth')
-    if args.resume:
-        if args.resume.startswith('https'):
-            checkpoint = torch.hub.load_state_dict_from_url(
-                args.resume, map_location='cpu', check_hash=True)
+    checkpoint_saver = utils.AsyncCheckpointSaver()
+    checkpoint_path = output_dir / 'checkpoint.pth'
+
+    def save_checkpoint(epoch, step=0):
+        # with step > 0, a checkpoint after the first step steps of the epoch
+        if args.output_dir:
+            checkpoint_saver.save({
+                'arch': utils.arch_state_dict(model_without_ddp),
+                'backbone': backbone,
+                'optimizer': optimizer.state_dict(),
+                'lr_scheduler': lr_scheduler.state_dict(),
+                'epoch': epoch,
+                'step': step,
+                'scaler': loss_scaler.state_dict(),
+                'args': args,
+            }, checkpoint_path)
+
+    if resume_checkpoint is not None:
+        if 'arch' in resume_checkpoint:
+            if resume_checkpoint['backbone'] != backbone:
+                raise ValueError(f"{args.resume} was searched on the backbone {resume_checkpoint['backbone']}, not {backbone}")
+            load_arch_state_dict(model_without_ddp, resume_checkpoint['arch'])
         else:
-            checkpoint = torch.load(args.resume, map_location='cpu')
-        model_without_ddp.load_state_dict(checkpoint['model'], strict=False)
-        if not args.eval and 'optimizer' in checkpoint and 'lr_scheduler' in checkpoint and 'epoch' in checkpoint:
-            optimizer.load_state_dict(checkpoint['optimizer'])
-            lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
-            args.start_epoch = checkpoint['epoch'] + 1
-            if 'scaler' in checkpoint:
-                loss_scaler.load_state_dict(checkpoint['scaler'])
+            load_arch_state_dict(model_without_ddp, resume_checkpoint['model'])
+        if not args.eval and 'optimizer' in resume_checkpoint and 'lr_scheduler' in resume_checkpoint and 'epoch' in resume_checkpoint:
+            optimizer.load_state_dict(resume_checkpoint['optimizer'])
+            lr_scheduler.load_state_dict(resume_checkpoint['lr_scheduler'])
+            args.start_epoch = resume_checkpoint['epoch'] + 1 if start_step == 0 else resume_checkpoint['epoch']
+            if 'scaler' in resume_checkpoint:
+                loss_scaler.load_state_dict(resume_checkpoint['scaler'])
 
 
     logger.info(f"Start training for {args.epochs} epochs")
     start_time = time.time()
     min_loss = float('inf')
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
+        if args.stream:
+            dataset_train.set_epoch(epoch)
+        elif args.distributed and (epoch > args.start_epoch or start_step == 0):
+            # the epoch of a mid-epoch checkpoint is set before the data loader started
             data_loader_train.sampler.set_epoch(epoch)
 
         train_stats = train_one_epoch(
@@ -524,25 +679,32 @@ def main(args):
             set_training_mode=args.finetune == '',  # keep in eval mode during finetuning
             logger=logger,
             target_flops=args.target_flops,
-            warm_up=args.warmup_compression_rate
+            warm_up=args.warmup_compression_rate,
+            count_syncs=args.count_syncs,
+            latency_table=latency_table,
+            target_latency_ms=args.target_latency_ms,
+            from_prefix=bool(args.prefix_cache),
+            start_step=start_step if epoch == args.start_epoch else 0,
+            checkpoint_steps=args.checkpoint_steps,
+            save_checkpoint=lambda step: save_checkpoint(epoch, step),
         )
 
         lr_scheduler.step(epoch)
-        if args.output_dir:
-            checkpoint_paths = [output_dir / 'checkpoint.pth']
-            for checkpoint_path in checkpoint_paths:
-                utils.save_on_master({
-                    'model': model_without_ddp.state_dict(),
-                    'optimizer': optimizer.state_dict(),
-                    'lr_scheduler': lr_scheduler.state_dict(),
-                    'epoch': epoch,
-                    'scaler': loss_scaler.state_dict(),
-                    'args': args,
-                }, checkpoint_path)
-
-        test_stats = evaluate(data_loader_val, model, device,logger=logger)
+        save_checkpoint(epoch)
+
+        if len(search_targets) > 1:
+            test_stats = {}
+            for target_index, search_target in enumerate(search_targets):
+                select_search_target(model_without_ddp, target_index)
+                logger.info(f"Evaluate the compression rate of target {search_target}")
+                test_stats.update({f'{k}_{search_target}': v for k, v in evaluate(data_loader_val, model, device,logger=logger).items()})
+            select_search_target(model_without_ddp, 0)
+            test_stats['loss'] = sum(test_stats[f'loss_{t}'] for t in search_targets) / len(search_targets)
+        else:
+            test_stats = evaluate(data_loader_val, model, device,logger=logger)
         logger.info(f"Loss of the network on the {len(dataset_val)} test images: {test_stats['loss']:.2f}")
         if utils.is_main_process() and min_loss > test_stats['loss'] :
+            checkpoint_saver.wait()
             shutil.copyfile(checkpoint_path, f'{args.output_dir}/model_best.pth')
         min_loss = min(min_loss, test_stats["loss"])
         logger.info(f'Min loss: {min_loss:.2f}%')
@@ -556,6 +718,23 @@ def main(args):
             with (output_dir / "log.txt").open("a") as f:
                 f.write(json.dumps(log_stats) + "\n")
 
+    checkpoint_saver.wait()
+    if len(search_targets) > 1 and args.epochs > args.start_epoch and args.output_dir and utils.is_main_process():
+        # in the layout of compression_rate.json, which is left untouched, so that a search does not change the published rates
+        model_name = model_name_dict.get(args.model, args.model)
+        compression_rate = {model_name: {}}
+        for target_index, search_target in enumerate(search_targets):
+            select_search_target(model_without_ddp, target_index)
+            prune_kept_num, merge_kept_num = model_without_ddp.get_kept_num()
+            compression_rate[model_name][str(search_target)] = {
+                'prune_kept_num': str(prune_kept_num),
+                'merge_kept_num': str(merge_kept_num),
+            }
+        select_search_target(model_without_ddp, 0)
+        with (output_dir / 'compression_rate.json').open('w') as f:
+            json.dump(compression_rate, f, indent=4)
+        logger.info(f"Compression rates of {search_targets} saved to {output_dir / 'compression_rate.json'}")
+
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     logger.info('Training time {}'.format(total_time_str))
@@ -3,6 +3,7 @@
 import torch
 import torch.distributed as dist
 import math
+import numpy as np
 
 
 class RASampler(torch.utils.data.Sampler):
@@ -57,3 +58,107 @@ class RASampler(torch.utils.data.Sampler):
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+
+def _mix64(x):
+    # splitmix64 finalizer, on uint64 arrays which wrap around on overflow
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+class FeistelPermutation:
+    """A seeded pseudo-random permutation of [0, n) evaluated lazily, in O(1) memory.
+    The indices are encrypted by a balanced Feistel network over the smallest power of 4 >= n,
+    which is a bijection, and cycle walked back into [0, n).
+    """
+
+    def __init__(self, n, seed=0, rounds=4):
+        self.n = n
+        self.half_bits = max((max(n - 1, 1).bit_length() + 1) // 2, 1)
+        self.mask = np.uint64((1 << self.half_bits) - 1)
+        seeds = np.arange(rounds, dtype=np.uint64) + np.uint64((seed * 0x9e3779b97f4a7c15) & 0xffffffffffffffff)
+        self.keys = _mix64(seeds)
+
+    def _encrypt(self, x):
+        left, right = x >> np.uint64(self.half_bits), x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix64(right ^ key) & self.mask)
+        return (left << np.uint64(self.half_bits)) | right
+
+    def __call__(self, indices):
+        """The permuted values of an array of indices in [0, n)."""
+        x = self._encrypt(np.asarray(indices, dtype=np.uint64))
+        out_of_range = x >= self.n
+        while out_of_range.any():
+            x[out_of_range] = self._encrypt(x[out_of_range])
+            out_of_range = x >= self.n
+        return x.astype(np.int64)
+
+    def __len__(self):
+        return self.n
+
+
+class PermutationSampler(torch.utils.data.Sampler):
+    """Sampler that restricts data loading to a subset of the dataset for distributed, as
+    torch.utils.data.DistributedSampler (repeats=1) or RASampler (repeats=3), without
+    materializing the permutation: the indices are generated lazily by a FeistelPermutation
+    seeded with the epoch, in chunks, so the memory does not depend on the size of the dataset.
+    set_epoch(epoch, start) resumes the epoch at the start-th sample of this rank, and once a pass is over
+    the sampler moves to the next epoch from its first sample unless set_epoch was called meanwhile, so that a
+    data loader which starts the next pass ahead of set_epoch (MultiEpochsDataLoader) does not repeat the seed
+    or the start of the last one.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0, repeats=1,
+                 num_selected_samples=None, chunk_size=65536):
+        if num_replicas is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            rank = dist.get_rank()
+        self.dataset_size = len(dataset)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.repeats = repeats
+        self.chunk_size = chunk_size
+        self.epoch = 0
+        self.start = 0
+        self.num_samples = int(math.ceil(self.dataset_size * repeats / self.num_replicas))
+        self.num_selected_samples = self.num_samples if num_selected_samples is None else num_selected_samples
+
+    def __iter__(self):
+        epoch, start = self.epoch, self.start
+        permutation = FeistelPermutation(self.dataset_size, seed=self.seed + epoch) if self.shuffle else None
+        for chunk_start in range(start, self.num_selected_samples, self.chunk_size):
+            # the position of the samples of this rank in the padded list of the repeated permutation
+            t = np.arange(chunk_start, min(chunk_start + self.chunk_size, self.num_selected_samples), dtype=np.int64)
+            positions = (self.rank + t * self.num_replicas) % (self.dataset_size * self.repeats)
+            indices = positions // self.repeats
+            yield from (permutation(indices) if permutation is not None else indices).tolist()
+        if (self.epoch, self.start) == (epoch, start):
+            self.set_epoch(epoch + 1)
+
+    def __len__(self):
+        return max(self.num_selected_samples - self.start, 0)
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+
+class LazyRASampler(PermutationSampler):
+    """RASampler with a lazily generated permutation, see PermutationSampler."""
+
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0):
+        if num_replicas is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            num_replicas = dist.get_world_size()
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed, repeats=3,
+                         num_selected_samples=int(math.floor(len(dataset) // 256 * 256 / num_replicas)))
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from DiffRate.dedup import dedup_groups
+
+
+def dedup_groups_loop(hashes, threshold, video_starts):
+    # the per-sample definition of the runs
+    bits = np.unpackbits(hashes, axis=1)
+    indices, weights = [], []
+    for idx in range(len(bits)):
+        if indices and idx not in video_starts and np.count_nonzero(bits[idx] != bits[indices[-1]]) <= threshold:
+            weights[-1] += 1
+        else:
+            indices.append(idx)
+            weights.append(1)
+    return np.array(indices, dtype=np.int64), np.array(weights, dtype=np.float32)
+
+
+def make_videos(seed, num_videos=6, max_frames=80):
+    """
+    The hashes of slowly changing videos, their first sample index and the frame index of each sample.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(0, max_frames, num_videos)
+    scenes = rng.integers(0, 256, (lengths.sum(), 8), dtype=np.uint8)
+    hashes = scenes[np.sort(rng.integers(0, len(scenes), lengths.sum()))]
+    noise = rng.integers(0, 256, hashes.shape, dtype=np.uint8) * (rng.random(hashes.shape) < 0.05)
+    video_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    frame_idxs = np.concatenate([np.arange(length) for length in lengths])
+    return hashes ^ noise.astype(np.uint8), video_starts, frame_idxs
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("threshold", [0, 4, 16])
+def test_dedup_groups_matches_loop(seed, threshold):
+    hashes, video_starts, frame_idxs = make_videos(seed)
+    expected = dedup_groups_loop(hashes, threshold, set(video_starts.tolist()))
+    for boundaries in ({'video_starts': video_starts}, {'frame_idxs': frame_idxs}):
+        for window in (1, 32):
+            indices, weights = dedup_groups(hashes, threshold, window=window, **boundaries)
+            assert np.array_equal(indices, expected[0])
+            assert np.array_equal(weights, expected[1])
+
+
+def test_dedup_groups_stops_at_frame_idx_gaps():
+    # identical frames of three videos, only told apart by their frame indices
+    hashes = np.zeros((7, 8), dtype=np.uint8)
+    indices, weights = dedup_groups(hashes, 0, frame_idxs=[0, 1, 2, 0, 1, 5, 6])
+    assert indices.tolist() == [0, 3, 5]
+    assert weights.tolist() == [3, 2, 2]
@@ -0,0 +1,68 @@
+import logging
+import os
+
+import pytest
+import timm
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import DiffRate
+import utils
+from engine import train_one_epoch
+
+BATCH_SIZE = 4
+WORLD_SIZE = 2
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = timm.create_model("deit_tiny_patch16_224", pretrained=False, depth=3, num_classes=8)
+    DiffRate.patch.deit(model, prune_granularity=4, merge_granularity=4)
+    return model
+
+
+def make_batch():
+    generator = torch.Generator().manual_seed(1)
+    samples = torch.randn(BATCH_SIZE, 3, 224, 224, generator=generator)
+    targets = torch.randn(BATCH_SIZE, 8, generator=generator)
+    return torch.arange(BATCH_SIZE), samples, targets
+
+
+def search_step(rank, world_size):
+    """
+    One search step of main.py in the default arch mode, on the shard of the batch of this rank, and
+    the arch gradients it leaves behind.
+    """
+    model = make_model()
+    optimizer = torch.optim.AdamW(model.arch_parameters(), lr=0.01, weight_decay=0)
+    loss_scaler = utils.NativeScalerWithGradNormCount(all_reduce_grads=world_size > 1)
+    cosine_similarity = torch.nn.CosineSimilarity(dim=-1, eps=1e-6)
+    criterion = lambda x, y: (1 - cosine_similarity(x, y).mean()) * 100
+    logger = logging.getLogger(f"test_distributed_{rank}")
+
+    shard = slice(rank * BATCH_SIZE // world_size, (rank + 1) * BATCH_SIZE // world_size)
+    data_loader = [tuple(item[shard] for item in make_batch())]
+    train_one_epoch(model, criterion, data_loader, optimizer, torch.device("cpu"), 0, loss_scaler,
+                    logger=logger, target_flops=0.5)
+    return [p.grad.clone() for p in model.arch_parameters()]
+
+
+def worker(rank, world_size, init_file, output_dir):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    try:
+        torch.save(search_step(rank, world_size), os.path.join(output_dir, f"grads_{rank}.pt"))
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+def test_arch_grads_match_single_process(tmp_path):
+    expected = search_step(0, 1)
+
+    mp.spawn(worker, args=(WORLD_SIZE, str(tmp_path / "init"), str(tmp_path)), nprocs=WORLD_SIZE)
+    for rank in range(WORLD_SIZE):
+        grads = torch.load(tmp_path / f"grads_{rank}.pt")
+        assert len(grads) == len(expected)
+        for grad, expected_grad in zip(grads, expected):
+            assert torch.allclose(grad, expected_grad, atol=1e-6, rtol=1e-4)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+import timm
+import torch
+
+import DiffRate
+
+transformers = pytest.importorskip("transformers")
+
+
+def make_clip():
+    torch.manual_seed(0)
+    model = timm.create_model("vit_base_patch16_clip_224.openai", pretrained=False, depth=2, num_classes=512).eval()
+    DiffRate.patch.clip(model)
+    return model
+
+
+@torch.no_grad()
+def test_uint8_input_matches_clip_processor():
+    # the openai CLIP preprocessing: bicubic resize, center crop, rescale and normalize
+    processor = transformers.CLIPImageProcessor()
+    frames = np.random.default_rng(0).integers(0, 256, (2, 224, 224, 3), dtype=np.uint8)
+    pixel_values = processor(images=list(frames), return_tensors="pt")["pixel_values"]
+    uint8_values = torch.from_numpy(frames).permute(0, 3, 1, 2).contiguous()
+
+    model = make_clip()
+    assert torch.allclose(model(uint8_values, return_flop=False), model(pixel_values, return_flop=False), atol=1e-4)
+
+
+@pytest.mark.parametrize("shape", [(480, 854), (854, 480), (361, 641), (100, 150)])
+def test_decode_time_resize_matches_clip_processor(shape):
+    dataset = pytest.importorskip("dataset")
+    # the PIL processor, the default one of transformers < 5
+    processor = getattr(transformers, "CLIPImageProcessorPil", transformers.CLIPImageProcessor)()
+    frame = np.random.default_rng(0).integers(0, 256, (*shape, 3), dtype=np.uint8)
+    expected = processor(images=frame, do_rescale=False, do_normalize=False, return_tensors="np")["pixel_values"][0]
+
+    crop_size = (processor.crop_size["height"], processor.crop_size["width"])
+    crop = dataset.resize_center_crop(frame, processor.size["shortest_edge"], crop_size)
+    assert np.array_equal(crop.transpose(2, 0, 1), expected.astype(np.uint8))
+
+
+def test_feature_store_is_rebuilt_on_preprocessing_change(tmp_path):
+    dataset = pytest.importorskip("dataset")
+    offsets = np.array([0, 2])
+    store = dataset.FeatureStore(tmp_path, offsets, 3, (3, 4, 4), 8, writable=True)
+    store.put_video(0, torch.ones(2, 3, 4, 4, dtype=torch.uint8), torch.ones(2, 8))
+    assert dataset.FeatureStore(tmp_path, offsets, 3, (3, 4, 4), 8).has_video(0)
+    assert not dataset.FeatureStore(tmp_path, offsets, 3, (3, 4, 4), 8, version=-1).has_video(0)
@@ -0,0 +1,22 @@
+import torch
+
+from DiffRate.reuse import LSHReuseTable
+
+
+def test_budget_adds_buckets():
+    small = LSHReuseTable(16, bucket_size=4, max_entries=64)
+    large = LSHReuseTable(16, bucket_size=4, max_entries=1 << 16)
+    assert (small.num_bits, small.bucket_size) == (4, 4)
+    assert (large.num_bits, large.bucket_size) == (14, 4)
+    assert large.capacity == 1 << 16
+    assert LSHReuseTable(16, bucket_size=4, max_entries=3).capacity == 3
+
+
+def test_reuse_hits_stored_tokens():
+    torch.manual_seed(0)
+    table = LSHReuseTable(16, bucket_size=4, threshold=0.99, max_entries=1 << 12)
+    x = torch.randn(2, 9, 16)
+    fn = lambda tokens: tokens * 2
+    assert torch.allclose(table.reuse(x, fn), fn(x))
+    assert torch.allclose(table.reuse(x, fn), fn(x), atol=1e-2)
+    assert table.stats()["hits"] == 16
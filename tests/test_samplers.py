@@ -0,0 +1,36 @@
+import pytest
+import torch
+
+from samplers import PermutationSampler
+from utils import MultiEpochsDataLoader
+
+NUM_SAMPLES = 40
+BATCH_SIZE = 4
+EPOCHS = 3
+
+
+def run(start_epoch=0, start_step=0, num_workers=0):
+    """
+    The batches of the training loop of main.py with --lazy-sampler, resumed at start_step of start_epoch.
+    """
+    sampler = PermutationSampler(range(NUM_SAMPLES), num_replicas=1, rank=0, seed=0)
+    if start_epoch > 0 or start_step > 0:
+        sampler.set_epoch(start_epoch, start=start_step * BATCH_SIZE)
+    data_loader = MultiEpochsDataLoader(torch.arange(NUM_SAMPLES), sampler=sampler, batch_size=BATCH_SIZE,
+                                        num_workers=num_workers, drop_last=True)
+    batches = []
+    for epoch in range(start_epoch, EPOCHS):
+        if epoch > start_epoch or start_step == 0:
+            sampler.set_epoch(epoch)
+        batches += [batch.tolist() for batch in data_loader]
+    return batches
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+@pytest.mark.parametrize("start_epoch, start_step", [(1, 0), (1, 3), (2, 9)])
+def test_resume_yields_the_remaining_batches(num_workers, start_epoch, start_step):
+    batches = run(num_workers=num_workers)
+    assert len(batches) == EPOCHS * NUM_SAMPLES // BATCH_SIZE
+    assert batches[:NUM_SAMPLES // BATCH_SIZE] != batches[NUM_SAMPLES // BATCH_SIZE:2 * NUM_SAMPLES // BATCH_SIZE]
+    skipped = start_epoch * NUM_SAMPLES // BATCH_SIZE + start_step
+    assert run(start_epoch, start_step, num_workers) == batches[skipped:]
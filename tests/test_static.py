@@ -0,0 +1,28 @@
+import pytest
+import timm
+import torch
+
+import DiffRate
+
+
+def make_model(name, patch):
+    torch.manual_seed(0)
+    model = timm.create_model(name, pretrained=False, depth=4).eval()
+    patch(model, prune_granularity=4, merge_granularity=4)
+    # block 0 is never compressed
+    model.set_kept_num([197, 160, 120, 97], [197, 140, 100, 65])
+    return model
+
+
+@pytest.mark.parametrize("name, patch", [
+    ("deit_tiny_patch16_224", DiffRate.patch.deit),
+    ("vit_base_patch16_clip_224", DiffRate.patch.clip),
+])
+@torch.no_grad()
+def test_export_matches_patched_model(name, patch):
+    model = make_model(name, patch)
+    exported = DiffRate.export(model)
+    x = torch.randn(2, 3, 224, 224)
+    assert torch.allclose(exported(x), model(x, return_flop=False), atol=1e-5)
+    # the patched model is left untouched
+    assert model.get_kept_num() == ([197, 160, 120, 97], [197, 140, 100, 65])
@@ -0,0 +1,158 @@
+import datetime
+import logging
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import timm
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import DiffRate
+import utils
+from DiffRate.extract import extract
+from engine import train_one_epoch
+
+dataset = pytest.importorskip("dataset")
+
+NUM_CLASSES = 8
+NUM_SAMPLES = [3, 2]
+
+
+def open_store(path, num_samples=NUM_SAMPLES, writable=False):
+    """
+    A CharadesDataset stand-in over the feature store of videos of num_samples samples.
+    """
+    video_to_start = np.concatenate(([0], np.cumsum(num_samples)[:-1])).astype(np.int64)
+    store = dataset.FeatureStore(path, video_to_start, sum(num_samples), (3, 224, 224), NUM_CLASSES, writable=writable)
+    return SimpleNamespace(
+        feature_store=store, video_to_start=video_to_start, len=sum(num_samples), video_paths=[None] * len(num_samples),
+        use_cache=True, extract=False, nb_classes=NUM_CLASSES,
+    )
+
+
+def make_store(path, num_samples=NUM_SAMPLES):
+    """
+    open_store over a feature store where all the videos are extracted.
+    """
+    charades = open_store(path, num_samples, writable=True)
+    generator = torch.Generator().manual_seed(0)
+    for video_idx, n in enumerate(num_samples):
+        pixel_values = torch.randint(0, 256, (n, 3, 224, 224), dtype=torch.uint8, generator=generator)
+        charades.feature_store.put_video(video_idx, pixel_values, torch.randn(n, NUM_CLASSES, generator=generator))
+    return charades
+
+
+def test_stream_items_match_store(tmp_path):
+    charades = make_store(tmp_path / "store")
+    stream = dataset.CharadesStreamDataset(charades, shuffle_buffer=4, open_videos=2)
+    items = sorted(stream, key=lambda item: item[0])
+    assert [item[0] for item in items] == list(range(charades.len))
+    for idx, pixel_values, output in items:
+        _, expected_pixel_values, expected_output = charades.feature_store[idx]
+        assert torch.equal(pixel_values, expected_pixel_values)
+        assert torch.equal(output, expected_output)
+
+
+def test_train_one_epoch_on_stream(tmp_path):
+    torch.manual_seed(0)
+    model = timm.create_model("vit_base_patch16_clip_224.openai", pretrained=False, depth=2, num_classes=NUM_CLASSES)
+    DiffRate.patch.clip(model, prune_granularity=4, merge_granularity=4)
+    optimizer = torch.optim.AdamW(model.arch_parameters(), lr=0.01, weight_decay=0)
+    cosine_similarity = torch.nn.CosineSimilarity(dim=-1, eps=1e-6)
+    criterion = lambda x, y: (1 - cosine_similarity(x, y).mean()) * 100
+
+    stream = dataset.CharadesStreamDataset(make_store(tmp_path / "store"), shuffle_buffer=4, open_videos=2)
+    data_loader = torch.utils.data.DataLoader(stream, batch_size=2)
+    stats = train_one_epoch(model, criterion, data_loader, optimizer, torch.device("cpu"), 0,
+                            utils.NativeScalerWithGradNormCount(), logger=logging.getLogger("test_stream"),
+                            target_flops=10.0)
+    assert np.isfinite(stats['loss_cls'])
+    assert all(p.grad is not None for p in model.arch_parameters())
+
+
+def test_teacher_targets_read_the_store(tmp_path):
+    charades = dataset.CharadesDataset.__new__(dataset.CharadesDataset)
+    charades.__dict__.update(vars(make_store(tmp_path / "store")))
+    indices = np.array([4, 0, 3])
+    targets = dataset.teacher_targets(charades, indices)
+    assert np.array_equal(targets, np.stack([charades.feature_store[idx][2].numpy() for idx in indices]))
+
+    written = np.load(tmp_path / "store" / "written.npy")
+    written[1] = False
+    np.save(tmp_path / "store" / "written.npy", written)
+    charades.feature_store.arrays = None
+    assert dataset.teacher_targets(charades, [0, 2]).shape == (2, NUM_CLASSES)
+    with pytest.raises(RuntimeError, match="not in the feature store"):
+        dataset.teacher_targets(charades, [0, 3])
+
+
+def test_train_subset_is_checked_against_its_key(tmp_path):
+    charades = dataset.CharadesDataset.__new__(dataset.CharadesDataset)
+    charades.__dict__.update(vars(make_store(tmp_path / "store")))
+    path, key = tmp_path / "subset.npy", {"data_path": str(tmp_path / "store"), "preprocessing": dataset.PREPROCESSING_VERSION}
+    indices = dataset.select_train_subset(charades, 0.5, "kcenter", path, key=key, num_workers=0)
+    assert len(indices) == 3
+    assert np.array_equal(dataset.select_train_subset(charades, 0.5, "kcenter", path, key=key, num_workers=0), indices)
+    with pytest.raises(ValueError, match="was selected for"):
+        dataset.select_train_subset(charades, 0.5, "kcenter", path, key={**key, "data_path": "other"}, num_workers=0)
+
+def test_short_videos_are_not_written(tmp_path):
+    charades = open_store(tmp_path / "store", writable=True)
+    frames = [torch.full((n, 3, 224, 224), video_idx + 1, dtype=torch.uint8) for video_idx, n in enumerate(NUM_SAMPLES)]
+    with pytest.raises(ValueError, match="decoded 2 frames for the 3 samples"):
+        charades.feature_store.put_video(0, frames[0][:2], torch.ones(2, NUM_CLASSES))
+    assert not charades.feature_store.has_video(0)
+
+    # the decode of the first video falls one frame short, the second one has its last sampled frame
+    decoded = [frames[0][:2], torch.cat((frames[1], frames[1][:1]))]
+    charades.preprocess_video = lambda video_idx: decoded[video_idx]
+    charades.video_paths = [0, 1]
+    charades.teacher_features = lambda pixel_values: pixel_values.float().mean(dim=(2, 3)).repeat(1, 3)[:, :NUM_CLASSES]
+    extract(charades, batch_size=4, num_workers=0, verbose=False)
+    assert not charades.feature_store.has_video(0)
+    assert charades.feature_store.has_video(1)
+    _, pixel_values, output = charades.feature_store[NUM_SAMPLES[0]]
+    assert torch.equal(pixel_values, frames[1][0]) and torch.all(output == 2)
+
+
+# videos of uneven lengths, whose shards hold different numbers of samples
+RANK_NUM_SAMPLES = [7, 1, 4, 2, 9, 3, 5]
+WORLD_SIZE = 2
+
+
+def count_batches(rank, world_size, init_file, store_path, output_dir):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size,
+                            timeout=datetime.timedelta(seconds=60))
+    try:
+        stream = dataset.CharadesStreamDataset(open_store(store_path, RANK_NUM_SAMPLES), shuffle_buffer=4, open_videos=2,
+                                               rank=rank, world_size=world_size, batch_size=2)
+        data_loader = torch.utils.data.DataLoader(stream, batch_size=2, drop_last=True)
+        num_batches = 0
+        for epoch in range(3):
+            stream.set_epoch(epoch)
+            for _ in data_loader:
+                # as the all-reduce of the arch gradients of each step, which hangs if a rank has fewer batches
+                dist.all_reduce(torch.ones(1))
+                num_batches += 1
+            dist.barrier()
+        torch.save((len(stream), num_batches), os.path.join(output_dir, f"batches_{rank}.pt"))
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+def test_ranks_yield_the_same_number_of_batches(tmp_path):
+    make_store(tmp_path / "store", RANK_NUM_SAMPLES)
+    # the workers of a data loader batch their own samples
+    for rank in range(WORLD_SIZE):
+        stream = dataset.CharadesStreamDataset(open_store(tmp_path / "store", RANK_NUM_SAMPLES), rank=rank, world_size=WORLD_SIZE,
+                                               batch_size=2, num_workers=2)
+        num_batches = len(list(torch.utils.data.DataLoader(stream, batch_size=2, num_workers=2, drop_last=True)))
+        assert num_batches == len(stream) // 2 == 6
+
+    mp.spawn(count_batches, args=(WORLD_SIZE, str(tmp_path / "init"), str(tmp_path / "store"), str(tmp_path)), nprocs=WORLD_SIZE)
+    results = [torch.load(tmp_path / f"batches_{rank}.pt") for rank in range(WORLD_SIZE)]
+    assert results[0] == results[1]
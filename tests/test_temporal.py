@@ -0,0 +1,36 @@
+import timm
+import torch
+
+import DiffRate
+from DiffRate.temporal import TemporalReuseState, match_source
+
+
+def test_match_source():
+    # the previous frame: tokens 0 (class), 1 = {1, 3}, 2 = {2}, 4 pruned
+    previous_source = torch.tensor([[0, 1, 2, 1, -1]])
+    # the current frame: 1 = {2}, 2 = {1, 3} as before, and 3 = {4}, which was pruned
+    assert match_source(torch.tensor([[0, 2, 1, 2, 3]]), previous_source, 4, 3).tolist() == [[0, 2, 1, -1]]
+    # 1 = {1}, 2 = {2, 3}: no token is made of the same patches
+    assert match_source(torch.tensor([[0, 1, 2, 2, -1]]), previous_source, 3, 3).tolist() == [[0, -1, -1]]
+
+
+def test_reuse_follows_the_sorted_tokens():
+    torch.manual_seed(0)
+    model = timm.create_model("vit_base_patch16_clip_224.openai", pretrained=False, depth=4)
+    DiffRate.patch.clip(model, prune_granularity=4, merge_granularity=4)
+    model.set_kept_num([197, 189, 177, 165], [197, 181, 169, 157])
+    model.eval()
+    frame = torch.randint(0, 256, (1, 3, 224, 224), dtype=torch.uint8)
+    # a few patches change, which reorders the tokens sorted by their class attention
+    next_frame = frame.clone()
+    next_frame[..., :32, :32] = 255 - next_frame[..., :32, :32]
+
+    state = TemporalReuseState(threshold=0.05)
+    with torch.no_grad():
+        model(frame, return_flop=False, temporal_state=state)
+        output = model(next_frame, return_flop=False, temporal_state=state)
+        expected = model(next_frame, return_flop=False)
+    assert torch.nn.functional.cosine_similarity(output, expected).item() > 0.99
+    # the first frame computes every token, the second one little more than the changed patches
+    for block in state.stats()["blocks"][1:]:
+        assert block["attn"] < 0.6 and block["mlp"] < 0.6
@@ -7,6 +7,7 @@ Mostly copy-paste from torchvision references.
 """
 import io
 import os
+import threading
 import time
 from collections import defaultdict, deque
 import datetime
@@ -25,7 +26,9 @@ import multiprocessing
 import socket 
 import random
 
-from torch._six import inf
+from math import inf
+
+from DiffRate.utils import backbone_hash
 
 def dist_init(port=2333):
     if multiprocessing.get_start_method(allow_none=True) != 'spawn':
@@ -65,8 +68,12 @@ def init_distributed_mode(args):
         args.gpu = int(os.environ['LOCAL_RANK'])
         args.distributed = True
 
-        torch.cuda.set_device(args.gpu)
-        args.dist_backend = 'nccl'
+        # gloo runs the search on cpu, e.g. to test the distributed mode
+        if torch.cuda.is_available():
+            torch.cuda.set_device(args.gpu)
+            args.dist_backend = 'nccl'
+        else:
+            args.dist_backend = 'gloo'
         print('| distributed init (rank {}): {}'.format(
             args.rank, args.dist_url), flush=True)
         torch.distributed.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
@@ -102,19 +109,36 @@ class SmoothedValue(object):
         self.total = 0.0
         self.count = 0
         self.fmt = fmt
+        self.pending = []
 
     def update(self, value, n=1):
         self.deque.append(value)
         self.count += n
         self.total += value * n
 
+    def update_lazy(self, value, n=1):
+        """
+        Keep a device tensor without synchronizing, it is copied to the host by resolve()
+        """
+        self.pending.append((value.detach().float().reshape(()), n))
+
+    def resolve(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        values = torch.stack([value for value, _ in pending]).tolist()
+        for value, (_, n) in zip(values, pending):
+            self.update(value, n)
+
     def synchronize_between_processes(self):
         """
         Warning: does not synchronize the deque!
         """
+        self.resolve()
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        # gloo runs the search on cpu, see init_distributed_mode
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda' if dist.get_backend() == 'nccl' else 'cpu')
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -123,24 +147,29 @@ class SmoothedValue(object):
 
     @property
     def median(self):
+        self.resolve()
         d = torch.tensor(list(self.deque))
         return d.median().item()
 
     @property
     def avg(self):
+        self.resolve()
         d = torch.tensor(list(self.deque), dtype=torch.float32)
         return d.mean().item()
 
     @property
     def global_avg(self):
+        self.resolve()
         return self.total / self.count
 
     @property
     def max(self):
+        self.resolve()
         return max(self.deque)
 
     @property
     def value(self):
+        self.resolve()
         return self.deque[-1]
 
     def __str__(self):
@@ -216,17 +245,36 @@ def create_logger(output_dir, dist_rank=0, name=''):
     return logger
 
 class MetricLogger(object):
-    def __init__(self, delimiter="\t"):
+    def __init__(self, delimiter="\t", lazy=False):
+        """
+        lazy: keep tensor values on device and copy the values of all meters to the host in a single
+        transfer when they are printed or read, instead of synchronizing on every update
+        """
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
+        self.lazy = lazy
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
             if isinstance(v, torch.Tensor):
+                if self.lazy:
+                    self.meters[k].update_lazy(v)
+                    continue
                 v = v.item()
             assert isinstance(v, (float, int))
             self.meters[k].update(v)
 
+    def resolve(self):
+        pending = [(meter, value, n) for meter in self.meters.values() for value, n in meter.pending]
+        if not pending:
+            return
+        device = pending[0][1].device
+        values = torch.stack([value.to(device) for _, value, _ in pending]).tolist()
+        for meter in self.meters.values():
+            meter.pending = []
+        for (meter, _, n), value in zip(pending, values):
+            meter.update(value, n)
+
     def __getattr__(self, attr):
         if attr in self.meters:
             return self.meters[attr]
@@ -236,6 +284,7 @@ class MetricLogger(object):
             type(self).__name__, attr))
 
     def __str__(self):
+        self.resolve()
         loss_str = []
         for name, meter in self.meters.items():
             loss_str.append(
@@ -244,6 +293,7 @@ class MetricLogger(object):
         return self.delimiter.join(loss_str)
 
     def synchronize_between_processes(self):
+        self.resolve()
         for meter in self.meters.values():
             meter.synchronize_between_processes()
 
@@ -351,6 +401,60 @@ def save_on_master(*args, **kwargs):
         torch.save(*args, **kwargs)
 
 
+def arch_state_dict(model):
+    """
+    The state of the searched compression rate, i.e. the entries of the DiffRate modules (named *ddp*).
+    """
+    return {k: v for k, v in model.state_dict().items() if k.find('ddp') > -1}
+
+
+def _clone_to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _clone_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_clone_to_cpu(v) for v in obj)
+    return obj
+
+
+class AsyncCheckpointSaver(object):
+    """
+    Save checkpoints on the main process from a background thread, so that training does not wait for the disk.
+    The tensors are copied to the cpu before save() returns, and the file is written to a temporary path
+    and renamed, so an interrupted write never leaves a partial checkpoint behind.
+    """
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, obj, path):
+        if not is_main_process():
+            return
+        self.wait()
+        obj = _clone_to_cpu(obj)
+        self.thread = threading.Thread(target=self._write, args=(obj, str(path)), daemon=True)
+        self.thread.start()
+
+    def _write(self, obj, path):
+        try:
+            torch.save(obj, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """
+        Block until the last checkpoint is written.
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
 
 class record_config():
     def __init__(self, args):
@@ -411,6 +515,22 @@ def accuracy(output, target, topk=(1,)):
 
     return correct_k
 
+def all_reduce_gradients(parameters):
+    """
+    Average the gradients of parameters over all processes with a single all-reduce of their concatenation.
+    """
+    if not is_dist_avail_and_initialized():
+        return
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = torch._utils._flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    for grad, reduced in zip(grads, torch._utils._unflatten_dense_tensors(flat, grads)):
+        grad.copy_(reduced)
+
+
 def ampscaler_get_grad_norm(parameters, norm_type: float = 2.0) -> torch.Tensor:
     if isinstance(parameters, torch.Tensor):
         parameters = [parameters]
@@ -430,12 +550,22 @@ def ampscaler_get_grad_norm(parameters, norm_type: float = 2.0) -> torch.Tensor:
 class NativeScalerWithGradNormCount:
     state_dict_key = "amp_scaler"
 
-    def __init__(self):
+    def __init__(self, all_reduce_grads=False):
+        '''
+        all_reduce_grads: average the gradients of the given parameters over all processes before the step,
+            for a model which is not wrapped by DistributedDataParallel
+        '''
         self._scaler = torch.cuda.amp.GradScaler()
+        self.all_reduce_grads = all_reduce_grads
 
     def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
         self._scaler.scale(loss).backward(create_graph=create_graph)
         if update_grad:
+            if self.all_reduce_grads:
+                assert parameters is not None
+                parameters = list(parameters)
+                # still scaled, a non-finite gradient on any process skips the step on all of them
+                all_reduce_gradients(parameters)
             if clip_grad is not None:
                 assert parameters is not None
                 self._scaler.unscale_(optimizer)  # unscale the gradients of optimizer's assigned params in-place
@@ -485,14 +615,17 @@ class MultiEpochsDataLoader(torch.utils.data.DataLoader):
         self._DataLoader__initialized = False
         self.batch_sampler = _RepeatSampler(self.batch_sampler)
         self._DataLoader__initialized = True
+        # the first pass may resume an epoch, and the next pass may start while its last batches are prefetched
+        self.first_len = len(self.batch_sampler.sampler)
         self.iterator = super().__iter__()
 
     def __len__(self):
-        return len(self.batch_sampler.sampler)
+        return self.first_len if self.first_len is not None else len(self.batch_sampler.sampler)
 
     def __iter__(self):
         for i in range(len(self)):
             yield next(self.iterator)
+        self.first_len = None
 
 
 class _RepeatSampler(object):